@@ -0,0 +1,24 @@
+# coding=utf-8
+"""Import the plugin's standalone modules without executing the package ``__init__``.
+
+The package ``__init__`` needs OctoPrint and Flask. The parser, state and storage modules do not,
+so the micro-benchmarks register an empty package object and import only the submodules they need.
+"""
+from __future__ import absolute_import
+
+import importlib
+import os
+import sys
+import types
+
+PACKAGE = "octoprint_Julia2018PrintRestore"
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), PACKAGE)
+
+
+def load(name):
+	"""Import ``octoprint_Julia2018PrintRestore.<name>`` and return the module."""
+	if PACKAGE not in sys.modules:
+		package = types.ModuleType(PACKAGE)
+		package.__path__ = [PACKAGE_DIR]
+		sys.modules[PACKAGE] = package
+	return importlib.import_module("{}.{}".format(PACKAGE, name))
@@ -0,0 +1,110 @@
+# coding=utf-8
+"""Micro-benchmark: per-line cost of the G-code word parser versus the original string scanning.
+
+Usage: python benchmarks/bench_gcode_parser.py [repeat]
+"""
+from __future__ import absolute_import, print_function
+
+import sys
+import timeit
+
+from _loader import load
+
+gcode_parser = load("gcode_parser")
+parse_words = gcode_parser.parse_words
+parse_move = gcode_parser.parse_move
+
+LINES = [
+	"G1 X102.345 Y87.123 E1.23456",
+	"G1 X103.001 Y88.992 E1.30021 F1800",
+	"G0 F9000 X120.5 Y60.25 Z0.6",
+	"G1 Z0.4 F600",
+	"G1 E-0.8 F2400",
+	"G1 X98.5 Y91.75 E1.41",
+]
+
+# Forms the original scan gets wrong: glued words, lower case, trailing comments.
+EXTRA_LINES = [
+	"G1X10.5Y20.25E.8",
+	"g1 x10 y20 e0.5",
+	"G1 Z0.4 F600 ; lift to Z1",
+]
+
+AXES = frozenset("XYZEF")
+
+
+def legacy_record(cmd, state):
+	"""The axis extraction previously done by record_current_state for G0/G1."""
+	if "X" in cmd:
+		state["X"] = cmd[cmd.index('X') + 1:].split(' ', 1)[0]
+	if "Y" in cmd:
+		state["Y"] = cmd[cmd.index('Y') + 1:].split(' ', 1)[0]
+	if "Z" in cmd:
+		state["Z"] = cmd[cmd.index('Z') + 1:].split(' ', 1)[0]
+	if "E" in cmd:
+		state["E"] = cmd[cmd.index('E') + 1:].split(' ', 1)[0]
+	if "F" in cmd:
+		state["F"] = cmd[cmd.index('F') + 1:].split(' ', 1)[0]
+
+
+def legacy_record_float(cmd, state):
+	"""The original scan plus the float() conversion start_restore applies to every value."""
+	if "X" in cmd:
+		state["X"] = float(cmd[cmd.index('X') + 1:].split(' ', 1)[0])
+	if "Y" in cmd:
+		state["Y"] = float(cmd[cmd.index('Y') + 1:].split(' ', 1)[0])
+	if "Z" in cmd:
+		state["Z"] = float(cmd[cmd.index('Z') + 1:].split(' ', 1)[0])
+	if "E" in cmd:
+		state["E"] = float(cmd[cmd.index('E') + 1:].split(' ', 1)[0])
+	if "F" in cmd:
+		state["F"] = float(cmd[cmd.index('F') + 1:].split(' ', 1)[0])
+
+
+def parser_record(cmd, state):
+	state.update(parse_words(cmd))
+
+
+def move_record(cmd, state):
+	state["X"], state["Y"], state["Z"], state["E"], state["F"] = parse_move(cmd)
+
+
+def bench(funcs, repeat, rounds=200):
+	"""Best ns/line of each function. Many short rounds are interleaved, so a noisy machine slows all of them alike."""
+	best = [None] * len(funcs)
+	for _ in range(rounds):
+		for i, func in enumerate(funcs):
+			state = {}
+
+			def run():
+				for line in LINES:
+					func(line, state)
+
+			elapsed = timeit.timeit(run, number=repeat)
+			if best[i] is None or elapsed < best[i]:
+				best[i] = elapsed
+	return [b / (repeat * len(LINES)) * 1e9 for b in best]
+
+
+def main():
+	repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	legacy, legacy_float, parser, move = bench((legacy_record, legacy_record_float, parser_record, move_record), repeat)
+	print("legacy string scan:         {:8.1f} ns/line (raw strings, no validation)".format(legacy))
+	print("legacy scan + float():      {:8.1f} ns/line (same values as parse_words)".format(legacy_float))
+	print("parse_words:                {:8.1f} ns/line (floats, lower case and comment aware)".format(parser))
+	print("parse_move:                 {:8.1f} ns/line (G0/G1 fast path, no dict)".format(move))
+	print("speedup vs legacy scan:      {:7.2f}x parse_words, {:.2f}x parse_move".format(legacy / parser, legacy / move))
+	print("speedup vs legacy + float(): {:7.2f}x parse_words, {:.2f}x parse_move".format(legacy_float / parser, legacy_float / move))
+	print("")
+	for line in EXTRA_LINES:
+		legacy_state = {}
+		legacy_record(line, legacy_state)
+		parser_state = {}
+		for axis, value in parse_words(line).items():
+			if axis in AXES:
+				parser_state[axis] = value
+		print("{!r:30} legacy={} parse_words={}".format(line, sorted(legacy_state.items()), sorted(parser_state.items())))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,216 @@
+# coding=utf-8
+"""Benchmark: time to resume a restored print, serial heat-up sequence versus the parallel planner.
+
+Runs on a simulated printer with a first order thermal model per heater: a heater on full power approaches
+``max`` with time constant ``tau``, a heater that is off cools towards ambient, and the firmware holds the
+target with bang-bang control. The firmware executes its command queue in order: M109/M190 block until the
+heater is within ``TEMP_WINDOW`` of its target for the residency time (Marlin defaults), G28 takes a fixed
+time. Temperatures are reported to the host every ``REPORT_INTERVAL`` seconds, like OctoPrint's polling.
+
+* ``serial``: the heat-up sequence ``start_restore`` sent before the planner: heat the nozzles to 140,
+  M109 each, home, then M190 the bed and M109 each nozzle at full temperature.
+* ``parallel``: :func:`restore_planner.plan_heat_up` run by :class:`restore_planner.RestoreRunner`
+  on simulated time.
+
+The ``estimate`` column is :func:`restore_planner.estimate_heat_up` with a :class:`thermal_model.ThermalModel`
+trained on the reports of one simulated heat-up to other targets, shown next to the simulated parallel time.
+
+The time to resume is when the firmware is done with everything queued before the job is resumed.
+"preheated" scenarios start at the hold temperatures of the speculative preheat, i.e. a restore confirmed
+after the preheat settled.
+
+Usage: python benchmarks/bench_heatup.py
+"""
+from __future__ import absolute_import, print_function
+
+import logging
+
+from _loader import load
+
+restore_planner = load("restore_planner")
+thermal_model = load("thermal_model")
+
+DT = 0.1
+AMBIENT = 25.0
+REPORT_INTERVAL = 2.0
+TEMP_WINDOW = 1.0
+TEMP_RESIDENCY_TIME = 10.0
+TEMP_BED_RESIDENCY_TIME = 10.0
+HOME_TIME = {"z": 15.0, "xy": 12.0}
+
+# (max temperature on full power, time constant in seconds)
+HEATERS = {"tool0": (320.0, 90.0), "tool1": (320.0, 90.0), "bed": (130.0, 400.0)}
+
+SCENARIOS = [
+	# name, targets, starting temperatures (ambient if left out)
+	("PLA, one nozzle", {"tool0": 210.0, "bed": 60.0}, {}),
+	("PLA, two nozzles", {"tool0": 210.0, "tool1": 215.0, "bed": 60.0}, {}),
+	("ABS, two nozzles", {"tool0": 240.0, "tool1": 240.0, "bed": 100.0}, {}),
+	("PLA, two nozzles, warm", {"tool0": 210.0, "tool1": 215.0, "bed": 60.0},
+	 {"tool0": 90.0, "tool1": 90.0, "bed": 45.0}),
+]
+# confirmed after the speculative preheat settled at its hold temperatures
+SCENARIOS += [(name + ", preheated", targets, restore_planner.preheat_targets(targets))
+			  for name, targets, _ in SCENARIOS[:3]]
+
+
+class Heater(object):
+
+	def __init__(self, max_temperature, tau, actual):
+		self.max_temperature = max_temperature
+		self.tau = tau
+		self.actual = actual
+		self.target = 0.0
+
+	def step(self, dt):
+		goal = self.max_temperature if self.actual < self.target else AMBIENT
+		self.actual += (goal - self.actual) * dt / self.tau
+
+
+class SimulatedPrinter(object):
+	"""Printer on simulated time. ``now`` is the host's time, ``busy_until`` when the firmware's queue is empty."""
+
+	def __init__(self, start_temperatures):
+		self.now = 0.0
+		self.busy_until = 0.0
+		self.heaters = dict((name, Heater(max_temperature, tau, start_temperatures.get(name, AMBIENT)))
+							for name, (max_temperature, tau) in HEATERS.items())
+		self._world = 0.0
+		self._pending = []  # (time, heater, target) changes queued behind blocking commands
+		self._reported = {}
+		self._reported_at = None
+
+	def advance(self, until):
+		while self._world < until:
+			while self._pending and self._pending[0][0] <= self._world:
+				_, heater, target = self._pending.pop(0)
+				self.heaters[heater].target = target
+			for heater in self.heaters.values():
+				heater.step(DT)
+			self._world += DT
+
+	def _set_target(self, at, heater, target):
+		if at <= self._world:
+			self.heaters[heater].target = target
+		else:
+			self._pending.append((at, heater, target))
+
+	def _wait_for(self, heater, residency):
+		heater = self.heaters[heater]
+		settled_since = None
+		while True:
+			if abs(heater.actual - heater.target) <= TEMP_WINDOW or heater.actual > heater.target:
+				if settled_since is None:
+					settled_since = self._world
+				if self._world - settled_since >= residency:
+					return self._world
+			else:
+				settled_since = None
+			self.advance(self._world + DT)
+
+	def _queue(self, command):
+		start = max(self.now, self.busy_until)
+		words = dict((word[0], word[1:]) for word in command.split()[1:])
+		code = command.split()[0]
+		if code in ("M104", "M109"):
+			heater = "tool" + words.get("T", "0")
+		elif code in ("M140", "M190"):
+			heater = "bed"
+		else:
+			heater = None
+		if code in ("M104", "M140"):
+			self._set_target(start, heater, float(words["S"]))
+			self.busy_until = start
+		elif code in ("M109", "M190"):
+			self.advance(start)
+			self._set_target(start, heater, float(words["S"]))
+			self.busy_until = self._wait_for(heater, TEMP_RESIDENCY_TIME if code == "M109" else TEMP_BED_RESIDENCY_TIME)
+		elif code == "G28":
+			self.busy_until = start + HOME_TIME["z" if "Z" in words else "xy"]
+		else:
+			self.busy_until = start
+
+	# PrinterInterface subset used by the restore runner
+	def commands(self, commands):
+		for command in [commands] if isinstance(commands, str) else commands:
+			self._queue(command)
+
+	def home(self, axes):
+		self._queue("G28 " + " ".join("{}0".format(axis.upper()) for axis in axes))
+
+	def temperatures(self):
+		if self._reported_at is None or self.now - self._reported_at >= REPORT_INTERVAL:
+			self.advance(self.now)
+			self._reported = dict((name, (heater.actual, heater.target)) for name, heater in self.heaters.items())
+			self._reported_at = self.now
+		return self._reported
+
+	def sleep(self, seconds):
+		self.now += seconds
+		self.advance(self.now)
+
+	def clock(self):
+		return self.now
+
+
+def serial_sequence(printer, targets):
+	"""The heat-up and homing start_restore queued before the planner."""
+	tools = [heater for heater in ("tool0", "tool1") if heater in targets]
+	if "bed" in targets:
+		printer.commands("M140 S{}".format(targets["bed"]))
+	for tool in tools:
+		printer.commands("M104 T{} S140".format(tool[4:]))
+	for tool in tools:
+		printer.commands("M109 T{} S140".format(tool[4:]))
+	printer.commands("T0")
+	printer.home("z")
+	printer.home(["x", "y"])
+	for tool in tools:
+		printer.commands("M104 T{} S{}".format(tool[4:], targets[tool]))
+	if "bed" in targets:
+		printer.commands("M190 S{}".format(targets["bed"]))
+	for tool in tools:
+		printer.commands("M109 T{} S{}".format(tool[4:], targets[tool]))
+	return max(printer.now, printer.busy_until)
+
+
+def parallel_sequence(printer, targets):
+	logger = logging.getLogger("bench_heatup")
+	logger.addHandler(logging.NullHandler())
+	logger.propagate = False
+	runner = restore_planner.RestoreRunner(printer, printer.temperatures, logger,
+										   clock=printer.clock, sleep=printer.sleep)
+	runner.execute(restore_planner.plan_heat_up(targets))
+	return max(printer.now, printer.busy_until)
+
+
+def train_model(targets, seconds=900.0):
+	"""Learn a thermal model from the temperature reports of a simulated heat-up from ambient."""
+	model = thermal_model.ThermalModel()
+	printer = SimulatedPrinter({})
+	printer.commands([restore_planner.set_temperature_command(heater, target) for heater, target in targets.items()])
+	while printer.now < seconds:
+		model.update(printer.temperatures(), printer.now)
+		printer.sleep(REPORT_INTERVAL)
+	return model
+
+
+def main():
+	model = train_model({"tool0": 260.0, "tool1": 250.0, "bed": 110.0})
+	for name in sorted(model.heaters):
+		k, t_max = model.heaters[name].fit()
+		print("learned {}: tau {:.0f} s, max {:.0f} C (simulated: tau {:.0f} s, max {:.0f} C)".format(
+			name, 1.0 / k, t_max, HEATERS[name][1], HEATERS[name][0]))
+	print("")
+	print("{:34} {:>10} {:>10} {:>10} {:>8} {:>10}".format("scenario", "serial s", "parallel s", "saved s", "speedup", "estimate s"))
+	for name, targets, start in SCENARIOS:
+		serial = serial_sequence(SimulatedPrinter(start), targets)
+		parallel = parallel_sequence(SimulatedPrinter(start), targets)
+		temperatures = dict((heater, (temperature, 0.0)) for heater, temperature in start.items())
+		estimate = restore_planner.estimate_heat_up(targets, temperatures, model.time_to)
+		print("{:34} {:10.1f} {:10.1f} {:10.1f} {:8.2f} {:10.1f}".format(
+			name, serial, parallel, serial - parallel, serial / parallel, estimate))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Benchmark: layer index build time with 1 to N worker processes.
+
+The input file is concatenated ``--copies`` times into a temporary file to simulate large prints.
+Every index is checked against the one scanned in the calling thread (0 processes).
+
+While each build runs, a loop standing in for OctoPrint's printer communication thread sleeps 1 ms and
+does a little Python work. Its wake-ups per second show how much the build holds up the calling process.
+
+Usage: python benchmarks/bench_index_builder.py [--copies N] [--max-processes N] FILE
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+
+from _loader import load
+
+gcode_index = load("gcode_index")
+
+_clock = timeit.default_timer
+
+
+def same_index(a, b, tolerance=1e-6):
+	"""Compare two indexes, positions may differ by float rounding as chunks add up E separately."""
+	if a.offsets != b.offsets or a.layers != b.layers:
+		return False
+	for x, y in zip(a.snapshots, b.snapshots):
+		for p, q in zip(x, y):
+			if isinstance(p, float) and isinstance(q, float):
+				if abs(p - q) > tolerance:
+					return False
+			elif p != q:
+				return False
+	return True
+
+
+def comm_loop_rate(func, duration=None):
+	"""Run ``func`` in a thread and count the wake-ups of a 1 ms sleep loop until it returns.
+
+	Returns:
+		tuple: (result of func, seconds it took, wake-ups per second)
+	"""
+	result = []
+	thread = threading.Thread(target=lambda: result.append(func()))
+	start = _clock()
+	thread.start()
+	wakeups = 0
+	while thread.is_alive() or (duration is not None and _clock() - start < duration):
+		time.sleep(0.001)
+		sum(range(50))
+		wakeups += 1
+	elapsed = _clock() - start
+	thread.join()
+	return result[0] if result else None, elapsed, wakeups / elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Time layer index builds with multiple processes")
+	parser.add_argument("file", help="G-code file")
+	parser.add_argument("--copies", type=int, default=1, help="Concatenate the file this many times")
+	parser.add_argument("--max-processes", type=int, default=4)
+	args = parser.parse_args()
+
+	folder = tempfile.mkdtemp(prefix="print_restore_index_")
+	try:
+		path = os.path.join(folder, "input.gcode")
+		with open(args.file, "rb") as source:
+			content = source.read()
+		with open(path, "wb") as f:
+			for _ in range(args.copies):
+				f.write(content)
+		size = os.path.getsize(path)
+		print("file: {:.1f} MB, {} CPUs".format(size / 1e6, multiprocessing.cpu_count()))
+
+		idle = comm_loop_rate(lambda: None, duration=1.0)[2]
+		print("comm loop idle: {:6.0f} wake-ups/s".format(idle))
+		baseline = None
+		for processes in range(0, args.max_processes + 1):
+			index, elapsed, rate = comm_loop_rate(lambda: gcode_index.build_layer_index(path, processes=processes))
+			if baseline is None:
+				baseline = index, elapsed
+			print("{} process(es): {:8.3f} s {:6.1f} MB/s speedup {:5.2f} entries {:6d} {} comm loop {:6.0f} wake-ups/s".format(
+				processes, elapsed, size / 1e6 / elapsed, baseline[1] / elapsed, len(index),
+				"ok" if same_index(baseline[0], index) else "MISMATCH", rate))
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,66 @@
+# coding=utf-8
+"""Benchmark: printer state reconstruction from a G-code file, with and without the layer index.
+
+The input file is concatenated ``--copies`` times into a temporary file to simulate large prints.
+
+Usage: python benchmarks/bench_reconstruct.py [--copies N] [--positions N] FILE
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from _loader import load
+
+gcode_index = load("gcode_index")
+
+_clock = timeit.default_timer
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Time printer state reconstruction from a G-code file")
+	parser.add_argument("file", help="G-code file")
+	parser.add_argument("--copies", type=int, default=1, help="Concatenate the file this many times")
+	parser.add_argument("--positions", type=int, default=20, help="Random file positions to reconstruct")
+	args = parser.parse_args()
+
+	folder = tempfile.mkdtemp(prefix="print_restore_reconstruct_")
+	try:
+		path = os.path.join(folder, "input.gcode")
+		with open(args.file, "rb") as source:
+			content = source.read()
+		with open(path, "wb") as f:
+			for _ in range(args.copies):
+				f.write(content)
+		size = os.path.getsize(path)
+		print("file: {:.1f} MB".format(size / 1e6))
+
+		start = _clock()
+		index = gcode_index.build_layer_index(path)
+		elapsed = _clock() - start
+		print("build index:      {:8.3f} s ({:.1f} MB/s, {} entries)".format(elapsed, size / 1e6 / elapsed, len(index)))
+
+		positions = [random.randint(0, size) for _ in range(args.positions)]
+		for name, use_index in (("full scan", False), ("from index", True)):
+			worst = total = 0.0
+			for pos in positions:
+				start = _clock()
+				gcode_index.reconstruct_state(path, pos, index if use_index else None)
+				elapsed = _clock() - start
+				worst = max(worst, elapsed)
+				total += elapsed
+			print("{:17} mean {:8.4f} s, max {:8.4f} s".format(name + ":", total / len(positions), worst))
+
+		mismatches = sum(gcode_index.reconstruct_state(path, pos).snapshot() !=
+						 gcode_index.reconstruct_state(path, pos, index).snapshot() for pos in positions[:5])
+		print("mismatching states: {}".format(mismatches))
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
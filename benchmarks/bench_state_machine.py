@@ -0,0 +1,82 @@
+# coding=utf-8
+"""Micro-benchmark: per-line cost of the motion state machine, with and without word parsing.
+
+``state.apply`` is what the sent hook runs per line, including command dispatch and :func:`parse_move`.
+It is compared with the axis scan the sent hook ran before, which kept the raw strings without validating them.
+
+Usage: python benchmarks/bench_state_machine.py [repeat]
+"""
+from __future__ import absolute_import, print_function
+
+import sys
+import timeit
+
+from _loader import load
+
+parse_words = load("gcode_parser").parse_words
+PrinterState = load("state").PrinterState
+
+LINES = [
+	"G1 X102.345 Y87.123 E0.0312",
+	"G1 X103.001 Y88.992 E0.0287 F1800",
+	"G0 F9000 X120.5 Y60.25",
+	"G1 Z0.4 F600",
+	"G1 E-0.8 F2400",
+	"G1 X98.5 Y91.75 E0.0301",
+]
+
+
+def legacy_record(gcode, cmd, state_position):
+	"""The G0/G1 branch previously run by record_current_state."""
+	if gcode == "G1" or gcode == "G0":
+		if "X" in cmd:
+			state_position["X"] = cmd[cmd.index('X') + 1:].split(' ', 1)[0]
+		if "Y" in cmd:
+			state_position["Y"] = cmd[cmd.index('Y') + 1:].split(' ', 1)[0]
+		if "Z" in cmd:
+			state_position["Z"] = cmd[cmd.index('Z') + 1:].split(' ', 1)[0]
+		if "E" in cmd:
+			state_position["E"] = cmd[cmd.index('E') + 1:].split(' ', 1)[0]
+		if "F" in cmd:
+			state_position["F"] = cmd[cmd.index('F') + 1:].split(' ', 1)[0]
+
+
+def main():
+	repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	state = PrinterState()
+	state.set_relative_e(True)
+	words = [parse_words(line) for line in LINES]
+
+	def update_only():
+		for w in words:
+			state.move(w)
+
+	def parse_and_update():
+		for line in LINES:
+			state.move(parse_words(line))
+
+	commands = [line.split(None, 1)[0] for line in LINES]
+
+	def apply():
+		for gcode, line in zip(commands, LINES):
+			state.apply(gcode, line)
+
+	state_position = {}
+
+	def legacy():
+		for gcode, line in zip(commands, LINES):
+			legacy_record(gcode, line, state_position)
+
+	benches = (("state.move only", update_only), ("parse_words + state.move", parse_and_update),
+			   ("state.apply (sent hook)", apply), ("legacy axis scan", legacy))
+	# many short interleaved rounds, so a noisy machine slows all of them alike
+	best = [float("inf")] * len(benches)
+	for _ in range(200):
+		for i, (name, func) in enumerate(benches):
+			best[i] = min(best[i], timeit.timeit(func, number=repeat))
+	for (name, func), elapsed in zip(benches, best):
+		print("{:26} {:8.1f} ns/line".format(name, elapsed / (repeat * len(LINES)) * 1e9))
+
+
+if __name__ == "__main__":
+	main()
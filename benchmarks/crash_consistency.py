@@ -0,0 +1,483 @@
+# coding=utf-8
+"""Power-cut fault injection for the restore file storage backends.
+
+Every file operation of a storage backend (open, buffered write reaching the OS, fsync/fdatasync,
+msync, rename, remove, directory fsync, stores into a memory map) is routed to an in-memory file system.
+A run writes a series of checkpoints and cuts the power right before the N-th operation. The state that
+survives is then built with the following model:
+
+	* data and metadata committed by fsync/fdatasync/msync (file) or by fsync of the directory (names) survive;
+	* every operation issued since the last commit may or may not have reached the disk, independently;
+	* writes that did reach the disk may be torn at 512 byte sector granularity.
+
+The backend's reader is then run on what survived and the result is classified as "latest" (last
+acknowledged checkpoint or the one in flight), "older" (an acknowledged checkpoint was lost), "none"
+(nothing readable although a checkpoint had been acknowledged) or "empty" (power was cut before the
+first checkpoint was acknowledged). Every operation boundary of the run is tried with several seeds.
+
+It also reports the cost of one checkpoint per backend: operations, syncs and metadata operations
+counted on the simulated file system, and wall-clock write latency on a real directory.
+
+Usage: python benchmarks/crash_consistency.py [--checkpoints N] [--seeds N] [--latency-writes N]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from _loader import load
+
+storage = load("storage")
+
+SECTOR = 512
+SIM_DIR = "/sim"
+
+
+class PowerCut(Exception):
+	pass
+
+
+class Inode(object):
+	def __init__(self):
+		self.current = bytearray()
+		self.durable = bytearray()
+		self.pending = []  # ("truncate", size) or ("write", offset, bytes) issued since the last sync
+
+	def write(self, offset, data):
+		end = offset + len(data)
+		if len(self.current) < end:
+			self.current.extend(b"\0" * (end - len(self.current)))
+		self.current[offset:end] = data
+		self.pending.append(("write", offset, bytes(data)))
+
+	def truncate(self):
+		del self.current[:]
+		self.pending.append(("truncate", 0))
+
+	def sync(self, start=None, end=None):
+		if start is None:
+			self.durable = bytearray(self.current)
+			self.pending = []
+			return
+		# ranged sync (msync): commit the range, keep the writes outside of it pending
+		if len(self.durable) < end:
+			self.durable.extend(b"\0" * (end - len(self.durable)))
+		self.durable[start:end] = self.current[start:end]
+		self.pending = [op for op in self.pending if not (op[0] == "write" and start <= op[1] and op[1] + len(op[2]) <= end)]
+
+	def survivor(self, rng):
+		"""Content after a power cut: durable data plus a random subset of pending sectors."""
+		content = bytearray(self.durable)
+		for op in self.pending:
+			if op[0] == "truncate":
+				if rng.random() < 0.5:
+					del content[:]
+				continue
+			_, offset, data = op
+			position = offset
+			while position < offset + len(data):
+				end = min(offset + len(data), (position // SECTOR + 1) * SECTOR)
+				if rng.random() < 0.5:
+					if len(content) < end:
+						content.extend(b"\0" * (end - len(content)))
+					content[position:end] = data[position - offset:end - offset]
+				position = end
+		return content
+
+
+class SimFS(object):
+	"""In-memory file system counting operations and cutting the power at a chosen one."""
+
+	def __init__(self, crash_at=None):
+		self.crash_at = crash_at
+		self.ops = 0
+		self.syncs = 0
+		self.metadata_ops = 0
+		self.bytes_written = 0
+		self.names = {}
+		self.durable_names = {}
+		self.pending_names = []  # ("link", name, inode) / ("unlink", name) issued since the last directory sync
+		self._fds = {}
+		self._next_fd = 1000
+
+	def op(self):
+		self.ops += 1
+		if self.crash_at is not None and self.ops >= self.crash_at:
+			raise PowerCut()
+
+	def fd_for(self, target):
+		fd = self._next_fd
+		self._next_fd += 1
+		self._fds[fd] = target
+		return fd
+
+	def lookup_fd(self, fd):
+		return self._fds[fd]
+
+	def link(self, name, inode):
+		self.names[name] = inode
+		self.pending_names.append(("link", name, inode))
+
+	def unlink(self, name):
+		del self.names[name]
+		self.pending_names.append(("unlink", name))
+
+	def sync_directory(self):
+		self.durable_names = dict(self.names)
+		self.pending_names = []
+
+	def after_power_cut(self, rng):
+		"""Build the file system that survives the power cut."""
+		names = dict(self.durable_names)
+		for op in self.pending_names:
+			if rng.random() < 0.5:
+				if op[0] == "link":
+					names[op[1]] = op[2]
+				else:
+					names.pop(op[1], None)
+		fs = SimFS()
+		survivors = {}
+		for name, inode in names.items():
+			if id(inode) not in survivors:
+				fresh = Inode()
+				fresh.current = inode.survivor(rng)
+				fresh.durable = bytearray(fresh.current)
+				survivors[id(inode)] = fresh
+			fs.names[name] = survivors[id(inode)]
+		fs.durable_names = dict(fs.names)
+		return fs
+
+
+class SimFile(object):
+	"""File object over an Inode, buffering writes until flush like Python's buffered I/O."""
+
+	def __init__(self, fs, inode, binary, position=0):
+		self._fs = fs
+		self._inode = inode
+		self._binary = binary
+		self._position = position
+		self._buffer = []
+		self._buffer_start = position
+		self._fd = fs.fd_for(self)
+		self.closed = False
+
+	def write(self, data):
+		if not self._binary:
+			data = data.encode("utf-8")
+		if not self._buffer:
+			self._buffer_start = self._position
+		self._buffer.append(data)
+		self._position += len(data)
+		return len(data)
+
+	def flush(self):
+		if self._buffer:
+			self._fs.op()
+			data = b"".join(self._buffer)
+			self._inode.write(self._buffer_start, data)
+			self._fs.bytes_written += len(data)
+			self._buffer = []
+
+	def seek(self, position):
+		self.flush()
+		self._position = position
+
+	def read(self):
+		self.flush()
+		data = bytes(self._inode.current[self._position:])
+		self._position = len(self._inode.current)
+		return data if self._binary else data.decode("utf-8")
+
+	def fileno(self):
+		return self._fd
+
+	def sync(self):
+		# like fsync, data still in the Python buffer is not committed
+		self._inode.sync()
+
+	def close(self):
+		if not self.closed:
+			self.flush()
+			self.closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class SimMmap(bytearray):
+	"""Memory map over an Inode. Every store is an unsynced write, flush is msync."""
+
+	def __init__(self, fs, inode):
+		bytearray.__init__(self, inode.current)
+		self._fs = fs
+		self._inode = inode
+
+	def __setitem__(self, index, value):
+		self._fs.op()
+		bytearray.__setitem__(self, index, value)
+		self._inode.write(index.start, bytes(value))
+		self._fs.bytes_written += len(value)
+
+	def flush(self, offset, size):
+		self._fs.op()
+		self._fs.syncs += 1
+		self._inode.sync(offset, offset + size)
+
+	def close(self):
+		pass
+
+
+class SimOs(object):
+	"""The parts of the ``os`` module used by the storage backends."""
+
+	O_RDONLY = os.O_RDONLY
+
+	def __init__(self, fs):
+		self._fs = fs
+		self.path = SimPath(fs)
+
+	def fsync(self, fd):
+		self._fs.op()
+		self._fs.syncs += 1
+		if hasattr(fd, "fileno"):
+			fd = fd.fileno()
+		target = self._fs.lookup_fd(fd)
+		if target == SIM_DIR:
+			self._fs.metadata_ops += 1
+			self._fs.sync_directory()
+		else:
+			target.sync()
+
+	def open(self, path, flags):
+		if path != SIM_DIR:
+			raise OSError("Cannot open {}".format(path))
+		return self._fs.fd_for(SIM_DIR)
+
+	def close(self, fd):
+		pass
+
+	def rename(self, src, dst):
+		self._fs.op()
+		self._fs.metadata_ops += 1
+		inode = self._fs.names[src]
+		self._fs.unlink(src)
+		self._fs.link(dst, inode)
+
+	def remove(self, path):
+		self._fs.op()
+		self._fs.metadata_ops += 1
+		self._fs.unlink(path)
+
+
+class SimPath(object):
+	def __init__(self, fs):
+		self._fs = fs
+
+	def isfile(self, path):
+		return path in self._fs.names
+
+	def getsize(self, path):
+		return len(self._fs.names[path].current)
+
+	dirname = staticmethod(os.path.dirname)
+	splitext = staticmethod(os.path.splitext)
+
+	@staticmethod
+	def abspath(path):
+		return path
+
+
+class SimMmapModule(object):
+	ALLOCATIONGRANULARITY = storage.mmap.ALLOCATIONGRANULARITY
+
+	def __init__(self, fs):
+		self._fs = fs
+
+	def mmap(self, fd, size):
+		return SimMmap(self._fs, self._fs.lookup_fd(fd)._inode)
+
+
+def sim_open(fs):
+	def _open(path, mode="r"):
+		binary = "b" in mode
+		if mode.startswith("r"):
+			if path not in fs.names:
+				raise IOError("No such file: {}".format(path))
+			return SimFile(fs, fs.names[path], binary)
+		# "w" modes create or truncate
+		fs.op()
+		if path in fs.names:
+			inode = fs.names[path]
+			inode.truncate()
+		else:
+			fs.metadata_ops += 1
+			inode = Inode()
+			fs.link(path, inode)
+		return SimFile(fs, inode, binary)
+	return _open
+
+
+class patched(object):
+	"""Route the storage module's file operations to a SimFS for the duration of a with block."""
+
+	def __init__(self, fs):
+		self._fs = fs
+
+	def __enter__(self):
+		self._saved = (storage.os, storage.mmap, storage._fdatasync, getattr(storage, "open", None))
+		storage.os = SimOs(self._fs)
+		storage.mmap = SimMmapModule(self._fs)
+		storage._fdatasync = storage.os.fsync
+		storage.open = sim_open(self._fs)
+		return self._fs
+
+	def __exit__(self, *args):
+		storage.os, storage.mmap, storage._fdatasync, saved_open = self._saved
+		if saved_open is None:
+			del storage.open
+		else:
+			storage.open = saved_open
+
+
+class LegacyJsonRestoreStorage(storage.JsonRestoreStorage):
+	"""The original write_restore_file: no flush before fsync and no directory fsync after the rename."""
+
+	name = "json-legacy"
+
+	def write(self, data):
+		with getattr(storage, "open", open)(self.temp_path, 'w') as restoreFile:
+			json.dump(data, restoreFile)
+			storage.os.fsync(restoreFile)
+		storage.os.rename(self.temp_path, self.path)
+
+
+def _small_journal(path):
+	# small capacity so the runs wrap around the journal
+	return storage.JournalRestoreStorage(path, capacity=8)
+
+
+BACKENDS = [
+	("json-legacy", LegacyJsonRestoreStorage, SIM_DIR + "/print_restore.json"),
+	("json", storage.JsonRestoreStorage, SIM_DIR + "/print_restore.json"),
+	("journal", _small_journal, SIM_DIR + "/print_restore.journal"),
+	("mmap", storage.MmapSlotRestoreStorage, SIM_DIR + "/print_restore.slots"),
+]
+
+
+def checkpoint(index):
+	return {"fileName": "benchy.gcode", "filePos": index * 1000, "path": "benchy.gcode",
+			"tool0Target": 210.0, "bedTarget": 60.0, "babystep": 0,
+			"position": {"X": 10.0 + index, "Y": 20.0, "Z": 0.2 * index, "E": 3.5 * index, "F": 1800.0}}
+
+
+def run(factory, path, checkpoints, crash_at=None):
+	"""Write checkpoints until the power is cut.
+
+	Returns:
+		tuple: (SimFS, index of the last acknowledged checkpoint or 0)
+	"""
+	fs = SimFS(crash_at)
+	acknowledged = 0
+	with patched(fs):
+		backend = factory(path)
+		try:
+			for index in range(1, checkpoints + 1):
+				backend.write(checkpoint(index))
+				acknowledged = index
+		except PowerCut:
+			pass
+	return fs, acknowledged
+
+
+def recover(factory, path, fs):
+	with patched(fs):
+		try:
+			data = factory(path).read()
+		except Exception:
+			return None
+	return data["filePos"] // 1000 if data is not None else None
+
+
+def fault_injection(name, factory, path, checkpoints, seeds):
+	total_ops = run(factory, path, checkpoints)[0].ops
+	outcome = {"latest": 0, "older": 0, "none": 0, "empty": 0}
+	for crash_at in range(1, total_ops + 1):
+		for seed in range(seeds):
+			fs, acknowledged = run(factory, path, checkpoints, crash_at)
+			recovered = recover(factory, path, fs.after_power_cut(random.Random(seed * 100003 + crash_at)))
+			if acknowledged == 0:
+				outcome["empty"] += 1
+			elif recovered is None:
+				outcome["none"] += 1
+			elif recovered >= acknowledged:
+				outcome["latest"] += 1
+			else:
+				outcome["older"] += 1
+	outcome["trials"] = total_ops * seeds
+	outcome["crashPoints"] = total_ops
+	return outcome
+
+
+def write_cost(factory, path, checkpoints):
+	fs = run(factory, path, checkpoints)[0]
+	return {"opsPerCheckpoint": float(fs.ops) / checkpoints,
+			"syncsPerCheckpoint": float(fs.syncs) / checkpoints,
+			"metadataOpsPerCheckpoint": float(fs.metadata_ops) / checkpoints,
+			"bytesPerCheckpoint": float(fs.bytes_written) / checkpoints}
+
+
+def real_latency(name, factory, writes):
+	"""Mean and p99 write latency against a real directory, in milliseconds."""
+	directory = tempfile.mkdtemp(prefix="print_restore_crash_")
+	try:
+		path = os.path.join(directory, os.path.basename(dict((b[0], b[2]) for b in BACKENDS)[name]))
+		backend = factory(path)
+		latencies = []
+		for index in range(writes):
+			start = timeit.default_timer()
+			backend.write(checkpoint(index))
+			latencies.append(timeit.default_timer() - start)
+		if hasattr(backend, "close"):
+			backend.close()
+		latencies.sort()
+		return {"meanMs": sum(latencies) / len(latencies) * 1e3,
+				"p99Ms": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1e3}
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Power-cut fault injection for restore storage backends")
+	parser.add_argument("--checkpoints", type=int, default=20, help="Checkpoints written per run")
+	parser.add_argument("--seeds", type=int, default=50, help="Random survivor states tried per crash point")
+	parser.add_argument("--latency-writes", type=int, default=200, help="Writes timed on a real directory")
+	args = parser.parse_args()
+
+	results = {}
+	for name, factory, path in BACKENDS:
+		result = fault_injection(name, factory, path, args.checkpoints, args.seeds)
+		result.update(write_cost(factory, path, args.checkpoints))
+		result.update(real_latency(name, factory, args.latency_writes))
+		results[name] = result
+
+	print("{:12} {:>7} {:>7} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6} {:>8} {:>8}".format(
+		"backend", "trials", "latest", "older", "none", "empty", "ops", "syncs", "meta", "mean ms", "p99 ms"))
+	for name, _, _ in BACKENDS:
+		r = results[name]
+		print("{:12} {:7d} {:7d} {:6d} {:6d} {:6d} {:6.1f} {:6.1f} {:6.1f} {:8.3f} {:8.3f}".format(
+			name, r["trials"], r["latest"], r["older"], r["none"], r["empty"], r["opsPerCheckpoint"],
+			r["syncsPerCheckpoint"], r["metadataOpsPerCheckpoint"], r["meanMs"], r["p99Ms"]))
+	print("")
+	print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,415 @@
+# coding=utf-8
+"""Replay G-code files and serial logs through the plugin hooks at full speed.
+
+Builds ``Julia2018PrintRestore`` against stand-in ``_printer``, ``_settings``, ``_file_manager`` and
+``_plugin_manager`` objects, so no printer or running server is needed. OctoPrint itself has to be
+installed, as the plugin module and ``gcode_command_for_cmd`` come from it.
+
+Inputs:
+	* ``*.gcode`` files are sent line by line through the queuing and sent hooks.
+	* OctoPrint ``serial.log`` files replay "Send:" lines through the queuing and sent hooks and
+	  "Recv:" lines through the received hook.
+
+Usage:
+	python benchmarks/hook_replay.py [--storage json|journal|mmap] [--checkpoint-every N] [--output result.json] FILE...
+	python benchmarks/hook_replay.py --compare baseline.json result.json
+
+The result is JSON: lines/s, p50/p99/mean latency per hook in microseconds, checkpoint build latency on
+the calling thread, write + fsync latency from the checkpoint writer and memory figures. Memory is reported
+per hook call and per line as allocated blocks left alive (``sys.getallocatedblocks`` delta around each call)
+and bytes allocated during the call (tracemalloc peak), next to the blocks retained by the whole replay.
+After the replay a PRINT_PAUSED event is fired: "pauseFlush" reports how long the synchronous flush took
+and whether the restore file then holds the file position of the last line sent.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_Julia2018PrintRestore as plugin_module  # noqa: E402
+from octoprint.events import Events  # noqa: E402
+from octoprint.util.comm import gcode_command_for_cmd  # noqa: E402
+
+_clock = timeit.default_timer
+_SERIAL_LOG_REGEX = re.compile(r"(Send|Recv): (.*)$")
+_LINE_NUMBER_REGEX = re.compile(r"^N\d+\s+(.*?)(\*\d+)?$")
+
+
+class FakeSettings(object):
+	"""Dict backed stand-in for the plugin's settings."""
+
+	def __init__(self, defaults, basedir):
+		self._values = dict(defaults)
+		self._basedir = basedir
+
+	def get(self, path):
+		return self._values.get(path[0])
+
+	def get_boolean(self, path):
+		value = self._values.get(path[0])
+		return None if value is None else bool(value)
+
+	def get_int(self, path):
+		value = self._values.get(path[0])
+		return None if value is None else int(value)
+
+	def set(self, path, value):
+		self._values[path[0]] = value
+
+	set_boolean = set
+	set_int = set
+
+	def save(self):
+		pass
+
+	def getBaseFolder(self, name):
+		folder = os.path.join(self._basedir, name)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		return folder
+
+
+class FakePrinter(object):
+	"""Stand-in for the printer: a printing job whose file position is set by the replay."""
+
+	def __init__(self):
+		self.filepos = 0
+		self.commands_sent = 0
+		self._callbacks = []
+
+	def register_callback(self, callback, *args, **kwargs):
+		self._callbacks.append(callback)
+		callback.on_printer_send_initial_data({"temps": [self.get_current_temperatures()], "logs": [], "messages": []})
+
+	def unregister_callback(self, callback, *args, **kwargs):
+		if callback in self._callbacks:
+			self._callbacks.remove(callback)
+
+	def push_current_data(self):
+		"""Push temperatures and job data to the callbacks, as OctoPrint does at most twice a second."""
+		for callback in self._callbacks:
+			callback.on_printer_add_temperature(self.get_current_temperatures())
+			callback.on_printer_send_current_data(self.get_current_data())
+
+	def get_current_temperatures(self):
+		return {"tool0": {"actual": 210.0, "target": 210.0},
+				"tool1": {"actual": 25.0, "target": None},
+				"bed": {"actual": 60.0, "target": 60.0}}
+
+	def get_current_data(self):
+		return {"job": {"file": {"name": "replay.gcode", "path": "replay.gcode", "origin": "local"}},
+				"progress": {"filepos": self.filepos}}
+
+	def is_printing(self):
+		return True
+
+	def is_paused(self):
+		return False
+
+	def commands(self, commands, *args, **kwargs):
+		self.commands_sent += 1
+
+	def home(self, axes, *args, **kwargs):
+		pass
+
+	def select_file(self, *args, **kwargs):
+		pass
+
+
+class FakeFileManager(object):
+	def __init__(self, basedir):
+		self._basedir = basedir
+
+	def path_on_disk(self, origin, path):
+		return os.path.join(self._basedir, path)
+
+
+class FakePluginManager(object):
+	def __init__(self):
+		self.messages = 0
+
+	def send_plugin_message(self, identifier, data):
+		self.messages += 1
+
+
+def create_plugin(basedir, storage):
+	"""Build and initialize the plugin against the stand-in OctoPrint objects."""
+	plugin = plugin_module.Julia2018PrintRestore()
+	logger = logging.getLogger("octoprint.plugins.Julia2018PrintRestore.replay")
+	logger.addHandler(logging.NullHandler())
+	logger.propagate = False
+	settings = FakeSettings(plugin.get_settings_defaults(), basedir)
+	settings.set(["storage"], storage)
+	plugin._identifier = "Julia2018PrintRestore"
+	plugin._plugin_version = plugin_module.__version__
+	plugin._data_folder = os.path.join(basedir, "data")
+	plugin._logger = logger
+	plugin._settings = settings
+	plugin._printer = FakePrinter()
+	plugin._file_manager = FakeFileManager(basedir)
+	plugin._plugin_manager = FakePluginManager()
+	plugin.initialize()
+	plugin._printer.register_callback(plugin._printer_data)
+	plugin._printer.push_current_data()
+	# run the writer, but drive checkpoints from the replay instead of the scheduler
+	plugin._checkpoint_writer.start()
+	plugin.init_printer_state_monitor()
+	plugin.start_printer_state_monitor(reset=True)
+	return plugin
+
+
+def read_events(path):
+	"""Yield (kind, text, file position) for every replayable line of an input file."""
+	serial_log = path.endswith(".log")
+	with open(path, "rb") as f:
+		pos = 0
+		for raw in f:
+			pos += len(raw)
+			line = raw.decode("utf-8", "replace").rstrip("\r\n")
+			if serial_log:
+				match = _SERIAL_LOG_REGEX.search(line)
+				if match is None:
+					continue
+				kind, text = match.groups()
+				if kind == "Send":
+					numbered = _LINE_NUMBER_REGEX.match(text)
+					if numbered is not None:
+						text = numbered.group(1)
+					yield "send", text, pos
+				else:
+					yield "recv", text, pos
+			else:
+				text = line.split(";", 1)[0].strip()
+				if text:
+					yield "send", text, pos
+					yield "recv", "ok", pos
+
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies):
+	latencies.sort()
+	return {"calls": len(latencies),
+			"p50Us": percentile(latencies, 0.50) * 1e6,
+			"p99Us": percentile(latencies, 0.99) * 1e6,
+			"meanUs": (sum(latencies) / len(latencies) * 1e6) if latencies else 0.0}
+
+
+def run_events(plugin, events, checkpoint_every, timings=None):
+	"""Feed the events through the hooks, timing each call if ``timings`` is given."""
+	printer = plugin._printer
+	if timings is None:
+		timings = {}
+	queuing = timings.get("gcode_queuing_hook", [])
+	sent = timings.get("gcode_sent_hook", [])
+	received = timings.get("gcode_received_hook", [])
+	checkpoints = timings.get("write_restore_file", [])
+
+	start = _clock()
+	for index, (kind, text, pos) in enumerate(events):
+		if kind == "send":
+			gcode = gcode_command_for_cmd(text)
+			tags = {"source:file", "filepos:{}".format(pos)}
+			t0 = _clock()
+			plugin.gcode_queuing_hook(None, "queuing", text, None, gcode)
+			t1 = _clock()
+			plugin.gcode_sent_hook(None, "sent", text, None, gcode, tags=tags)
+			t2 = _clock()
+			queuing.append(t1 - t0)
+			sent.append(t2 - t1)
+			printer.filepos = pos
+		else:
+			t0 = _clock()
+			plugin.gcode_received_hook(None, text)
+			received.append(_clock() - t0)
+		if checkpoint_every and index % checkpoint_every == 0:
+			# fresh checkpoint every time, the interval is what is being simulated here
+			plugin._checkpoint_policy.reset()
+			printer.push_current_data()
+			t0 = _clock()
+			plugin.write_restore_file()
+			checkpoints.append(_clock() - t0)
+		if len(sent) > 4096 and not timings:
+			# memory pass: keep the timing lists from growing
+			del queuing[:], sent[:], received[:], checkpoints[:]
+	return _clock() - start
+
+
+def count_allocations(func, counter, tracemalloc=None):
+	"""Wrap ``func`` to add the memory blocks and traced bytes each call allocates to ``counter``.
+
+	``counter`` is a list of [calls, blocks, bytes]. Blocks are the ``sys.getallocatedblocks`` delta across the
+	call, so objects the call leaves alive; bytes are the tracemalloc peak during the call above the memory
+	traced before it, so they include what the call allocates and frees again.
+	"""
+	getblocks = sys.getallocatedblocks
+
+	def wrapper(*args, **kwargs):
+		if tracemalloc is not None:
+			tracemalloc.reset_peak()
+			traced = tracemalloc.get_traced_memory()[0]
+		before = getblocks()
+		result = func(*args, **kwargs)
+		after = getblocks()
+		counter[0] += 1
+		counter[1] += after - before
+		if tracemalloc is not None:
+			counter[2] += tracemalloc.get_traced_memory()[1] - traced
+		return result
+	return wrapper
+
+
+def measure_memory(events, storage, checkpoint_every):
+	"""Replay once more without timing to count allocations per hook call, tracemalloc would distort the latencies.
+
+	Returns None on Pythons without ``sys.getallocatedblocks`` and ``tracemalloc.reset_peak`` (before 3.9).
+	"""
+	try:
+		import tracemalloc
+	except ImportError:  # Python 2
+		return None
+	if not hasattr(tracemalloc, "reset_peak") or not hasattr(sys, "getallocatedblocks"):
+		return None
+	basedir = tempfile.mkdtemp(prefix="print_restore_replay_")
+	plugin = create_plugin(basedir, storage)
+	tracemalloc.start()
+
+	# what the wrapper itself leaves behind per call, e.g. the int holding the first block count
+	calibration = [0, 0, 0]
+	noop = count_allocations(lambda *args, **kwargs: None, calibration, tracemalloc)
+	for _ in range(1000):
+		noop(None, "sent", "G1 X1", None, "G1", tags=None)
+	overhead_blocks = float(calibration[1]) / calibration[0]
+	overhead_bytes = float(calibration[2]) / calibration[0]
+
+	counters = {}
+	for name in ("gcode_queuing_hook", "gcode_sent_hook", "gcode_received_hook"):
+		counters[name] = [0, 0, 0]
+		setattr(plugin, name, count_allocations(getattr(plugin, name), counters[name], tracemalloc))
+	blocks_before = sys.getallocatedblocks()
+	run_events(plugin, events, checkpoint_every)
+	blocks_after = sys.getallocatedblocks()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	plugin._checkpoint_writer.stop()
+	shutil.rmtree(basedir, ignore_errors=True)
+
+	hooks = {}
+	for name, (calls, blocks, size) in counters.items():
+		hooks[name] = {"calls": calls,
+					   "blocksPerCall": (blocks / float(calls) - overhead_blocks) if calls else 0.0,
+					   "bytesPerCall": (size / float(calls) - overhead_bytes) if calls else 0.0}
+	lines = len(events)
+	return {"hooks": hooks,
+			"blocksPerLine": sum(h["blocksPerCall"] * h["calls"] for h in hooks.values()) / lines if lines else 0.0,
+			"bytesPerLine": sum(h["bytesPerCall"] * h["calls"] for h in hooks.values()) / lines if lines else 0.0,
+			"retainedBlocksPerLine": float(blocks_after - blocks_before) / lines if lines else 0.0,
+			"tracemallocPeakBytes": peak}
+
+
+def pause_flush(plugin, events):
+	"""Pause after the replay and check that the restore file holds the last file position sent."""
+	sent = [pos for kind, _, pos in events if kind == "send"]
+	start = _clock()
+	plugin.on_event(Events.PRINT_PAUSED, {})
+	elapsed = _clock() - start
+	data = plugin._storage.read()
+	saved = data["filePos"] if data else None
+	return {"ms": elapsed * 1000.0,
+			"savedFilePos": saved,
+			"lastSentFilePos": sent[-1] if sent else None,
+			"upToDate": bool(sent) and saved == sent[-1]}
+
+
+def replay(paths, storage, checkpoint_every):
+	events = []
+	for path in paths:
+		events.extend(read_events(path))
+
+	basedir = tempfile.mkdtemp(prefix="print_restore_replay_")
+	plugin = create_plugin(basedir, storage)
+	timings = {"gcode_queuing_hook": [], "gcode_sent_hook": [], "gcode_received_hook": [], "write_restore_file": []}
+	elapsed = run_events(plugin, events, checkpoint_every, timings)
+	flush = pause_flush(plugin, events)
+	plugin._checkpoint_writer.stop()
+	result = {"pluginVersion": plugin_module.__version__,
+			  "python": platform.python_version(),
+			  "machine": platform.machine(),
+			  "inputs": [os.path.basename(p) for p in paths],
+			  "storage": storage,
+			  "lines": len(events),
+			  "seconds": elapsed,
+			  "linesPerSecond": len(events) / elapsed if elapsed else 0.0,
+			  "hooks": dict((name, summarize(values)) for name, values in timings.items()),
+			  "checkpointWriter": plugin._checkpoint_writer.stats(),
+			  "pauseFlush": flush,
+			  "memory": measure_memory(events, storage, checkpoint_every)}
+	shutil.rmtree(basedir, ignore_errors=True)
+	return result
+
+
+def compare(baseline_path, result_path):
+	"""Print per-hook latency ratios between two result files."""
+	with open(baseline_path) as f:
+		baseline = json.load(f)
+	with open(result_path) as f:
+		result = json.load(f)
+	print("{:24} {:>12} {:>12} {:>8}".format("metric", "baseline", "result", "ratio"))
+
+	def row(name, old, new):
+		ratio = (new / old) if old else float("nan")
+		print("{:24} {:12.3f} {:12.3f} {:8.2f}".format(name, old, new, ratio))
+
+	row("linesPerSecond", baseline["linesPerSecond"], result["linesPerSecond"])
+	for hook in sorted(result["hooks"]):
+		if hook in baseline["hooks"] and baseline["hooks"][hook]["calls"] and result["hooks"][hook]["calls"]:
+			for key in ("p50Us", "p99Us"):
+				row("{}.{}".format(hook, key), baseline["hooks"][hook][key], result["hooks"][hook][key])
+	row("fsyncLatencyAvg", baseline["checkpointWriter"]["fsyncLatencyAvg"], result["checkpointWriter"]["fsyncLatencyAvg"])
+	if baseline.get("memory") and result.get("memory") and "bytesPerLine" in baseline["memory"]:
+		for key in ("blocksPerLine", "bytesPerLine"):
+			row(key, baseline["memory"][key], result["memory"][key])
+	if "pauseFlush" in baseline and "pauseFlush" in result:
+		row("pauseFlushMs", baseline["pauseFlush"]["ms"], result["pauseFlush"]["ms"])
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay G-code and serial logs through the print restore hooks")
+	parser.add_argument("files", nargs="*", help="G-code files (*.gcode) or OctoPrint serial logs (*.log)")
+	parser.add_argument("--storage", default="json", choices=("json", "journal", "mmap"))
+	parser.add_argument("--checkpoint-every", type=int, default=1000, help="Lines between checkpoints, 0 disables them")
+	parser.add_argument("--output", help="Write the JSON result to this file instead of stdout")
+	parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULT"), help="Compare two result files")
+	args = parser.parse_args()
+
+	if args.compare:
+		compare(*args.compare)
+		return
+	if not args.files:
+		parser.error("no input files")
+
+	result = replay(args.files, args.storage, args.checkpoint_every)
+	text = json.dumps(result, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(text)
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,124 @@
+# coding=utf-8
+"""Stress test: torn printer state snapshots under concurrent load.
+
+A sending thread applies moves to a PrinterState and pushes them to an AckWindow, like the G-code sent hook
+on OctoPrint's comm thread. Move N sets X, Y, Z, E and F all to N and is tagged with file position N, so any
+snapshot whose values differ, or whose acknowledged file position differs from them, is torn. A receiving
+thread acknowledges the pushed moves like the "ok" handler, and reader threads take snapshots like the
+checkpoint timer, as fast as they can.
+
+Three readers are compared:
+
+	* ``read_snapshot``: the seqlock read of PrinterState used by the checkpoint writer, must never be torn;
+	* ``acknowledged``: the lock-free read of the AckWindow, must never be torn;
+	* ``field_by_field``: copies the fields one at a time without any protection, like the checkpoint
+	  timer used to read the position dict key by key. Shows that the test does catch torn reads.
+
+The thread switch interval is lowered to force interleavings.
+
+Usage: python benchmarks/stress_snapshots.py [--seconds N] [--readers N] [--switch-interval S]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import sys
+import threading
+import timeit
+
+from _loader import load
+
+state_module = load("state")
+AckWindow = load("ack_window").AckWindow
+
+_clock = timeit.default_timer
+_AXES = (state_module.X, state_module.Y, state_module.Z, state_module.E, state_module.F)
+
+
+def torn(snapshot, offset=None):
+	"""Check the invariant of the moves written by :func:`sender`."""
+	values = set(snapshot[index] for index in _AXES)
+	if offset is not None:
+		values.add(offset)
+	return len(values) > 1
+
+
+class Counters(object):
+
+	def __init__(self):
+		self.reads = 0
+		self.torn = 0
+
+
+def sender(state, window, stop, stats):
+	n = 0
+	while not stop.is_set():
+		n += 1
+		state.apply("G1", "G1 X{0} Y{0} Z{0} E{0} F{0}".format(n))
+		window.push({"source:file", "filepos:{}".format(n)}, state)
+	stats["moves"] = n
+
+
+def receiver(window, stop):
+	while not stop.is_set():
+		if len(window):
+			window.ack()
+
+
+def reader(read, counters, stop):
+	while not stop.is_set():
+		counters.reads += 1
+		if read():
+			counters.torn += 1
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Check printer state snapshots for torn reads")
+	parser.add_argument("--seconds", type=float, default=5.0)
+	parser.add_argument("--readers", type=int, default=2, help="Threads per reader kind")
+	parser.add_argument("--switch-interval", type=float, default=1e-6, help="sys.setswitchinterval value")
+	args = parser.parse_args()
+
+	if hasattr(sys, "setswitchinterval"):
+		sys.setswitchinterval(args.switch_interval)
+
+	state = state_module.PrinterState()
+	window = AckWindow()
+	stop = threading.Event()
+	stats = {}
+
+	def acknowledged():
+		entry = window.acknowledged()
+		return entry is not None and torn(entry[1], entry[0])
+
+	readers = (("read_snapshot", lambda: torn(state.read_snapshot())),
+			   ("acknowledged", acknowledged),
+			   ("field_by_field", lambda: torn(tuple(getattr(state, name) for name in state_module.FIELDS))))
+	counters = dict((name, Counters()) for name, _ in readers)
+
+	threads = [threading.Thread(target=sender, args=(state, window, stop, stats)),
+			   threading.Thread(target=receiver, args=(window, stop))]
+	for name, read in readers:
+		for _ in range(args.readers):
+			threads.append(threading.Thread(target=reader, args=(read, counters[name], stop)))
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	start = _clock()
+	stop.wait(args.seconds)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	elapsed = _clock() - start
+
+	print("moves sent: {} ({:.0f}/s), window overflows: {}".format(
+		stats["moves"], stats["moves"] / elapsed, window.overflows))
+	for name, _ in readers:
+		print("{:15} reads {:9d} torn {:7d}".format(name, counters[name].reads, counters[name].torn))
+
+	failed = counters["read_snapshot"].torn or counters["acknowledged"].torn
+	print("FAILED" if failed else "ok: no torn snapshot from the protected readers")
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
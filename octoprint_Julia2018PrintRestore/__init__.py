@@ -7,53 +7,39 @@ from flask import jsonify, make_response, request
 from octoprint.util.comm import parse_firmware_line
 # from octoprint.settings import settings
 # import time
-from threading import Timer
 import json
 import os
-import re
+import signal
+import threading
 import logging
-
+import logging.handlers
+
+from .ack_window import AckWindow
+from .checkpoint import CheckpointPolicy
+from .config import load_config
+from .firmware import firmware_supports_babystep, is_frequent_line
+from .gcode_index import LayerIndexCache, LayerIndexer, default_index_processes, reconstruct_state
+from .printer_data import PrinterDataCache
+from .restore_planner import CALL, COMMANDS, POSITIONING, PREPARING, RESUMING, RestoreError, RestoreRunner, Step, estimate_heat_up
+from .restore_planner import heater_targets, plan_heat_up, preheat_targets, progress_to_dict, set_temperature_command
+from .scheduler import Scheduler
+from .state import PrinterState, BABYSTEP, TOOL0_TARGET, TOOL1_TARGET, BED_TARGET, position_from_snapshot, snapshot_from_position
+from .storage import open_restore_storage
+from .thermal_model import ThermalModel
+from .util import monotonic
+from .writer import CheckpointWriter
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-
-class RepeatedTimer(object):
-	"""Wrapper for a Timer object that repeatatively calls a function after an interval.
-
-	Args:
-		interval (int): Delay interval in seconds
-		function (object): The "function" to repeat
-		*args: Variable arguments for the "function"
-		**kwargs: Keyword arguments for the "function"
-	"""
-
-	def __init__(self, interval, function, *args, **kwargs):
-		self._timer = None
-		self.interval = interval
-		self.function = function
-		self.args = args
-		self.kwargs = kwargs
-		self.is_running = False
-
-	def _run(self):
-		"""Helper to call the "function" and set the timer again"""
-		self.is_running = False
-		self.start()
-		self.function(*self.args, **self.kwargs)
-
-	def start(self):
-		"""Sets the Timer to call the helper"""
-		if not self.is_running:
-			self._timer = Timer(self.interval, self._run)
-			self._timer.start()
-			self.is_running = True
-
-	def stop(self):
-		"""Stop the timer"""
-		if self.is_running:
-			self._timer.cancel()
-			self.is_running = False
+# Seconds a flush on pause, failure, disconnect or shutdown waits for the restore file to be on disk
+FLUSH_TIMEOUT = 2.0
+# Preheat timeout used when the setting is 0
+DEFAULT_PREHEAT_TIMEOUT = 600
+# Seconds between saves of the learned thermal model, it is only written when it changed
+THERMAL_MODEL_SAVE_INTERVAL = 60
+# Position keys a restore needs. Without E, G92 would reset the extruder and an absolute E move would extrude a blob.
+RESUME_POSITION_KEYS = ("X", "Y", "Z", "E", "F")
 
 
 class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
@@ -61,29 +47,74 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 							octoprint.plugin.SettingsPlugin,
 							octoprint.plugin.AssetPlugin,
 							octoprint.plugin.TemplatePlugin,
-							octoprint.plugin.BlueprintPlugin):
+							octoprint.plugin.BlueprintPlugin,
+							octoprint.plugin.ShutdownPlugin):
 	"""OctoPrint print restore plugin for Fracktal Works 3D printers."""
 
 	# region "Plugin settings"
+	def reload_config(self):
+		"""Rebuild the in-memory settings snapshot after the settings changed."""
+		self._config = load_config(self._settings)
+
 	@property
 	def enabled(self):
 		"""(bool) Get print restore enabled state plugin setting."""
-		return self._settings.get_boolean(["enabled"])
+		return self._config.enabled
 
 	@property
 	def autoRestore(self):
 		"""(bool) Get auto print restore enabled state plugin setting."""
-		return self._settings.get_boolean(["autoRestore"])
+		return self._config.autoRestore
 
 	@property
 	def interval(self):
 		"""(int) Get printer state monitor interval plugin setting."""
-		return self._settings.get_int(["interval"])
+		return self._config.interval
 
 	@property
 	def enableBabystep(self):
 		"""(bool) Get babystep monitor enabled state plugin setting."""
-		return self._settings.get_boolean(["enableBabystep"])
+		return self._config.enableBabystep
+
+	@property
+	def storage(self):
+		"""(str) Get restore file storage backend plugin setting, "json", "journal" or "mmap"."""
+		return self._config.storage
+
+	@property
+	def checkpointFilePosDelta(self):
+		"""(int) Get job file advance in bytes that triggers a checkpoint plugin setting."""
+		return self._config.checkpointFilePosDelta
+
+	@property
+	def checkpointMaxAge(self):
+		"""(int) Get maximum age in seconds of the saved checkpoint plugin setting."""
+		return self._config.checkpointMaxAge
+
+	@property
+	def buildLayerIndex(self):
+		"""(bool) Get index layers of uploaded and printed files plugin setting."""
+		return self._config.buildLayerIndex
+
+	@property
+	def indexProcesses(self):
+		"""(int) Get worker processes for layer indexing plugin setting, 0 picks a number for the CPU."""
+		return self._config.indexProcesses
+
+	@property
+	def resumeAt(self):
+		"""(str) Get restore resume point plugin setting, "filePos", "currentLayer" or "previousLayer"."""
+		return self._config.resumeAt
+
+	@property
+	def speculativePreheat(self):
+		"""(bool) Get preheat while a restore waits for confirmation plugin setting."""
+		return self._config.speculativePreheat
+
+	@property
+	def preheatTimeout(self):
+		"""(int) Get seconds to wait for a restore confirmation before cooling down plugin setting."""
+		return self._config.preheatTimeout
 	# endregion
 
 	# region "IPC"
@@ -102,24 +133,60 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 
 	# region "Printer state monitor"
 	def init_printer_state_monitor(self):
-		"""Initialize printer state monitor."""
+		"""Initialize printer state monitor, or apply a changed interval to it."""
 		if self._timer_printer_state_monitor is None:
-			self._timer_printer_state_monitor = RepeatedTimer(self.interval, self.write_restore_file)
+			self._timer_printer_state_monitor = self._scheduler.add_job(self.interval or 1, self.write_restore_file)
+		else:
+			self._timer_printer_state_monitor.interval = self.interval or 1
+
+	def start_printer_state_monitor(self, reset=False, state=None):
+		"""Start monitoring and saving printer state.
 
-	def start_printer_state_monitor(self):
-		"""Start monitoring and saving printer state."""
+		The tracked state carries on from where the monitor was stopped, e.g. on resume after a pause, so the
+		first checkpoint is written on the next tick. The checkpoint policy is reset to make it due.
+
+		Args:
+			reset (bool, optional): Forget the tracked state, for a new print or when commands were sent
+				without being tracked.
+			state (PrinterState, optional): Track on from this state instead, e.g. the one a restore moved the
+				printer to. Implies reset.
+		"""
 		self._logger.info("Printer state monitor started")
+		if reset or state is not None:
+			# swap in a new state rather than resetting it from this thread, the comm thread is its only writer
+			if state is None:
+				state = PrinterState()
+				state.babystep = self.state.babystep
+			self.state = state
+			self._ack_window.reset()
+		else:
+			# entries pending since the pause were acknowledged meanwhile, or will never be
+			self._ack_window.clear_pending()
 		self.flag_is_saving_state = True
-		self.flag_restore_file_write_in_progress = False
-		self.state_position = {}
+		self._checkpoint_policy.reset()
 		self._timer_printer_state_monitor.start()
 
-	def stop_printer_state_monitor(self):
-		"""Stop monitoring and saving printer state."""
+	def stop_printer_state_monitor(self, flush_reason=None):
+		"""Stop monitoring and saving printer state.
+
+		Args:
+			flush_reason (str, optional): If given and the monitor was running, the current state is written to
+				the restore file right away instead of waiting for the next checkpoint.
+		"""
+		was_saving = self.flag_is_saving_state
 		self.flag_is_saving_state = False
 		self._logger.info("Printer state monitor stopped")
 		self._timer_printer_state_monitor.stop()
 		# self._timer_printer_state_monitor = None
+		if flush_reason is not None and was_saving:
+			self.flush_restore_file(flush_reason)
+
+	def open_storage(self):
+		"""Open the restore storage backend selected in the settings, taking over the checkpoint of another backend"""
+		self._storage, migrated = open_restore_storage(self.storage, self.__RESTORE_FILE)
+		if migrated is not None:
+			self._logger.info("Restore checkpoint migrated from " + migrated)
+		self._logger.info("Path of restore file: " + self._storage.path)
 
 	def check_restore_file_exists(self):
 		"""Check if restore file exists
@@ -127,41 +194,134 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 		Returns:
 			bool: True if restore file exists
 		"""
-		if os.path.isfile(self.__RESTORE_FILE):
-			return True
+		return self._storage.exists()
+
+	def request_layer_index(self, origin, path):
+		"""Queue a G-code file for layer indexing in the background.
+
+		Args:
+			origin (str): File origin, only "local" files are indexed.
+			path (str): Path of the file relative to its origin.
+		"""
+		if not self.buildLayerIndex or origin != "local" or not path:
+			return
+		try:
+			self._layer_indexer.request(self._file_manager.path_on_disk("local", path))
+		except Exception as e:
+			self._logger.error("Could not queue layer index of {}\n{}".format(path, str(e)))
+
+	def build_restore_data(self):
+		"""Collect the restore data of the current printer state.
+
+		Returns:
+			dict: Restore data, None if there is no job file position to save yet.
+		"""
+		acknowledged = self._ack_window.acknowledged()
+		if acknowledged is not None:
+			filepos, state = acknowledged
 		else:
-			return False
+			# nothing acknowledged yet, or job lines are not tagged with their file position
+			filepos, state = None, self.state.read_snapshot()
+		# pushed by OctoPrint, reading it takes none of the printer's locks
+		printer_data = self._printer_data
+		job = printer_data.job
+		if job is None:
+			return None
+		if filepos is None:
+			filepos = job[2]
+		if filepos is None:  # prevents saving when file is garbage
+			return None
+
+		data = {"fileName": job[0],
+				"filePos": filepos,
+				"path": job[1],
+				"tool0Target": printer_data.target("tool0"),
+				"bedTarget": printer_data.target("bed"),
+				"position": position_from_snapshot(state),
+				"babystep": state[BABYSTEP] if self.enableBabystep else 0
+				}
+		tool1_target = printer_data.target("tool1")
+		if tool1_target is not None:
+			data["tool1Target"] = tool1_target
+		return data
 
 	def write_restore_file(self):
-		"""Write and commit restore file to disk"""
-		if self.flag_restore_in_progress or self.flag_restore_file_write_in_progress:
+		"""Hand the current printer state to the checkpoint writer if a checkpoint is due"""
+		if self.flag_restore_in_progress:
 			return
 		try:
-			temps = self._printer.get_current_temperatures()
-			file = self._printer.get_current_data()
-			data = {"fileName": file["job"]["file"]["name"],
-					"filePos": file["progress"]["filepos"],
-					"path": file["job"]["file"]["path"],
-					"tool0Target": temps["tool0"]["target"],
-					"bedTarget": temps["bed"]["target"],
-					"position": self.state_position,
-					"babystep": self.state_babystep if self.enableBabystep else 0
-					}
-			if "tool1" in temps.keys():
-				if temps["tool1"]["target"] is not None:
-					data["tool1Target"] = temps["tool1"]["target"]
-
-			if data["filePos"] is None or "Z" not in data["position"].keys():  # prevents saving when file is garbage
+			data = self.build_restore_data()
+			if data is None:
+				return
+			now = monotonic()
+			if not self._checkpoint_policy.due(data, now):
 				return
 
-			self.flag_restore_file_write_in_progress = True
-			with open(self.__TEMP_RESTORE_FILE, 'w') as restoreFile:
-				json.dump(data, restoreFile)
-				os.fsync(restoreFile)
-			os.rename(self.__TEMP_RESTORE_FILE, self.__RESTORE_FILE)
-			self.flag_restore_file_write_in_progress = False
+			self._checkpoint_policy.commit(data, now)
+			self._checkpoint_writer.submit(data)
+		except Exception as e:
+			self._logger.error("Could not create restore checkpoint\n" + str(e))
+
+	def flush_restore_file(self, reason, timeout=FLUSH_TIMEOUT):
+		"""Write the current printer state now and wait until it is on disk.
+
+		Used when the print stops or OctoPrint goes down, so the progress made since the last periodic
+		checkpoint is not lost. Waits at most ``timeout`` seconds, a slow disk never holds up shutdown.
+
+		Args:
+			reason (str): What triggered the flush, for the log.
+			timeout (float, optional): Seconds to wait for the write at most.
+
+		Returns:
+			bool: True if the newest state is on disk.
+		"""
+		if self.flag_restore_in_progress:
+			return False
+		deadline = monotonic() + timeout
+		try:
+			data = self.build_restore_data()
+			if data is not None and self._checkpoint_policy.changed(data):
+				self._checkpoint_policy.commit(data, monotonic())
+				self._checkpoint_writer.submit(data)
 		except Exception as e:
-			self._logger.error("Could not write to restore file\n" + str(e))
+			self._logger.error("Could not create restore checkpoint\n" + str(e))
+		flushed = self._checkpoint_writer.flush(max(0.0, deadline - monotonic()))
+		if flushed:
+			self._logger.info("Restore file flushed on {}".format(reason))
+		else:
+			self._logger.warning("Restore file not flushed within {}s on {}".format(timeout, reason))
+		return flushed
+
+	def install_signal_handlers(self):
+		"""Flush the restore file on SIGPWR before the previous handler runs.
+
+		SIGPWR is sent by UPS daemons when the power is failing. SIGTERM needs no handler, OctoPrint's own
+		handler exits through its shutdown path, which calls :meth:`on_shutdown`. Must be called from the
+		main thread, see :meth:`on_startup`.
+		"""
+		signum = getattr(signal, "SIGPWR", None)
+		if signum is None:
+			return
+		try:
+			signal.signal(signum, self._create_signal_handler("SIGPWR", signal.getsignal(signum)))
+		except (ValueError, OSError) as e:
+			self._logger.warning("Could not install SIGPWR handler: {}".format(str(e)))
+
+	def _create_signal_handler(self, name, previous):
+		def handler(signum, frame):
+			if self.flag_is_saving_state:
+				self.flush_restore_file(name)
+			if callable(previous):
+				previous(signum, frame)
+			elif previous == signal.SIG_DFL:
+				# let the default action (terminate) happen, now that the state is on disk
+				signal.signal(signum, signal.SIG_DFL)
+				os.kill(os.getpid(), signum)
+		return handler
+
+	def on_checkpoint_write_failed(self, data):
+		"""Called by the checkpoint writer when a write failed. Makes the next checkpoint due right away."""
+		self._checkpoint_policy.reset()
 
 	def parse_restore_file(self, log=False):
 		"""Read and parse restore file data
@@ -172,27 +332,24 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 		"""
 		if self.check_restore_file_exists():
 			try:
-				with open(self.__RESTORE_FILE) as f:
-					txt = f.read()
-					txt = txt.encode('ascii', 'ignore')
-					txt = txt.decode()
-					#txt = "".join(c for c in txt if 31 < ord(c) < 127)
-					try:
-						data = json.loads(txt)
-						if log:
-							self._logger.info("Print restore data:\n" + json.dumps(data))
-						return (True, data)
-					except Exception as e:
-						self._logger.error("Invalid JSON data in restore file: {}\n{}".format(txt, str(e)))
+				data = self._storage.read()
+				if data is not None:
+					if log:
+						self._logger.info("Print restore data:\n" + json.dumps(data))
+					return (True, data)
+				self._logger.error("No valid checkpoint in restore file")
+			except ValueError as e:
+				self._logger.error(str(e))
 			except Exception as e:
 				self._logger.error("Could not open restore file\n" + str(e))
 		return (False, None)
 
 	def delete_restore_file(self):
 		"""Delete the print restore file from disk"""
+		self._checkpoint_writer.discard()
 		if self.check_restore_file_exists():
 			try:
-				os.remove(self.__RESTORE_FILE)
+				self._storage.delete()
 				self._logger.info("Restore progress file was deleted")
 			except:
 				self._logger.info("Error deleting restore file")
@@ -206,18 +363,20 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 		Returns:
 			str: Modified or untouched line
 		"""
+		if self.flag_firmware_detected or is_frequent_line(line):
+			return line
 		if "FIRMWARE_NAME" in line:
 			# self._logger.info("FIRMWARE_NAME line: {}".format(line))
 			# Create a dict with all the keys/values returned by the M115 request
 			data = parse_firmware_line(line)
+			# detection result holds until the printer disconnects
+			self.flag_firmware_detected = True
 
-			regex = r"Marlin J18([A-Z]{2})_([0-9]{6}_[0-9]{4})_HA"
-			matches = re.search(regex, data['FIRMWARE_NAME'])
-
-			enable_babystep = matches and len(matches.groups()) == 2 and matches.group(1) in ["PT", "PE"]
+			enable_babystep = firmware_supports_babystep(data.get("FIRMWARE_NAME", ""))
 			if self.enableBabystep != enable_babystep:
 				self._settings.set_boolean(["enableBabystep"], enable_babystep)
 				self._settings.save()
+				self.reload_config()
 		return line
 
 	def record_current_state(self, gcode, cmd):
@@ -232,130 +391,327 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 
 		if self.flag_is_saving_state:
 			try:
-				if gcode == "G1" or gcode == "G0":
-					if "X" in cmd:
-						self.state_position["X"] = cmd[cmd.index('X') + 1:].split(' ', 1)[0]
-					if "Y" in cmd:
-						self.state_position["Y"] = cmd[cmd.index('Y') + 1:].split(' ', 1)[0]
-					if "Z" in cmd:
-						self.state_position["Z"] = cmd[cmd.index('Z') + 1:].split(' ', 1)[0]
-					if "E" in cmd:
-						self.state_position["E"] = cmd[cmd.index('E') + 1:].split(' ', 1)[0]
-					if "F" in cmd:
-						self.state_position["F"] = cmd[cmd.index('F') + 1:].split(' ', 1)[0]
-				elif gcode == "M106":
-					if "S" in cmd:
-						self.
-                        state_position["FAN"] = cmd[cmd.index('S') + 1:].split(' ', 1)[0]
-				elif gcode == "M107":
-					if "S" in cmd:
-						self.state_position["FAN"] = 0
-				elif gcode == "M290":
-					if "Z" in cmd:
-						val = cmd[cmd.index('Z') + 1:].split(' ', 1)[0]
-						try:
-							self.state_babystep = self.state_babystep + float(val)
-						except Exception as e:
-							self._logger.error("Could not parse babystep: " + str(e))
+				self.state.apply(gcode, cmd)
+			except ValueError as e:
+				self._logger.error("Rejected printer state from \"{}\": {}".format(cmd, str(e)))
 			except:
 				self._logger.info("Error getting latest command sent to printer")
 	# endregion
 
 	# region "Print Restore"
+	def complete_restore_data(self, data):
+		"""Fill in restore data missing from a checkpoint by replaying the G-code file up to the saved file position.
+
+		A checkpoint saved before the first Z move, or one holding only the file and file position, has no usable
+		position. The state is then reconstructed from the file, starting at the nearest indexed layer if there is one.
+
+		Args:
+			data (dict): Restore data.
+
+		Returns:
+			dict: Restore data with a complete position and temperature targets.
+
+		Raises:
+			ValueError: If the file does not give a position before the saved file position.
+		"""
+		position = data.get("position") or {}
+		if all(key in position for key in RESUME_POSITION_KEYS):
+			return data
+
+		path = self._file_manager.path_on_disk("local", data.get("path") or data["fileName"])
+		start = monotonic()
+		snapshot = reconstruct_state(path, int(data["filePos"]), self._layer_indexer.get(path)).snapshot()
+		self._logger.info("Reconstructed printer state at {} of {} in {:.3f}s".format(data["filePos"], path, monotonic() - start))
+
+		data = dict(data)
+		data["position"] = position_from_snapshot(snapshot)
+		if not all(key in data["position"] for key in RESUME_POSITION_KEYS):
+			raise ValueError("No complete position in {} before file position {}".format(path, data["filePos"]))
+		for key, index in (("tool0Target", TOOL0_TARGET), ("tool1Target", TOOL1_TARGET), ("bedTarget", BED_TARGET)):
+			if data.get(key) is None and snapshot[index] is not None:
+				data[key] = snapshot[index]
+		if data.get("bedTarget") is None:
+			data["bedTarget"] = 0
+		return data
+
+	def select_resume_point(self, data):
+		"""Move the restore point back to a layer start, depending on the resumeAt setting.
+
+		The saved file position can be in the middle of a layer and ahead of what the firmware executed.
+		Resuming at the start of the current layer, or of the previous one, reprints from a clean boundary
+		with the machine state recorded in the layer index.
+
+		Args:
+			data (dict): Restore data.
+
+		Returns:
+			dict: Restore data with file position, position and temperature targets of the layer start,
+			or unchanged if resuming at the saved file position or there is no layer index.
+		"""
+		if self.resumeAt not in ("currentLayer", "previousLayer"):
+			return data
+		path = self._file_manager.path_on_disk("local", data.get("path") or data["fileName"])
+		index = self._layer_indexer.get(path)
+		entry = None
+		if index is not None:
+			entry = index.nearest(int(data["filePos"]), back=1 if self.resumeAt == "previousLayer" else 0)
+		if entry is None:
+			self._logger.warning("No layer start found before file position {} of {}, resuming there".format(data["filePos"], path))
+			return data
+
+		offset, layer, snapshot = entry
+		position = position_from_snapshot(snapshot)
+		if not all(key in position for key in RESUME_POSITION_KEYS):
+			self._logger.warning("Incomplete position at start of layer {} of {}, resuming at file position {}".format(layer, path, data["filePos"]))
+			return data
+
+		self._logger.info("Resuming at start of layer {} at file position {} instead of {}".format(layer, offset, data["filePos"]))
+		data = dict(data)
+		data["filePos"] = offset
+		data["position"] = position
+		for key, field in (("tool0Target", TOOL0_TARGET), ("tool1Target", TOOL1_TARGET), ("bedTarget", BED_TARGET)):
+			if snapshot[field] is not None:
+				data[key] = snapshot[field]
+		return data
+
 	def start_restore(self):
 		"""Try to restore the failed print.
 		Initialize printer temperatures and position to last known state.
 
+		Only the restore file is read on the calling thread. Completing the restore data, planning the steps,
+		heating, homing and resuming the job run as a job on the restore runner's thread, see
+		:mod:`restore_planner`. The job's progress is sent as RESTORE_PROGRESS status messages and
+		can be polled from /restoreProgress.
+
+		Returns:
+			tuple: (status, result) status is True and result the restore job id if the restore was started,
+			False and result the error otherwise.
+		"""
+		restore_state = self.parse_restore_file()
+		if not restore_state[0]:
+			return (False, "Did not load data")
+		data = restore_state[1]
+		file_name = data.get("fileName")
+		if file_name is None or file_name == "None":
+			self._logger.error("Did not find print job filename in restore file\n" + json.dumps(data))
+			return (False, "Gcode file name is none")
+
+		targets = {}
+
+		def plan():
+			restore_data = self.select_resume_point(self.complete_restore_data(data))
+			targets.update(heater_targets(restore_data))
+			return ([Step(COMMANDS, ["M117 RESTORE_STARTED"], "restore started", PREPARING)] +
+					plan_heat_up(targets) +
+					[Step(COMMANDS, self.resume_commands(restore_data), "move to the saved position", POSITIONING),
+					 Step(CALL, lambda: self.resume_job(restore_data), "resume the job", RESUMING)])
+
+		try:
+			job_id = self._restore_runner.start(plan, file_name=file_name,
+												on_error=lambda e: self.on_restore_failed(file_name, targets, e),
+												on_progress=self.on_restore_progress)
+		except RestoreError:
+			return (False, "Restore already in progress")
+		self._logger.info("Restore job {} started for {}".format(job_id, file_name))
+		return (True, job_id)
+
+	def resume_commands(self, data):
+		"""Build the commands moving the homed and heated printer to the saved position and restoring its modal state.
+
+		Args:
+			data (dict): Restore data with a complete position.
+
 		Returns:
-			tuple: (status, error) status is True if printer was initialized to last known state, False and error is not None otherwise.
+			list: G-code commands.
 		"""
+		commands = ["G1 X10 Y10 F2000"]
+		# self._printer.commands("G1 X0 Y0 Z10 F9000")
+		if "T" not in data["position"].keys():
+			data["position"]["T"] = 0
+
+		if "FAN" in data["position"].keys():
+			if float(data["position"]["FAN"]) > 0:
+				commands.append("M106 S{}".format(float(data["position"]["FAN"])))
+
+		position = data["position"]
+		commands += ["M420 S1",
+					 "G90",
+					 "G1 Z{} F4000".format(float(position["Z"])),
+					 "T{}".format(int(position["T"])),
+					 "G92 E0",
+					 "G1 F200 E3",
+					 "G92 E{}".format(float(position["E"])),
+					 "G1 X{} Y{} F3000".format(float(position["X"]), float(position["Y"])),
+					 "G1 F{}".format(float(position["F"]))
+					 ]
+		# machine coordinates were restored above, re-apply the G92 shift and the modal state of the job
+		offsets = [(axis, float(position.get("OFFSET_" + axis, 0))) for axis in ("X", "Y", "Z")]
+		if any(offset != 0 for axis, offset in offsets):
+			commands.append("G92 " + " ".join("{}{}".format(axis, float(position[axis]) - offset)
+											  for axis, offset in offsets))
+		if float(position.get("UNITS", 1)) != 1:
+			commands.append("G20")
+		if position.get("RELATIVE", False):
+			commands.append("G91")
+			if not position.get("RELATIVE_E", True):
+				commands.append("M82")
+		elif position.get("RELATIVE_E", False):
+			commands.append("M83")
+		if float(data["position"].get("FEED", 100)) != 100:
+			commands.append("M220 S{}".format(float(data["position"]["FEED"])))
+		if float(data["position"].get("FLOW", 100)) != 100:
+			commands.append("M221 S{}".format(float(data["position"]["FLOW"])))
+
+		if "babystep" in data.keys():
+			if float(data["babystep"]) != 0:
+				commands.append("M290 Z{}".format(float(data["babystep"])))
+		return commands
+
+	def restored_state(self, data):
+		"""Build the printer state a restore leaves the printer in, once :meth:`resume_commands` were sent.
+
+		Args:
+			data (dict): Restore data with a complete position.
+
+		Returns:
+			PrinterState: The state.
+		"""
+		state = PrinterState()
+		state.restore(snapshot_from_position(data["position"], data.get("babystep") or 0))
+		for key, name in (("tool0Target", "tool0_target"), ("tool1Target", "tool1_target"), ("bedTarget", "bed_target")):
+			if data.get(key) is not None:
+				setattr(state, name, float(data[key]))
+		return state
+
+	def resume_job(self, data):
+		"""Last restore step: continue the job file from the saved file position.
+
+		The PRINT_STARTED event of the resumed job picks up the restored state instead of starting from a fresh one.
+		"""
+		self._restored_state = self.restored_state(data)
+		self._printer.select_file(path=self._file_manager.path_on_disk("local", data["fileName"]),
+								  sd=False, printAfterSelect=True, pos=int(data["filePos"]))
+
+		self._printer.commands("M117 RESTORE_COMPLETE")
+
+		self._send_status(status_type="PRINT_RESURRECTION_STARTED", status_value=data["fileName"],
+						  status_description="Print resurrection started")
+
+	def on_restore_failed(self, file_name, targets, error):
+		"""Called by the restore runner when planning or a step failed.
+
+		Turns the heaters of the restore off again, and any other heater with a target, which the restore
+		may have taken over from a preheat before it failed.
+		"""
+		self._restored_state = None
+		heaters = set(targets)
+		heaters.update(heater for heater, (_, target) in self._printer_data.temperatures.items()
+					   if target and (heater == "bed" or heater.startswith("tool")))
+		self._printer.commands([set_temperature_command(heater, 0) for heater in sorted(heaters)] +
+							   ["M117 RESTORE_FAILED"])
+		self.flag_restore_in_progress = False
+		self._send_status(status_type="PRINT_RESURRECTION_FAILED", status_value=file_name,
+						  status_description=str(error))
+
+	def on_restore_progress(self, progress):
+		"""Called by the restore runner when the restore job moves to another step. Pushes the progress to clients."""
+		self._send_status(status_type="RESTORE_PROGRESS", status_value=progress_to_dict(progress),
+						  status_description=progress.error or progress.step or progress.state)
+
+	def start_preheat(self):
+		"""Start heating for the pending restore before it is confirmed, see :func:`restore_planner.preheat_targets`.
+
+		The heaters are turned off again if the restore is neither confirmed nor discarded within the
+		preheatTimeout setting.
+		"""
+		if self._printer.is_printing() or self._printer.is_paused():
+			return
+		restore_state = self.parse_restore_file()
+		if not restore_state[0]:
+			return
 		try:
-			restore_state = self.parse_restore_file()
-			if not restore_state[0]:
-				raise Exception("Did not load data")
-
-			data = restore_state[1]
-
-			if data["fileName"] != "None":   # file name is not none
-				self._printer.commands("M117 RESTORE_STARTED")
-
-				#start heating to prepare for initial move
-
-				if float(data["bedTarget"]) > 0:
-					self._printer.commands("M140 S{}".format(float(data["bedTarget"])))
-				if "tool0Target" in data.keys():
-					if float(data["tool0Target"]) > 0:
-						self._printer.commands("M104 T0 S140".format(float(data["tool0Target"])))
-				if "tool1Target" in data.keys():
-					if float(data["tool1Target"]) > 0:
-						self._printer.commands("M104 T1 S140".format(float(data["tool1Target"])))
-				if "tool0Target" in data.keys():
-					if float(data["tool0Target"]) > 0:
-						self._printer.commands("M109 T0 S140") #just enough heat to remove nozzle without disloging print
-				if "tool1Target" in data.keys():
-					if float(data["tool1Target"]) > 0:
-						self._printer.commands("M109 T1 S140")  #just enough heat to remove nozzle without disloging print
-				# Move the print head
-				self._printer.commands("T0")
-				self._printer.home("z")
-				self._printer.home(["x", "y"])
-
-				#Set to actual heating temperatures
-
-				if "tool0Target" in data.keys():
-					if float(data["tool0Target"]) > 0:
-						self._printer.commands("M104 T0 S{}".format(float(data["tool0Target"])))
-				if "tool1Target" in data.keys():
-					if float(data["tool1Target"] )> 0:
-						self._printer.commands("M104 T1 S{}".format(float(data["tool1Target"])))
-				if float(data["bedTarget"]) > 0:
-					self._printer.commands("M190 S{}".format(float(data["bedTarget"])))
-				if "tool0Target" in data.keys():
-					if float(data["tool0Target"]) > 0:
-						self._printer.commands("M109 T0 S{}".format(float(data["tool0Target"])))
-				if "tool1Target" in data.keys():
-					if float(data["tool1Target"]) > 0:
-						self._printer.commands("M109 T1 S{}".format(float(data["tool1Target"])))
-
-				self._printer.commands("G1 X10 Y10 F2000")
-				# self._printer.commands("G1 X0 Y0 Z10 F9000")
-				if "T" not in data["position"].keys():
-					data["position"]["T"] = 0
-
-				if "FAN" in data["position"].keys():
-					if float(data["position"]["FAN"]) > 0:
-						self._printer.commands("M106 S{}".format(float(data["position"]["FAN"])))
-
-				commands = ["M420 S1",
-							"G90",
-							"G1 Z{} F4000".format(float(data["position"]["Z"])),
-							"T{}".format(float(data["position"]["T"])),
-							"G92 E0",
-							"G1 F200 E3",
-							"G92 E{}".format(float(data["position"]["E"])),
-							"G1 X{} Y{} F3000".format(float(data["position"]["X"]), float(data["position"]["Y"])),
-							"G1 F{}".format(float(data["position"]["F"]))
-							]
-				self._printer.commands(commands)
-
-				if "babystep" in data.keys():
-					if float(data["babystep"]) != 0:
-						self._printer.commands("M290 Z{}".format(float(data["babystep"])))
-
-				self._printer.select_file(path=self._file_manager.path_on_disk("local", data["fileName"]),
-										  sd=False, printAfterSelect=True, pos=int(data["filePos"]))
-
-				self._printer.commands("M117 RESTORE_COMPLETE")
-
-				self._send_status(status_type="PRINT_RESURRECTION_STARTED", status_value=data["fileName"],
-								  status_description="Print resurrection started")
-				return (True, None)
-			else:    # file name is None
-				self._logger.error("Did not find print job filename in restore file\n" + json.dumps(data))
-				return (False, "Gcode file name is none")
+			holds = preheat_targets(heater_targets(restore_state[1]))
+		except (TypeError, ValueError) as e:
+			self._logger.error("Invalid temperatures in restore file, not preheating\n" + str(e))
+			return
+		if not holds:
+			return
+		with self._preheat_lock:
+			self._preheat_generation += 1
+			self._printer.commands([set_temperature_command(heater, holds[heater]) for heater in sorted(holds)])
+			self._preheat_heaters = sorted(holds)
+			# a new job per preheat, so a timeout already due for an earlier preheat carries the older generation
+			self._preheat_timer.stop()
+			self._preheat_timer = self._scheduler.add_one_shot_job(self.preheatTimeout or DEFAULT_PREHEAT_TIMEOUT,
+																   self.on_preheat_timeout, self._preheat_generation)
+			self._preheat_timer.start()
+		self._logger.info("Preheating for restore: " + json.dumps(holds))
+		self._send_status(status_type="PREHEAT_STARTED", status_value=restore_state[1].get("fileName"),
+						  status_description="Preheating until the restore is confirmed")
+
+	def stop_preheat(self, cool_down):
+		"""End a preheat started by :meth:`start_preheat`. Does nothing if none is running.
+
+		Args:
+			cool_down (bool): Turn the preheated heaters off, False if a restore or print takes them over.
+
+		Returns:
+			list: The preheated heaters, None if no preheat was running.
+		"""
+		with self._preheat_lock:
+			return self._end_preheat(cool_down)
+
+	def _end_preheat(self, cool_down):
+		"""End the running preheat, the caller holds ``_preheat_lock``."""
+		heaters = self._preheat_heaters
+		if heaters is None:
+			return None
+		# a timeout due for this preheat is a no-op from here on
+		self._preheat_generation += 1
+		self._preheat_heaters = None
+		self._preheat_timer.stop()
+		if cool_down:
+			self._printer.commands([set_temperature_command(heater, 0) for heater in heaters])
+			self._logger.info("Preheat for restore cooled down")
+		return heaters
+
+	def on_preheat_timeout(self, generation):
+		"""Called by the scheduler when a preheated restore was not confirmed in time.
+
+		Args:
+			generation (int): Preheat the timeout was started for. Does nothing if that preheat was already
+				stopped or taken over by a restore meanwhile.
+		"""
+		with self._preheat_lock:
+			if generation != self._preheat_generation or self._end_preheat(cool_down=True) is None:
+				return
+		self._logger.info("Restore not confirmed within {}s".format(self._preheat_timer.interval))
+		self._send_status(status_type="PREHEAT_TIMEOUT", status_value=None,
+						  status_description="Restore not confirmed, heaters turned off")
+
+	def estimate_time_to_resume(self, data):
+		"""Estimate the seconds from starting a restore until the job continues, from the learned thermal model.
+
+		Args:
+			data (dict): Restore data.
+
+		Returns:
+			float: Seconds, None if the restore data holds invalid temperatures.
+		"""
+		try:
+			targets = heater_targets(data)
+		except (TypeError, ValueError):
+			return None
+		return round(estimate_heat_up(targets, self._printer_data.temperatures, self._thermal_model.time_to), 1)
+
+	def save_thermal_model(self):
+		"""Store the thermal model if it learned something since it was last saved."""
+		if not self._thermal_model.dirty:
+			return
+		try:
+			self._thermal_model.save(os.path.join(self.get_plugin_data_folder(), "thermal_model.json"))
 		except Exception as e:
-			self._logger.error("Restore error\n" + str(e))
-			return (False, str(e))
+			self._logger.error("Could not save thermal model\n" + str(e))
 
 	def detect_restore_phase(self, gcode, cmd):
 		"""Detect start of restore and the point when job file is resumed.
@@ -385,7 +741,9 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 			if self.check_restore_file_exists():
 				restore_state = self.parse_restore_file(log=True)
 				if restore_state[0] and "fileName" in restore_state[1].keys():
-					return jsonify(status="failureDetected", canRestore=True, file=restore_state[1]["fileName"])
+					return jsonify(status="failureDetected", canRestore=True, file=restore_state[1]["fileName"],
+								   preheating=self._preheat_heaters is not None,
+								   estimatedTimeToResume=self.estimate_time_to_resume(restore_state[1]))
 				else:
 					return jsonify(status="failureDetected", canRestore=False)
 			else:
@@ -407,17 +765,37 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 		else:
 			if data["restore"] is True:
 				if self.check_restore_file_exists():
+					# claim the preheated heaters before the restore heats them, a preheat timeout can no longer
+					# turn them off once the restore has started
+					preheated = self.stop_preheat(cool_down=False)
 					result = self.start_restore()
+					if result[0] is not True and preheated:
+						self._printer.commands([set_temperature_command(heater, 0) for heater in preheated])
 					if result[0] is True:
-						return jsonify(status="Successfully Restored")
+						return jsonify(status="Successfully Restored", jobId=result[1])
 					else:
 						return jsonify(status="Error: Could not restore", error=result[1])
 				else:
 					return jsonify(status="Error: Could not restore, no progress file exists")
 			else:
+				self.stop_preheat(cool_down=True)
 				self.delete_restore_file()
 				return jsonify(status="Progress file discarded")
 
+	@octoprint.plugin.BlueprintPlugin.route("/restoreProgress", methods=["GET"])
+	def route_restore_progress(self):
+		"""REST endpoint reporting the progress of the running or last restore job, optionally selected by jobId"""
+		progress = self._restore_runner.progress
+		job_id = request.args.get("jobId")
+		if progress is None or (job_id is not None and job_id != progress.job_id):
+			return make_response("Unknown restore job", 404)
+		return jsonify(**progress_to_dict(progress))
+
+	@octoprint.plugin.BlueprintPlugin.route("/getStatistics", methods=["GET"])
+	def route_get_statistics(self):
+		"""REST endpoint to get checkpoint writer counters"""
+		return jsonify(**self._checkpoint_writer.stats())
+
 	@octoprint.plugin.BlueprintPlugin.route("/getSettings", methods=["GET"])
 	def route_get_settings(self):
 		"""REST endpoint to get plugin settings"""
@@ -442,6 +820,7 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 	def initialize(self):
 		"""Initialize plugin: loggings, restore file path, state, flags"""
 		self._logger.info("Print Restore plugin initialised")
+		self.reload_config()
 
 		debug_file = os.path.join(self._settings.getBaseFolder("logs"), "print_restore.log")
 		file_handler = logging.handlers.RotatingFileHandler(debug_file, maxBytes=(2 * 1024 * 1024))
@@ -455,61 +834,117 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 
 		else:
 			self.__RESTORE_FILE = "/home/pi/print_restore.json"
-		self._logger.info("Path of restore file: " + self.__RESTORE_FILE)
-		self.__TEMP_RESTORE_FILE = self.__RESTORE_FILE + ".tmp"
+		self.open_storage()
+		self._checkpoint_writer = CheckpointWriter(self._storage, self._logger, on_failure=self.on_checkpoint_write_failed)
+		self._layer_indexer = LayerIndexer(LayerIndexCache(os.path.join(self.get_plugin_data_folder(), "index")), self._logger,
+										   processes=self.indexProcesses or default_index_processes())
 
 		# self.enabled = bool(boolConv(self._settings.get(["enabled"])))
 		# self.autoRestore = bool(boolConv(self._settings.get(["autoRestore"])))
 		# self.interval = float(self._settings.get(["interval"]))
+		self._scheduler = Scheduler(self._logger)
 		self._timer_printer_state_monitor = None
-		self.state_position = {}
-		self.state_babystep = 0
+		self._preheat_timer = self._scheduler.add_one_shot_job(DEFAULT_PREHEAT_TIMEOUT, self.on_preheat_timeout, 0)
+		self._thermal_model_timer = self._scheduler.add_job(THERMAL_MODEL_SAVE_INTERVAL, self.save_thermal_model)
+		self._checkpoint_policy = CheckpointPolicy(self.checkpointFilePosDelta, self.checkpointMaxAge)
+		self.state = PrinterState()
+		# state a restore left the printer in, taken over by the PRINT_STARTED event of the resumed job
+		self._restored_state = None
+		self._ack_window = AckWindow()
+		self._printer_data = PrinterDataCache()
+		self._restore_runner = RestoreRunner(self._printer, lambda: self._printer_data.temperatures, self._logger)
+		self._preheat_heaters = None
+		# guards the preheat heaters and generation, a preheat is started and stopped from Flask, event and
+		# scheduler threads
+		self._preheat_lock = threading.Lock()
+		self._preheat_generation = 0
+		self._thermal_model = ThermalModel()
+		self._thermal_model.load(os.path.join(self.get_plugin_data_folder(), "thermal_model.json"))
 		self.flag_is_saving_state = False
 		self.flag_restore_in_progress = False
+		self.flag_firmware_detected = False
+
+	def on_startup(self, host, port):
+		"""Called on the main thread while the server starts, the only place signal handlers can be installed."""
+		self.install_signal_handlers()
 
 	def on_after_startup(self):
 		"""Called just after launch of the server.
 
-		Initialize printer state monitor
+		Initialize printer state monitor and checkpoint writer, subscribe to printer data pushes
 		"""
+		self._printer.register_callback(self._printer_data)
+		self._printer.register_callback(self._thermal_model)
+		self._checkpoint_writer.start()
+		self._layer_indexer.start()
+		self._scheduler.start()
+		self._thermal_model_timer.start()
 		self.init_printer_state_monitor()
 
+	def on_shutdown(self):
+		"""Called by OctoPrint on shutdown. Flush the current printer state and stop the background threads."""
+		if self.flag_is_saving_state:
+			self.flush_restore_file("shutdown")
+		self.stop_preheat(cool_down=True)
+		self._printer.unregister_callback(self._printer_data)
+		self._printer.unregister_callback(self._thermal_model)
+		self.save_thermal_model()
+		self._restore_runner.cancel(FLUSH_TIMEOUT)
+		self._scheduler.stop(FLUSH_TIMEOUT)
+		self._layer_indexer.stop(FLUSH_TIMEOUT)
+		self._checkpoint_writer.stop(FLUSH_TIMEOUT)
+
 	def on_event(self, event, payload):
 		"""Called by OctoPrint upon processing of a fired event.
 
-		* Start/stop print state monitor
+		* Start/stop print state monitor, flush the restore file when a print stops unfinished
 		* Handle auto restore.
-		* Handle tool change
+		* Queue layer indexing of uploaded and printed files
 
 		Args:
 			event (str): The type of event that got fired
 			payload (dict): The payload as provided with the event
 		"""
+		if event == Events.DISCONNECTED:
+			self.flag_firmware_detected = False  # detect firmware again on the next connection
+			self._restore_runner.cancel(FLUSH_TIMEOUT)
+			self.stop_preheat(cool_down=False)  # nothing to send to, the firmware resets its heaters
+			self._restored_state = None
+
 		if self.enabled:
 			if event in (Events.CONNECTED):
 				if self.check_restore_file_exists():
 					if self.autoRestore:
 						self.start_restore()
+					elif self.speculativePreheat:
+						self.start_preheat()
 				# else:
 				#     self.parse_restore_file()
 
 			elif event in (Events.PRINT_STARTED, Events.PRINT_RESUMED):
 				#self.delete_restore_file()
-				self.start_printer_state_monitor()
+				# a resumed print continues with the state tracked up to the pause, a restored print with the
+				# state the restore moved the printer to
+				restored, self._restored_state = self._restored_state, None
+				self.start_printer_state_monitor(reset=event == Events.PRINT_STARTED,
+												 state=restored if event == Events.PRINT_STARTED else None)
+				if event == Events.PRINT_STARTED:
+					self.stop_preheat(cool_down=False)
+					self._printer_data.set_job(payload.get("name"), payload.get("path"))
+					self.request_layer_index(payload.get("origin"), payload.get("path"))
+
+			elif event == Events.UPLOAD:
+				self.request_layer_index(payload.get("target"), payload.get("path"))
 
 			elif event in Events.PRINT_PAUSED:
-				self.stop_printer_state_monitor()
+				self.stop_printer_state_monitor(flush_reason=event)
 
 			elif event in Events.PRINT_DONE:
 				self.stop_printer_state_monitor()
 				self.delete_restore_file()
 
 			elif event in (Events.PRINT_FAILED, Events.PRINT_CANCELLED, Events.DISCONNECTED):
-				self.stop_printer_state_monitor()
-
-			elif event is Events.TOOL_CHANGE:
-				if self.flag_is_saving_state:
-					self.state_position["T"] = payload["new"]
+				self.stop_printer_state_monitor(flush_reason=event)
 
 	def get_assets(self):
 		"""Define the static assets the plugin offers."""
@@ -530,7 +965,16 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 			enabled=True,
 			autoRestore=False,
 			interval=1,
-			enableBabystep=None
+			enableBabystep=None,
+			# a layer start is always saved, in between up to 256 KiB (around 20s of a typical print) may be reprinted
+			checkpointFilePosDelta=262144,
+			checkpointMaxAge=60,
+			storage="json",
+			buildLayerIndex=True,
+			indexProcesses=0,
+			resumeAt="filePos",
+			speculativePreheat=False,
+			preheatTimeout=DEFAULT_PREHEAT_TIMEOUT
 		)
 
 	def on_settings_migrate(self, target, current):
@@ -540,30 +984,43 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 			self._settings.set_int(["interval"], self._settings.get_int(["interval"]))
 			self._settings.set_boolean(["enableBabystep"], self._settings.get_boolean(["enableBabystep"]))
 			self._settings.save()
+		self.reload_config()
 
 	def on_settings_save(self, data):
 		"""React to changes in plugin settings"""
-		interval = self.interval
 		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 		self._settings.save()
+		self.reload_config()
 		# self.enabled = bool(boolConv(self._settings.get(["enabled"])))
 		# self.autoRestore = bool(boolConv(self._settings.get(["autoRestore"])))
 		# self.interval = float(self._settings.get(["interval"]))
 		self._logger.info("Print Restore settings saved")
-		if self._timer_printer_state_monitor.interval != interval:
+		self._checkpoint_policy.filepos_delta = self.checkpointFilePosDelta
+		self._checkpoint_policy.max_age = self.checkpointMaxAge
+		self._layer_indexer.processes = self.indexProcesses or default_index_processes()
+		if not self.speculativePreheat or not self.enabled:
+			self.stop_preheat(cool_down=True)
+		if self._storage.name != self.storage:
+			self._checkpoint_writer.discard()
+			close = getattr(self._storage, "close", None)
+			if close is not None:
+				close()
+			self.open_storage()
+			self._checkpoint_writer.storage = self._storage
+			self._checkpoint_policy.reset()
+		if self._timer_printer_state_monitor.interval != (self.interval or 1):
+			self.init_printer_state_monitor()
 			if self.flag_is_saving_state:
-				self.stop_printer_state_monitor()
-				self.init_printer_state_monitor()
-				self.start_printer_state_monitor()
-			else:
-				self.init_printer_state_monitor()
+				# reschedule the timer only, the tracked state is kept
+				self._timer_printer_state_monitor.stop()
+				self._timer_printer_state_monitor.start()
 		if not self.enabled:
 			if self._printer.is_printing() or self._printer.is_paused():
 				self.stop_printer_state_monitor()
 				self.delete_restore_file()
-		else:
-			if self._printer.is_printing() or self._printer.is_paused():
-				self.start_printer_state_monitor()
+		elif not self.flag_is_saving_state and self._printer.is_printing():
+			# enabled during a print: commands sent meanwhile were not tracked
+			self.start_printer_state_monitor(reset=True)
 	# endregion
 
 	# region "OctoPrint hooks"
@@ -578,6 +1035,8 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 			gcode (str): Parsed GCODE command. None if no known command could be parsed.
 		"""
 		self.record_current_state(gcode, cmd)
+		if self.flag_is_saving_state:
+			self._ack_window.push(kwargs.get("tags"), self.state)
 
 	def gcode_received_hook(self, comm, line, *args, **kwargs):
 		"""Get the returned lines sent by the printer.
@@ -589,6 +1048,10 @@ class Julia2018PrintRestore(octoprint.plugin.StartupPlugin,
 		Returns:
 			str: Modified or untouched line
 		"""
+		if line.startswith("ok"):
+			self._ack_window.ack()
+		elif line.startswith("Resend") or line.startswith("rs "):
+			self._ack_window.clear_pending()
 		return self.detect_babystep_support(line)
 
 	def gcode_queuing_hook(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
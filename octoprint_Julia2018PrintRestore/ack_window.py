@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .state import CHECKPOINT_FIELDS
+
+
+class AckWindow(object):
+	"""Ring of the commands sent to the printer and not yet acknowledged with "ok".
+
+	The sent hook pushes the command's tags and the printer state after each command, every "ok"
+	pops the oldest entry, which becomes the acknowledged state. Slots are preallocated and the
+	:data:`state.CHECKPOINT_FIELDS` are copied into them in place, so pushing and acknowledging take
+	constant time and allocate nothing. The tag set is kept by reference, the file position is parsed out
+	of it only when a checkpoint reads the acknowledged entry.
+
+	Note that firmware acknowledges a move once it is in its planner queue, so the acknowledged state
+	can still be a few moves ahead of the nozzle. It is never ahead of what the firmware received.
+
+	The lock only orders OctoPrint's sending and receiving threads. :meth:`acknowledged` takes no lock,
+	it retries its copy when an acknowledgement changed the entry meanwhile (seqlock), so a checkpoint
+	being taken never holds up the communication with the printer.
+
+	Args:
+		capacity (int): Maximum number of unacknowledged commands. When exceeded, the oldest one is
+			treated as acknowledged.
+	"""
+
+	def __init__(self, capacity=64):
+		self.capacity = capacity
+		self._lock = threading.Lock()
+		self._tags = [None] * capacity
+		self._states = [[None] * len(CHECKPOINT_FIELDS) for _ in range(capacity)]
+		self._acked = [None] * len(CHECKPOINT_FIELDS)
+		self._acked_tags = None
+		self._last_tags = None
+		self._sequence = 0
+		self._head = 0
+		self._count = 0
+		self.overflows = 0
+
+	def __len__(self):
+		return self._count
+
+	def reset(self):
+		"""Forget all pending and acknowledged entries."""
+		with self._lock:
+			self._head = 0
+			self._count = 0
+			self._sequence += 1
+			self._acked_tags = None
+			self._sequence += 1
+			self._last_tags = None
+
+	def clear_pending(self):
+		"""Drop the unacknowledged entries, e.g. after the firmware requested a resend.
+
+		The acknowledged state is kept. Entries pushed afterwards are acknowledged by the following "ok"s.
+		"""
+		with self._lock:
+			self._count = 0
+
+	def push(self, tags, state):
+		"""Add a sent command.
+
+		Args:
+			tags (set): Tags of the command, see :func:`file_position_from_tags`. Commands not tagged
+				"source:file" take the file position of the last job file line.
+			state (PrinterState): Printer state after the command.
+		"""
+		with self._lock:
+			if tags is not None and "source:file" in tags:
+				self._last_tags = tags
+			else:
+				tags = self._last_tags
+			if self._count == self.capacity:
+				self._pop()
+				self.overflows += 1
+			slot = (self._head + self._count) % self.capacity
+			self._tags[slot] = tags
+			state.checkpoint_into(self._states[slot])
+			self._count += 1
+
+	def ack(self):
+		"""Acknowledge the oldest pending command. Does nothing if there is none."""
+		with self._lock:
+			if self._count:
+				self._pop()
+
+	def acknowledged(self):
+		"""Get the last acknowledged entry.
+
+		Returns:
+			tuple: (file position, tuple of the :data:`state.CHECKPOINT_FIELDS`), None if nothing was
+				acknowledged yet.
+		"""
+		while True:
+			sequence = self._sequence
+			if not sequence & 1:
+				tags = self._acked_tags
+				state = tuple(self._acked)
+				if self._sequence == sequence:
+					break
+			time.sleep(0)
+		offset = file_position_from_tags(tags)
+		if offset is None:
+			return None
+		return offset, state
+
+	def _pop(self):
+		head = self._head
+		self._sequence += 1
+		# swap the slot with the acknowledged state list instead of copying
+		self._states[head], self._acked = self._acked, self._states[head]
+		self._acked_tags = self._tags[head]
+		self._sequence += 1
+		self._head = (head + 1) % self.capacity
+		self._count -= 1
+
+
+def file_position_from_tags(tags):
+	"""Get the job file position OctoPrint tags job file lines with in the gcode hooks.
+
+	Args:
+		tags (set): Command tags, e.g. {"source:file", "filepos:1234", "fileline:56"}.
+
+	Returns:
+		int: File position after the line, None for commands not from the job file.
+	"""
+	if tags:
+		for tag in tags:
+			if tag.startswith("filepos:"):
+				return int(tag[8:])
+	return None
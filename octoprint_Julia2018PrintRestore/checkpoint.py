@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+
+class CheckpointPolicy(object):
+	"""Decide whether a restore file checkpoint is worth writing.
+
+	A checkpoint is due on a layer change (Z increased), when the job file position advanced by at least
+	``filepos_delta`` bytes, or when the last committed checkpoint is older than ``max_age`` seconds.
+	A checkpoint identical to the last committed one is never written.
+
+	The plugin defaults (256 KiB, 60s) write about one checkpoint per layer on typical prints, a tenth
+	of the ticks or less, at the cost of reprinting up to ``filepos_delta`` bytes of a layer after a power cut.
+	Every layer change is still written, so on prints whose layers take less than about ten ticks the saving is smaller.
+
+	Args:
+		filepos_delta (int): Job file position advance in bytes that triggers a checkpoint.
+		max_age (float): Maximum age in seconds of the committed checkpoint.
+	"""
+
+	def __init__(self, filepos_delta, max_age):
+		self.filepos_delta = filepos_delta
+		self.max_age = max_age
+		self.reset()
+
+	def reset(self):
+		"""Forget the last committed checkpoint, making the next one due."""
+		self._last_data = None
+		self._last_z = None
+		self._last_filepos = None
+		self._last_time = None
+
+	def due(self, data, now):
+		"""Check if a checkpoint should be written.
+
+		Args:
+			data (dict): Restore file data about to be written.
+			now (float): Current monotonic time in seconds.
+
+		Returns:
+			bool: True if the checkpoint should be written.
+		"""
+		if self._last_data is None:
+			return True
+		if data == self._last_data:
+			return False
+		z = data["position"].get("Z")
+		if z is not None and self._last_z is not None and z > self._last_z:
+			return True
+		if data["filePos"] - self._last_filepos >= self.filepos_delta:
+			return True
+		return now - self._last_time >= self.max_age
+
+	def changed(self, data):
+		"""Check if a checkpoint differs from the last committed one, regardless of whether it is due.
+
+		Args:
+			data (dict): Restore file data about to be written.
+
+		Returns:
+			bool: True if nothing was committed yet or the data differs.
+		"""
+		return self._last_data is None or data != self._last_data
+
+	def commit(self, data, now):
+		"""Record a checkpoint that was handed to the checkpoint writer.
+
+		The write happens later on the writer's thread. If it fails, the owner calls :meth:`reset` so the
+		next checkpoint is due again.
+
+		Args:
+			data (dict): Restore file data that was submitted.
+			now (float): Monotonic time of the submission in seconds.
+		"""
+		self._last_data = data
+		self._last_z = data["position"].get("Z")
+		self._last_filepos = data["filePos"]
+		self._last_time = now
@@ -0,0 +1,36 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+PluginConfig = namedtuple("PluginConfig", ["enabled", "autoRestore", "interval", "enableBabystep",
+										   "checkpointFilePosDelta", "checkpointMaxAge", "storage", "buildLayerIndex", "indexProcesses", "resumeAt",
+										   "speculativePreheat", "preheatTimeout"])
+PluginConfig.__doc__ = """Immutable snapshot of the plugin settings.
+
+Rebuilt whenever the settings change and swapped in as a whole, so hot paths read plain attributes
+instead of looking values up in OctoPrint's settings tree.
+"""
+
+
+def load_config(settings):
+	"""Read the plugin settings into a :class:`PluginConfig`.
+
+	Args:
+		settings (octoprint.plugin.PluginSettings): The plugin's settings.
+
+	Returns:
+		PluginConfig: Settings snapshot.
+	"""
+	return PluginConfig(enabled=settings.get_boolean(["enabled"]),
+						autoRestore=settings.get_boolean(["autoRestore"]),
+						interval=settings.get_int(["interval"]),
+						enableBabystep=settings.get_boolean(["enableBabystep"]),
+						checkpointFilePosDelta=settings.get_int(["checkpointFilePosDelta"]),
+						checkpointMaxAge=settings.get_int(["checkpointMaxAge"]),
+						storage=settings.get(["storage"]),
+						buildLayerIndex=settings.get_boolean(["buildLayerIndex"]),
+						indexProcesses=settings.get_int(["indexProcesses"]),
+						resumeAt=settings.get(["resumeAt"]),
+						speculativePreheat=settings.get_boolean(["speculativePreheat"]),
+						preheatTimeout=settings.get_int(["preheatTimeout"]))
@@ -0,0 +1,34 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re
+
+_BABYSTEP_FIRMWARE_REGEX = re.compile(r"Marlin J18([A-Z]{2})_([0-9]{6}_[0-9]{4})_HA")
+
+# Prefixes of the lines received many times per second that never carry firmware information
+_FREQUENT_LINE_PREFIXES = ("ok", "T:", " T:", "echo:busy", "wait")
+
+
+def is_frequent_line(line):
+	"""Check if a received line is an acknowledgement, temperature report or busy message.
+
+	Args:
+		line (str): The line received from the printer.
+
+	Returns:
+		bool: True for lines that can skip firmware detection.
+	"""
+	return line.startswith(_FREQUENT_LINE_PREFIXES)
+
+
+def firmware_supports_babystep(firmware_name):
+	"""Check if a firmware build saves babystep, i.e. it is a Julia Pro (PT/PE) build.
+
+	Args:
+		firmware_name (str): FIRMWARE_NAME value reported by M115.
+
+	Returns:
+		bool: True if babystep needs to be saved.
+	"""
+	matches = _BABYSTEP_FIRMWARE_REGEX.search(firmware_name)
+	return matches is not None and matches.group(1) in ("PT", "PE")
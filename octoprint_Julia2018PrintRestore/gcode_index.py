@@ -0,0 +1,824 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+
+from .gcode_parser import command_for_line, parse_move, parse_words
+from .state import (FIELDS, TRACKED_COMMANDS, PrinterState, X, Y, Z, E, F, FAN, TOOL, BABYSTEP, FEED_MULTIPLIER, FLOW_MULTIPLIER,
+					OFFSET_X, OFFSET_Y, OFFSET_Z, TOOL0_TARGET, TOOL1_TARGET, BED_TARGET)
+
+INDEX_VERSION = 1
+
+# A move this far from the last layer height starts a new layer once it extrudes
+MIN_LAYER_STEP = 0.05
+
+# Upper bound for the entries kept per file. Past it every other entry is dropped, so a vase mode print
+# with a layer every few hundred bytes still gives a bounded index.
+MAX_ENTRIES = 20000
+
+# Smallest chunk worth handing to a worker process
+PARALLEL_MIN_CHUNK = 4 * 1024 * 1024
+
+# Block size for files that cannot be memory mapped
+_BLOCK_SIZE = 8 * 1024 * 1024
+
+# A command line: optional indentation and the command word. Comments and blank lines never match,
+# so they are skipped without leaving the regular expression engine.
+_COMMAND_LINE_REGEX = re.compile(br"^[ \t]*([GMTgmt][0-9]+)[^\n]*", re.MULTILINE)
+# A scanned line: either a plain G0/G1 move with its X, Y, Z, E and F values (groups 1-5), the bulk of a
+# print, or any other command line (group 6) with its command word (group 7). Moves are taken straight
+# from the bytes, only the other lines are decoded, and only if the state machine tracks their command.
+_SCAN_LINE_REGEX = re.compile(br"^[ \t]*(?:[Gg]0?[01](?: (?:X([-+.0-9]{1,32})|Y([-+.0-9]{1,32})|Z([-+.0-9]{1,32})|"
+							  br"E([-+.0-9]{1,32})|F([.0-9]{1,32})))*[ \t]*(?:;[^\n]*)?\r?$|(([GMTgmt][0-9]+)[^\n]*))",
+							  re.MULTILINE)
+# The commands switching relative/absolute positioning and units
+_MODAL_REGEX = re.compile(br"^[ \t]*([GMgm](?:9[01]|8[23]|2[01]))(?![0-9])", re.MULTILINE)
+
+_MOVES = frozenset(("G0", "G1", "G00", "G01"))
+_AXES = (("X", X, OFFSET_X), ("Y", Y, OFFSET_Y), ("Z", Z, OFFSET_Z))
+
+# Fields a speculative scan tracks relative to the unknown state at the start of its chunk
+_RELATIVE_FIELDS = (X, Y, Z, E, OFFSET_X, OFFSET_Y, OFFSET_Z, BABYSTEP)
+# Fields a speculative scan leaves None until they are set in its chunk
+_INHERITED_FIELDS = (F, FAN, TOOL, FEED_MULTIPLIER, FLOW_MULTIPLIER, TOOL0_TARGET, TOOL1_TARGET, BED_TARGET)
+
+# Command word bytes to command, filled as commands are seen
+_COMMANDS = {}
+
+
+def _command(code):
+	gcode = _COMMANDS.get(code)
+	if gcode is None:
+		gcode = _COMMANDS[code] = command_for_line(code.decode("ascii"))
+	return gcode
+
+
+class LayerIndex(object):
+	"""Byte offsets of the layer starts of a G-code file with the machine state at each of them.
+
+	Entry ``i`` is the line starting layer ``layers[i]`` at byte ``offsets[i]``, ``snapshots[i]`` is the
+	:class:`~state.PrinterState` snapshot before that line is executed.
+
+	Args:
+		path (str): Path of the G-code file.
+		size (int): File size the index was built for.
+		mtime (float): File modification time the index was built for.
+	"""
+
+	def __init__(self, path, size, mtime, offsets=None, layers=None, snapshots=None):
+		self.path = path
+		self.size = size
+		self.mtime = mtime
+		self.offsets = offsets if offsets is not None else []
+		self.layers = layers if layers is not None else []
+		self.snapshots = snapshots if snapshots is not None else []
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def matches(self, path):
+		"""Check if the index is still valid for a file on disk."""
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return False
+		return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+	def nearest(self, offset, back=0):
+		"""Find the last layer start at or before a file position.
+
+		Args:
+			offset (int): File position.
+			back (int): Number of indexed layers to go back from there.
+
+		Returns:
+			tuple: (offset, layer, snapshot) of the entry, None if there is no such entry.
+		"""
+		i = bisect.bisect_right(self.offsets, offset) - 1 - back
+		if i < 0:
+			return None
+		return self.offsets[i], self.layers[i], self.snapshots[i]
+
+	def append(self, offset, layer, snapshot):
+		self.offsets.append(offset)
+		self.layers.append(layer)
+		self.snapshots.append(snapshot)
+
+	def thin(self):
+		"""Drop every other entry, keeping the first."""
+		del self.offsets[1::2]
+		del self.layers[1::2]
+		del self.snapshots[1::2]
+
+	def to_dict(self):
+		return dict(version=INDEX_VERSION,
+					path=self.path,
+					size=self.size,
+					mtime=self.mtime,
+					offsets=self.offsets,
+					layers=self.layers,
+					snapshots=[list(s) for s in self.snapshots])
+
+	@classmethod
+	def from_dict(cls, data):
+		"""Create an index from :meth:`to_dict` data.
+
+		Raises:
+			ValueError: If the data is not a valid index.
+		"""
+		try:
+			if data["version"] != INDEX_VERSION:
+				raise ValueError("Unsupported layer index version: {}".format(data["version"]))
+			index = cls(data["path"], data["size"], data["mtime"],
+						[int(o) for o in data["offsets"]],
+						[int(layer) for layer in data["layers"]],
+						[tuple(s) for s in data["snapshots"]])
+		except (KeyError, TypeError) as e:
+			raise ValueError("Invalid layer index: {}".format(str(e)))
+		if not len(index.offsets) == len(index.layers) == len(index.snapshots):
+			raise ValueError("Invalid layer index: entry count mismatch")
+		return index
+
+
+def _next_line_start(f, offset, size):
+	"""First line start at or after ``offset`` in a file opened in binary mode."""
+	if offset <= 0:
+		return 0
+	if offset >= size:
+		return size
+	f.seek(offset - 1)
+	return min(size, offset - 1 + len(f.readline()))
+
+
+def _regions(f, start, end):
+	"""Yield (buffer, base offset, start, end) tuples covering a range of a file.
+
+	The file is memory mapped where possible, otherwise read in blocks cut at line ends.
+	``start`` and ``end`` must be line starts.
+	"""
+	try:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except (EnvironmentError, ValueError):
+		buf = None
+	if buf is not None:
+		try:
+			yield buf, 0, start, end
+		finally:
+			buf.close()
+		return
+
+	base = start
+	while base < end:
+		f.seek(base)
+		block = f.read(min(_BLOCK_SIZE, end - base))
+		if not block:
+			break
+		length = len(block)
+		if base + length < end:
+			cut = block.rfind(b"\n")
+			if cut >= 0:
+				length = cut + 1
+		yield block, base, 0, length
+		base += length
+
+
+def _speculative_state(modal):
+	state = PrinterState()
+	for field in _INHERITED_FIELDS:
+		setattr(state, FIELDS[field], None)
+	for field in _RELATIVE_FIELDS:
+		setattr(state, FIELDS[field], 0.0)
+	state.relative, state.relative_e, state.units = modal
+	return state
+
+
+def _resolve(snapshot, deps, start):
+	"""Turn a speculative snapshot into an absolute one, given the exact state at the start of its chunk."""
+	if deps is None:
+		return snapshot
+	values = list(snapshot)
+	for field in _RELATIVE_FIELDS:
+		dep = deps[field]
+		if dep is not None:
+			values[field] += start[dep]
+	for field in _INHERITED_FIELDS:
+		if values[field] is None:
+			values[field] = start[field]
+	return tuple(values)
+
+
+def _resolve_value(value, dep, start):
+	return value if dep is None else value + start[dep]
+
+
+class _LayerScanner(object):
+	"""Runs the printer state machine over a range of a G-code file and reports layer starts.
+
+	A layer starts at a move changing Z away from the last layer height which is then followed by an
+	extruding move at that height, so Z hops and travel moves do not count as layers. Z going down starts
+	a layer too, as in sequential printing.
+
+	An exact scan starts from a known state. A speculative scan (``modal`` given) starts in the middle of
+	a file without knowing the state there: positions, E, G92 offsets and babystep are kept relative to
+	the start state, ``deps[field]`` naming the start state field a value is relative to (None if it is
+	absolute), and other fields stay None until set. Events that cannot be decided before the first
+	extrusion are recorded in ``prefix``. After it, a decision depending on the start state marks the
+	scan as failed, and the chunk has to be rescanned exactly.
+
+	Args:
+		on_layer (callable): Called with (offset, snapshot, deps) of every layer start.
+		state (PrinterState, optional): Start state of an exact scan.
+		modal (tuple, optional): (relative, relative_e, units) at the start of a speculative scan.
+		layer_z (float, optional): Height of the last layer before the range.
+		candidate (tuple, optional): Pending layer start before the range.
+	"""
+
+	def __init__(self, on_layer, state=None, modal=None, layer_z=None, candidate=None):
+		self.on_layer = on_layer
+		self.layer_z = layer_z
+		self.layer_z_dep = None
+		self.candidate = candidate
+		self.failed = False
+		self.uses_default_tool = False
+		self.assumed_layer = None
+		self.prefix = None
+		self.in_prefix = False
+		self._prefix_extruded = False
+		if modal is None:
+			self.state = state if state is not None else PrinterState()
+			self.deps = None
+		else:
+			self.state = _speculative_state(modal)
+			self.deps = [None] * len(FIELDS)
+			for field in _RELATIVE_FIELDS:
+				self.deps[field] = field
+			self.prefix = []
+			self.in_prefix = True
+		self._deps_snapshot = None
+
+	def scan(self, buf, base, start, end):
+		"""Scan ``buf[start:end]``, ``base`` being the file offset of ``buf[0]``."""
+		state = self.state
+		deps = self.deps
+		commands = _COMMANDS
+		for match in _SCAN_LINE_REGEX.finditer(buf, start, end):
+			code = match.group(7)
+			if code is None:
+				x, y, z, e, f = match.group(1, 2, 3, 4, 5)
+				try:
+					x = x if x is None else float(x)
+					y = y if y is None else float(y)
+					z = z if z is None else float(z)
+					e = e if e is None else float(e)
+					f = f if f is None else float(f)
+				except ValueError:
+					# digits and dots that are not a number, parsed the way the sent hook does
+					try:
+						x, y, z, e, f = parse_move(match.group(0).decode("ascii", "ignore"))
+					except ValueError:
+						continue
+			else:
+				gcode = commands.get(code)
+				if gcode is None:
+					gcode = _command(code)
+				if gcode not in TRACKED_COMMANDS:
+					continue
+				line = match.group(6).decode("ascii", "ignore")
+				if gcode not in _MOVES:
+					if deps is not None:
+						self._apply_speculative(gcode, line)
+					else:
+						try:
+							state.apply(gcode, line)
+						except ValueError:
+							pass
+					continue
+				try:
+					x, y, z, e, f = parse_move(line)
+				except ValueError:
+					continue
+			before = None
+			if z is not None:
+				before = state.snapshot()
+				before_deps = self._deps()
+			e_before = state.e
+			e_dep = deps[E] if deps is not None else None
+			try:
+				state.move_to(x, y, z, e, f)
+			except ValueError:
+				continue
+			if deps is not None:
+				self._move_deps(x, y, z, e)
+			if before is not None:
+				self._z_moved(base + match.start(), before, before_deps)
+			if e is not None:
+				self._e_moved(e_before, e_dep)
+			if self.failed:
+				return
+
+	def result(self, entries):
+		"""Picklable outcome of a scan, see :func:`_stitch_chunk`."""
+		return dict(snapshot=self.state.snapshot(), deps=self._deps(), entries=entries,
+					prefix=self.prefix, in_prefix=self.in_prefix, assumed_layer=self.assumed_layer,
+					layer_z=(self.layer_z, self.layer_z_dep), candidate=self.candidate,
+					failed=self.failed, uses_default_tool=self.uses_default_tool)
+
+	def _deps(self):
+		if self.deps is None:
+			return None
+		if self._deps_snapshot is None:
+			self._deps_snapshot = tuple(self.deps)
+		return self._deps_snapshot
+
+	def _set_dep(self, field, dep):
+		if self.deps[field] != dep:
+			self.deps[field] = dep
+			self._deps_snapshot = None
+
+	def _move_deps(self, x, y, z, e):
+		state = self.state
+		if not state.relative:
+			for value, field, offset in ((x, X, OFFSET_X), (y, Y, OFFSET_Y), (z, Z, OFFSET_Z)):
+				if value is not None:
+					self._set_dep(field, self.deps[offset])
+		if e is not None and not state.relative_e:
+			self._set_dep(E, None)
+
+	def _apply_speculative(self, gcode, line):
+		state = self.state
+		if state.tool is None and (gcode == "M104" or gcode == "M109"):
+			self.uses_default_tool = True
+		try:
+			state.apply(gcode, line)
+		except ValueError:
+			return
+		if gcode == "G92":
+			words = parse_words(line)
+			if not any(axis in words for axis in "XYZE"):
+				words = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+			for axis, field, offset in _AXES:
+				if axis in words:
+					self._set_dep(offset, self.deps[field])
+			if "E" in words:
+				self._set_dep(E, None)
+		elif gcode == "G28":
+			words = parse_words(line)
+			home_all = not ("X" in words or "Y" in words or "Z" in words)
+			for axis, field, offset in _AXES:
+				if home_all or axis in words:
+					self._set_dep(field, None)
+					self._set_dep(offset, None)
+
+	def _z_moved(self, offset, before, before_deps):
+		z = self.state.z
+		z_dep = self.deps[Z] if self.deps is not None else None
+		if self.in_prefix:
+			self.prefix.append(("z", offset, before, before_deps, z, z_dep))
+			self._prefix_extruded = False
+			return
+		if (before_deps[Z] if before_deps is not None else None) != z_dep:
+			self.failed = True
+			return
+		if z == before[Z]:
+			return
+		if self.layer_z is None:
+			far = True
+		elif self.layer_z_dep != z_dep:
+			self.failed = True
+			return
+		else:
+			far = abs(z - self.layer_z) > MIN_LAYER_STEP
+		self.candidate = (offset, before, before_deps, z, z_dep) if far else None
+
+	def _e_moved(self, e_before, e_before_dep):
+		state = self.state
+		if e_before is None:
+			return
+		e_dep = self.deps[E] if self.deps is not None else None
+		extruded = state.e > e_before if e_dep == e_before_dep else None
+		z = state.z
+		z_dep = self.deps[Z] if self.deps is not None else None
+		if self.in_prefix:
+			if extruded is False or self._prefix_extruded:
+				return
+			self.prefix.append(("e", e_before, e_before_dep, state.e, e_dep, z, z_dep))
+			if extruded and (z_dep != Z or state.relative):
+				# from here on layer heights can be compared within the chunk
+				self.in_prefix = False
+				self.layer_z = z
+				self.layer_z_dep = z_dep
+				self.assumed_layer = (z, z_dep)
+				self.candidate = None
+			self._prefix_extruded = bool(extruded)
+			return
+		if extruded is None:
+			self.failed = True
+			return
+		candidate = self.candidate
+		if not extruded or candidate is None:
+			return
+		if candidate[4] != z_dep:
+			self.failed = True
+		elif z == candidate[3]:
+			self.on_layer(candidate[0], candidate[1], candidate[2])
+			self.layer_z = z
+			self.layer_z_dep = z_dep
+			self.candidate = None
+
+
+class _LayerRecorder(object):
+	"""Numbers layer starts and adds them to an index, thinning it past ``max_entries``."""
+
+	def __init__(self, index, max_entries):
+		self.index = index
+		self.max_entries = max_entries
+		self.layer = 0
+		# layers recorded after thinning, doubled on every thinning
+		self.stride = 1
+
+	def __call__(self, offset, snapshot, deps=None):
+		self.layer += 1
+		if self.layer % self.stride == 0:
+			self.index.append(offset, self.layer, snapshot)
+			if len(self.index) > self.max_entries:
+				self.index.thin()
+				self.stride *= 2
+
+
+def _lower_priority():
+	"""Pool initializer, keeps index workers from competing with the printer communication."""
+	if hasattr(os, "nice"):
+		os.nice(10)
+
+
+def _context():
+	"""Multiprocessing context index workers are started with.
+
+	OctoPrint runs many threads, forking it could copy a lock another thread holds into the worker. Workers
+	are started by a fork server where there is one, spawned otherwise. Python 2 has no contexts and forks.
+	"""
+	get_context = getattr(multiprocessing, "get_context", None)
+	if get_context is None:
+		return multiprocessing
+	try:
+		return get_context("forkserver")
+	except ValueError:
+		return get_context("spawn")
+
+
+def _modal_worker(args):
+	"""Find the commands switching positioning mode or units in a chunk, in file order."""
+	path, start, end = args
+	commands = []
+	with open(path, "rb") as f:
+		for buf, base, lo, hi in _regions(f, start, end):
+			commands.extend(_command(code) for code in _MODAL_REGEX.findall(buf, lo, hi))
+	return commands
+
+
+def _chunk_worker(args):
+	"""Scan one chunk, exactly for the first chunk and speculatively for the others."""
+	path, start, end, modal = args
+	entries = []
+	scanner = _LayerScanner(lambda *entry: entries.append(entry), modal=modal)
+	with open(path, "rb") as f:
+		for region in _regions(f, start, end):
+			scanner.scan(*region)
+			if scanner.failed:
+				break
+	return scanner.result(entries)
+
+
+def _exact_worker(args):
+	"""Scan one chunk exactly from the state at its start, where its speculative scan did not hold."""
+	path, start, end, snapshot, layer_z, candidate = args
+	entries = []
+	state = PrinterState()
+	state.restore(snapshot)
+	scanner = _LayerScanner(lambda *entry: entries.append(entry), state=state, layer_z=layer_z, candidate=candidate)
+	with open(path, "rb") as f:
+		for region in _regions(f, start, end):
+			scanner.scan(*region)
+	return entries, state.snapshot(), scanner.layer_z, scanner.candidate
+
+
+def _stitch_chunk(result, start, layer_z, candidate, recorder):
+	"""Apply a speculative chunk scan, given the exact state at the start of its chunk.
+
+	Returns:
+		tuple: (state, layer_z, candidate) at the end of the chunk, None if the speculation did not hold.
+	"""
+	if result["failed"] or any(start[field] is None for field in (X, Y, Z, E)):
+		return None
+	if result["uses_default_tool"] and start[TOOL] not in (None, 0):
+		return None
+
+	confirmed = []
+	for event in result["prefix"]:
+		if event[0] == "z":
+			_, offset, before, before_deps, z, z_dep = event
+			before = _resolve(before, before_deps, start)
+			z = _resolve_value(z, z_dep, start)
+			if z != before[Z]:
+				far = layer_z is None or abs(z - layer_z) > MIN_LAYER_STEP
+				candidate = (offset, before, None, z, None) if far else None
+		else:
+			_, e_before, e_before_dep, e, e_dep, z, z_dep = event
+			if candidate is not None \
+					and _resolve_value(e, e_dep, start) > _resolve_value(e_before, e_before_dep, start) \
+					and _resolve_value(z, z_dep, start) == candidate[3]:
+				confirmed.append((candidate[0], candidate[1]))
+				layer_z = candidate[3]
+				candidate = None
+
+	if not result["in_prefix"]:
+		# the scan went on assuming the layer height at its first extrusion
+		assumed_z, assumed_dep = result["assumed_layer"]
+		if candidate is not None or layer_z != _resolve_value(assumed_z, assumed_dep, start):
+			return None
+		for offset, snapshot, deps in result["entries"]:
+			confirmed.append((offset, _resolve(snapshot, deps, start)))
+		layer_z = _resolve_value(result["layer_z"][0], result["layer_z"][1], start)
+		candidate = result["candidate"]
+		if candidate is not None:
+			candidate = (candidate[0], _resolve(candidate[1], candidate[2], start), None,
+						 _resolve_value(candidate[3], candidate[4], start), None)
+
+	for offset, snapshot in confirmed:
+		recorder(offset, snapshot)
+	return _resolve(result["snapshot"], result["deps"], start), layer_z, candidate
+
+
+def _build_in_pool(path, size, recorder, processes, chunk_count):
+	with open(path, "rb") as f:
+		bounds = sorted(set(_next_line_start(f, size * i // chunk_count, size) for i in range(chunk_count + 1)))
+	chunks = list(zip(bounds[:-1], bounds[1:])) or [(0, size)]
+
+	pool = _context().Pool(min(processes, len(chunks)), initializer=_lower_priority)
+	try:
+		# positioning mode and units at each chunk start, these commands do not depend on the position
+		modal = [None]
+		if len(chunks) > 1:
+			flags = PrinterState()
+			modal = []
+			for commands in pool.map(_modal_worker, [(path, start, end) for start, end in chunks]):
+				modal.append((flags.relative, flags.relative_e, flags.units))
+				for gcode in commands:
+					flags.apply(gcode, gcode)
+
+		results = pool.imap(_chunk_worker, [(path, start, end, modal[i] if i else None)
+											for i, (start, end) in enumerate(chunks)])
+		state = layer_z = candidate = None
+		for (start, end), result in zip(chunks, results):
+			if state is None:
+				for offset, snapshot, deps in result["entries"]:
+					recorder(offset, snapshot)
+				state, layer_z, candidate = result["snapshot"], result["layer_z"][0], result["candidate"]
+				continue
+			stitched = _stitch_chunk(result, state, layer_z, candidate, recorder)
+			if stitched is None:
+				# rescanned by a worker too, the calling thread only stitches
+				entries, snapshot, layer_z, candidate = pool.apply(_exact_worker, ((path, start, end, state, layer_z, candidate),))
+				for offset, entry, deps in entries:
+					recorder(offset, entry)
+				stitched = snapshot, layer_z, candidate
+			state, layer_z, candidate = stitched
+		pool.close()
+	except Exception:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+
+def default_index_processes():
+	"""Worker processes for indexing: all cores but one, which is left for OctoPrint, and at most four."""
+	try:
+		count = multiprocessing.cpu_count()
+	except NotImplementedError:
+		count = 1
+	return max(1, min(4, count - 1))
+
+
+def build_layer_index(path, max_entries=MAX_ENTRIES, processes=1):
+	"""Scan a G-code file through the printer state machine and record where each layer starts.
+
+	Command lines are found with a regular expression over the raw bytes, only those are decoded.
+	The file is scanned by a pool of ``processes`` low priority worker processes, so the scan never holds
+	the calling process's GIL, which OctoPrint's printer communication needs. Files larger than
+	:data:`PARALLEL_MIN_CHUNK` are split at line starts. Every chunk but the first is scanned without
+	knowing the state at its start, the chunks are then stitched together in order with the exact state,
+	see :class:`_LayerScanner`. A chunk whose speculation did not hold is rescanned by a worker.
+	The index is thinned past ``max_entries``, which bounds memory for large files.
+
+	Args:
+		path (str): Path of the G-code file.
+		max_entries (int): Maximum number of entries kept.
+		processes (int): Worker processes, 0 scans in the calling thread.
+
+	Returns:
+		LayerIndex: The index.
+	"""
+	stat = os.stat(path)
+	index = LayerIndex(path, stat.st_size, stat.st_mtime)
+	recorder = _LayerRecorder(index, max_entries)
+	if processes > 0:
+		chunk_count = max(1, min(2 * processes, stat.st_size // PARALLEL_MIN_CHUNK)) if processes > 1 else 1
+		_build_in_pool(path, stat.st_size, recorder, processes, chunk_count)
+	else:
+		scanner = _LayerScanner(recorder)
+		with open(path, "rb") as f:
+			for region in _regions(f, 0, stat.st_size):
+				scanner.scan(*region)
+	return index
+
+
+def reconstruct_state(path, filepos, index=None):
+	"""Recover the printer state at a file position by replaying the G-code file up to it.
+
+	With a valid layer index the replay starts at the last layer start before ``filepos`` from the state
+	recorded there, so only part of one layer is read. The file is memory mapped where possible.
+
+	Args:
+		path (str): Path of the G-code file.
+		filepos (int): File position, every line starting before it is applied.
+		index (LayerIndex, optional): Layer index of the file.
+
+	Returns:
+		PrinterState: State after the last line before ``filepos``.
+	"""
+	state = PrinterState()
+	start = 0
+	if index is not None and index.path == path and index.matches(path):
+		entry = index.nearest(filepos)
+		if entry is not None:
+			start = entry[0]
+			state.restore(entry[2])
+
+	with open(path, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		end = _next_line_start(f, min(filepos, size), size)
+		for buf, base, lo, hi in _regions(f, start, end):
+			for match in _COMMAND_LINE_REGEX.finditer(buf, lo, hi):
+				gcode = _command(match.group(1))
+				if gcode not in TRACKED_COMMANDS:
+					continue
+				try:
+					state.apply(gcode, match.group(0).decode("ascii", "ignore"))
+				except ValueError:
+					pass
+	return state
+
+
+class LayerIndexCache(object):
+	"""Layer indexes stored as JSON files in a folder, one per G-code file.
+
+	The file name is derived from the G-code file's path, the index is valid as long as the G-code file's
+	size and modification time match.
+
+	Args:
+		folder (str): Cache folder.
+	"""
+
+	def __init__(self, folder):
+		self.folder = folder
+
+	def _file_for(self, path):
+		digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+		return os.path.join(self.folder, digest + ".json")
+
+	def load(self, path):
+		"""Load the index of a G-code file.
+
+		Returns:
+			LayerIndex: The index, None if there is none or it is outdated.
+		"""
+		try:
+			with open(self._file_for(path)) as f:
+				index = LayerIndex.from_dict(json.load(f))
+		except (IOError, OSError, ValueError):
+			return None
+		if index.path != path or not index.matches(path):
+			return None
+		return index
+
+	def save(self, index):
+		"""Store an index, replacing the file atomically."""
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		target = self._file_for(index.path)
+		temp = target + ".tmp"
+		with open(temp, "w") as f:
+			json.dump(index.to_dict(), f, separators=(",", ":"))
+		os.rename(temp, target)
+
+	def delete(self, path):
+		"""Remove the index of a G-code file."""
+		try:
+			os.remove(self._file_for(path))
+		except OSError:
+			pass
+
+
+class LayerIndexer(object):
+	"""Background thread building layer indexes for G-code files.
+
+	Files are queued by :meth:`request`, a file already queued is not queued twice. The index of the most
+	recently used file is kept in memory.
+
+	Args:
+		cache (LayerIndexCache): Where built indexes are stored.
+		logger (logging.Logger): Logger for build errors.
+		processes (int): Worker processes, see :func:`build_layer_index`.
+	"""
+
+	def __init__(self, cache, logger, processes=1):
+		self.cache = cache
+		self.processes = processes
+		self._logger = logger
+		self._cond = threading.Condition()
+		self._queue = []
+		self._running = False
+		self._thread = None
+		self._current = None
+
+	def start(self):
+		"""Start the indexer thread."""
+		with self._cond:
+			if self._running:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._run, name="PrintRestoreLayerIndexer")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, timeout=None):
+		"""Stop the indexer thread. An index being built is finished first.
+
+		Args:
+			timeout (float, optional): Seconds to wait for the thread to finish.
+		"""
+		with self._cond:
+			self._running = False
+			del self._queue[:]
+			self._cond.notify_all()
+		if self._thread is not None:
+			self._thread.join(timeout)
+
+	def request(self, path):
+		"""Queue a G-code file for indexing unless a valid index exists.
+
+		Args:
+			path (str): Path of the G-code file.
+		"""
+		with self._cond:
+			if path in self._queue:
+				return
+			current = self._current
+			if current is not None and current.path == path and current.matches(path):
+				return
+			self._queue.append(path)
+			self._cond.notify_all()
+
+	def get(self, path):
+		"""Get the index of a G-code file if one was built.
+
+		Args:
+			path (str): Path of the G-code file.
+
+		Returns:
+			LayerIndex: The index, None if there is no valid one.
+		"""
+		current = self._current
+		if current is not None and current.path == path and current.matches(path):
+			return current
+		index = self.cache.load(path)
+		if index is not None:
+			self._current = index
+		return index
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._queue and self._running:
+					self._cond.wait()
+				if not self._running:
+					return
+				path = self._queue.pop(0)
+
+			try:
+				if self.get(path) is not None:
+					continue
+				index = build_layer_index(path, processes=self.processes)
+				self.cache.save(index)
+				self._current = index
+				self._logger.info("Indexed {} layers of {}".format(len(index), path))
+			except Exception as e:
+				self._logger.error("Could not build layer index of {}\n{}".format(path, str(e)))
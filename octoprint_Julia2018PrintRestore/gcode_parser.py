@@ -0,0 +1,124 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re
+
+# One word is a parameter letter followed by a number, e.g. "X10.5", "x 10", "E-.8".
+# The command word itself ("G1", "M106") is never matched since G/M are not parameter letters.
+_WORD_PATTERN = r"([XYZEFSTRxyzefstr])[ \t]*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))"
+_WORD_REGEX = re.compile(_WORD_PATTERN)
+
+# Upper case lookup for the parameter letters. Avoids calling str.upper() for every word.
+_LETTERS = dict((c, c.upper()) for c in "XYZEFSTRxyzefstr")
+
+
+# A command in the form OctoPrint sends, e.g. "M104 S200 T1", parameter words in any order with one space before each.
+# Only the number text is captured. It is at most 32 digits, signs and dots, so float() either rejects it
+# or returns a finite value. A repeated word keeps its last value.
+_NUMBER = r"([-+.0-9]{1,32})"
+_COMMAND_WORDS_REGEX = re.compile(r"[GMgm][0-9]+(?: (?:X{0}|Y{0}|Z{0}|E{0}|F{0}|S{0}|T{0}|R{0}))*$".format(_NUMBER))
+
+
+def parse_words(cmd):
+	"""Tokenize a G-code command into its numeric parameter words in a single pass.
+
+	A single match of a precompiled regular expression picks the number text of each word out of the command,
+	which goes straight to float. Other forms, lower case, glued ("G1X10Y10"), spaced ("X 10") or followed by a
+	";" comment, are scanned word by word by a second expression that stops at the comment instead of slicing it off.
+
+	Args:
+		cmd (str): Command to be sent to the printer.
+
+	Returns:
+		dict: Parameter letter (upper case) mapped to its float value, e.g. {"X": 10.0, "E": 2.5}.
+	"""
+	match = _COMMAND_WORDS_REGEX.match(cmd)
+	if match is not None:
+		x, y, z, e, f, s, t, r = match.groups()
+		words = {}
+		try:
+			if x is not None:
+				words["X"] = float(x)
+			if y is not None:
+				words["Y"] = float(y)
+			if z is not None:
+				words["Z"] = float(z)
+			if e is not None:
+				words["E"] = float(e)
+			if f is not None:
+				words["F"] = float(f)
+			if s is not None:
+				words["S"] = float(s)
+			if t is not None:
+				words["T"] = float(t)
+			if r is not None:
+				words["R"] = float(r)
+			return words
+		except ValueError:
+			pass  # digits and dots that are not a number, e.g. "X1.2.3"
+	end = cmd.find(";")
+	if end < 0:
+		end = len(cmd)
+	words = {}
+	letters = _LETTERS
+	for letter, value in _WORD_REGEX.findall(cmd, 0, end):
+		words[letters[letter]] = float(value)
+	return words
+
+
+# A plain G0/G1 move, e.g. "G1 X10.5 Y20 E0.8", the same way as _COMMAND_WORDS_REGEX but axis words only.
+# The feedrate has no sign, so it cannot be negative.
+_MOVE_REGEX = re.compile(r"G0?[01](?: (?:X{0}|Y{0}|Z{0}|E{0}|F([.0-9]{{1,32}})))*$".format(_NUMBER))
+
+
+def parse_move(cmd):
+	"""Parse the axis words of a G0/G1 move. This is the hot path of the sent hook.
+
+	Like :func:`parse_words`, but a single match of a precompiled regular expression picks the values out of
+	the line and they go straight into a tuple, without building a dict. Forms the expression does not cover
+	(lower case, glued words, comments) are handed to :func:`parse_words`.
+
+	Args:
+		cmd (str): Move command.
+
+	Returns:
+		tuple: (x, y, z, e, f) finite float values, None for the axes the command does not carry.
+
+	Raises:
+		ValueError: If a value is not a finite number.
+	"""
+	match = _MOVE_REGEX.match(cmd)
+	if match is not None:
+		x, y, z, e, f = match.groups()
+		try:
+			return (x if x is None else float(x), y if y is None else float(y), z if z is None else float(z),
+					e if e is None else float(e), f if f is None else float(f))
+		except ValueError:
+			pass  # digits and dots that are not a number, e.g. "X1.2.3"
+	words = parse_words(cmd)
+	x, y, z, e, f = words.get("X"), words.get("Y"), words.get("Z"), words.get("E"), words.get("F")
+	if (x is not None and x - x) or (y is not None and y - y) or (z is not None and z - z) \
+			or (e is not None and e - e) or (f is not None and f - f):  # NaN or infinity
+		raise ValueError("Invalid move: X={} Y={} Z={} E={} F={}".format(x, y, z, e, f))
+	return x, y, z, e, f
+
+
+_COMMAND_REGEX = re.compile(r"\s*([GMTgmt])([0-9]+)")
+
+
+def command_for_line(line):
+	"""Find the command of a G-code file line, the way OctoPrint reports it to the sent hook.
+
+	Args:
+		line (str): Line of a G-code file, may include a comment.
+
+	Returns:
+		str: Command, e.g. "G1" or "M104", "T" for tool changes. None for comments, blank and unknown lines.
+	"""
+	match = _COMMAND_REGEX.match(line)
+	if match is None:
+		return None
+	letter = match.group(1).upper()
+	if letter == "T":
+		return "T"
+	return letter + match.group(2)
@@ -0,0 +1,51 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from octoprint.printer import PrinterCallback
+
+
+class PrinterDataCache(PrinterCallback):
+	"""Local copy of the printer data a checkpoint needs, kept up to date by OctoPrint's callback pushes.
+
+	Reading ``get_current_data``/``get_current_temperatures`` copies OctoPrint's whole state under its locks.
+	The pushes carry the same data, so the checkpoint timer reads this cache instead. Each push replaces
+	an immutable record in a single assignment, readers always see a whole record.
+
+	Attributes:
+		job (tuple): (file name, file path, file position) of the current job, None until pushed.
+		temperatures (dict): {"tool0": (actual, target), "bed": (actual, target), ...}, empty until pushed.
+			Replaced as a whole, never modified.
+	"""
+
+	def __init__(self):
+		self.job = None
+		self.temperatures = {}
+
+	def set_job(self, name, path):
+		"""Set the job file before OctoPrint pushes it, e.g. from the PRINT_STARTED event payload."""
+		self.job = (name, path, None)
+
+	def target(self, heater):
+		"""Get the target temperature of a heater.
+
+		Args:
+			heater (str): e.g. "tool0" or "bed".
+
+		Returns:
+			float: Target temperature, None if not known.
+		"""
+		return self.temperatures.get(heater, (None, None))[1]
+
+	def on_printer_send_initial_data(self, data):
+		temps = data.get("temps")
+		if temps:
+			self.on_printer_add_temperature(temps[-1])
+
+	def on_printer_send_current_data(self, data):
+		job_file = (data.get("job") or {}).get("file") or {}
+		progress = data.get("progress") or {}
+		self.job = (job_file.get("name"), job_file.get("path"), progress.get("filepos"))
+
+	def on_printer_add_temperature(self, data):
+		self.temperatures = dict((heater, (values.get("actual"), values.get("target")))
+								 for heater, values in data.items() if isinstance(values, dict))
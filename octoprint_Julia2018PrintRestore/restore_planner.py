@@ -0,0 +1,349 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from .util import monotonic
+
+# Nozzle temperature at which a nozzle stuck in the print is soft enough to home without dislodging the print
+RELEASE_TEMPERATURE = 140.0
+# A heater is ready when it is at most this many degrees below its target
+TOOL_TOLERANCE = 2.0
+BED_TOLERANCE = 2.0
+# Seconds the heaters have to stay ready before the print is resumed
+SETTLE_TIME = 3.0
+POLL_INTERVAL = 1.0
+# Seconds a heater wait may take before the restore is given up
+WAIT_TIMEOUT = 1200.0
+# Assumed by estimates: seconds homing Z and X/Y takes, temperature of a heater that was not reported
+HOMING_TIME = 30.0
+AMBIENT_TEMPERATURE = 25.0
+
+# Step kinds
+COMMANDS = "commands"
+HOME = "home"
+WAIT = "wait"
+CALL = "call"
+
+# Restore job states
+PREPARING = "preparing"
+HEATING = "heating"
+HOMING = "homing"
+POSITIONING = "positioning"
+RESUMING = "resuming"
+DONE = "done"
+FAILED = "failed"
+
+Step = namedtuple("Step", ["kind", "value", "description", "state"])
+Step.__doc__ = """One restore step.
+
+``value`` is a command list (COMMANDS), axes (HOME), a :class:`HeaterWait` (WAIT) or a callable (CALL).
+``state`` is the job state while the step runs, e.g. HEATING.
+"""
+
+HeaterWait = namedtuple("HeaterWait", ["windows", "settle", "timeout"])
+HeaterWait.__doc__ = """Wait until every heater is in its window.
+
+``windows`` maps a heater to (low, high), high may be None. The heaters must stay in their windows for
+``settle`` seconds, the wait fails after ``timeout`` seconds.
+"""
+
+RestoreProgress = namedtuple("RestoreProgress", ["job_id", "state", "step", "steps_done", "steps_total", "file_name",
+												 "error", "started", "finished"])
+RestoreProgress.__doc__ = """Progress of a restore job, replaced as a whole on every change.
+
+``step`` is the description of the running step, ``steps_total`` is 0 until the steps were planned.
+``error`` is set when the job failed. ``started`` and ``finished`` are wall clock times, ``finished``
+is None while the job runs.
+"""
+
+_TARGET_KEYS = (("tool0", "tool0Target"), ("tool1", "tool1Target"), ("bed", "bedTarget"))
+
+
+class RestoreError(Exception):
+	"""A restore step failed or the restore was cancelled."""
+
+
+def heater_targets(data):
+	"""Get the heaters to bring up to temperature for a restore.
+
+	Args:
+		data (dict): Restore data.
+
+	Returns:
+		dict: e.g. {"tool0": 210.0, "bed": 60.0}. Heaters without a positive target are left out.
+	"""
+	targets = {}
+	for heater, key in _TARGET_KEYS:
+		value = data.get(key)
+		if value is not None and float(value) > 0:
+			targets[heater] = float(value)
+	return targets
+
+
+def set_temperature_command(heater, target):
+	"""Non-blocking G-code setting a heater target, e.g. "M104 T1 S210.0" or "M140 S60.0"."""
+	if heater == "bed":
+		return "M140 S{}".format(float(target))
+	return "M104 T{} S{}".format(int(heater[4:]), float(target))
+
+
+def preheat_targets(targets, release_temperature=RELEASE_TEMPERATURE):
+	"""Hold temperatures for heating up ahead of a restore that was not confirmed yet.
+
+	The bed, which takes longest, is brought to its target. Nozzles are held at the release temperature,
+	hot enough to home right away but cool enough not to ooze or degrade the filament while waiting.
+
+	Args:
+		targets (dict): Heater targets, see :func:`heater_targets`.
+		release_temperature (float, optional): Nozzle hold temperature.
+
+	Returns:
+		dict: Hold temperature per heater.
+	"""
+	return dict((heater, target if heater == "bed" else min(release_temperature, target))
+				for heater, target in targets.items())
+
+
+def plan_heat_up(targets, release_temperature=RELEASE_TEMPERATURE):
+	"""Plan heating and homing before a restored print is resumed.
+
+	All heaters are set to their final targets at once. Homing starts as soon as the nozzles passed the
+	release temperature and runs while the heaters keep ramping. The waits poll the reported temperatures
+	instead of sending M109/M190, which would block the firmware and serialize everything behind them.
+	A heater above its target is not waited for, like M109 S and M190 S.
+
+	Args:
+		targets (dict): Heater targets, see :func:`heater_targets`.
+		release_temperature (float, optional): Nozzle temperature required for homing.
+
+	Returns:
+		list: :class:`Step` list.
+	"""
+	heaters = sorted(targets)
+	steps = [Step(COMMANDS, [set_temperature_command(heater, targets[heater]) for heater in heaters],
+				  "start heaters", HEATING)]
+	release = dict((heater, (min(release_temperature, targets[heater]) - TOOL_TOLERANCE, None))
+				   for heater in heaters if heater != "bed")
+	if release:
+		steps.append(Step(WAIT, HeaterWait(release, 0.0, WAIT_TIMEOUT), "wait for nozzles to soften", HEATING))
+	steps.append(Step(COMMANDS, ["T0"], "select first tool", HOMING))
+	steps.append(Step(HOME, ["z"], "home Z", HOMING))
+	steps.append(Step(HOME, ["x", "y"], "home X/Y", HOMING))
+	if heaters:
+		ready = dict((heater, (targets[heater] - (BED_TOLERANCE if heater == "bed" else TOOL_TOLERANCE), None))
+					 for heater in heaters)
+		steps.append(Step(WAIT, HeaterWait(ready, SETTLE_TIME, WAIT_TIMEOUT), "wait for heaters", HEATING))
+	return steps
+
+
+def estimate_heat_up(targets, temperatures, time_to, release_temperature=RELEASE_TEMPERATURE):
+	"""Estimate how long the steps of :func:`plan_heat_up` take until the job can be resumed.
+
+	Args:
+		targets (dict): Heater targets, see :func:`heater_targets`.
+		temperatures (dict): Current {heater: (actual, target)}.
+		time_to (callable): Called with (heater, start, target), returns the seconds to heat up on full power,
+			e.g. :meth:`thermal_model.ThermalModel.time_to`.
+		release_temperature (float, optional): Nozzle temperature required for homing.
+
+	Returns:
+		float: Seconds.
+	"""
+	if not targets:
+		return HOMING_TIME
+	release = ready = 0.0
+	for heater, target in targets.items():
+		start = temperatures.get(heater, (None, None))[0]
+		if start is None:
+			start = AMBIENT_TEMPERATURE
+		if heater == "bed":
+			tolerance = BED_TOLERANCE
+		else:
+			tolerance = TOOL_TOLERANCE
+			release = max(release, time_to(heater, start, min(release_temperature, target) - tolerance))
+		ready = max(ready, time_to(heater, start, target - tolerance))
+	return max(release + HOMING_TIME, ready) + SETTLE_TIME
+
+
+def progress_to_dict(progress):
+	"""Get the JSON representation of a :class:`RestoreProgress` sent to clients."""
+	return dict(jobId=progress.job_id, state=progress.state, step=progress.step, stepsDone=progress.steps_done,
+				stepsTotal=progress.steps_total, fileName=progress.file_name, error=progress.error,
+				started=progress.started, finished=progress.finished)
+
+
+def in_windows(temperatures, windows):
+	"""Check reported temperatures against heater windows.
+
+	Args:
+		temperatures (dict): {heater: (actual, target)}.
+		windows (dict): {heater: (low, high)}, high may be None.
+
+	Returns:
+		bool: True if every heater was reported and is inside its window.
+	"""
+	for heater, (low, high) in windows.items():
+		actual = temperatures.get(heater, (None, None))[0]
+		if actual is None or actual < low or (high is not None and actual > high):
+			return False
+	return True
+
+
+class RestoreRunner(object):
+	"""Runs restore jobs on a background thread.
+
+	Commands and homing are queued to the printer and return right away, heater waits poll the
+	temperatures, so the firmware keeps executing the queued moves while the heaters ramp.
+
+	Attributes:
+		progress (RestoreProgress): Progress of the running or last job, None before the first job.
+
+	Args:
+		printer (PrinterInterface): OctoPrint printer, only ``commands`` and ``home`` are used.
+		read_temperatures (callable): Returns the last reported {heater: (actual, target)}.
+		logger (logging.Logger): Logger for step progress and errors.
+		poll_interval (float, optional): Seconds between temperature checks.
+		clock (callable, optional): Monotonic clock in seconds.
+		sleep (callable, optional): Called with a number of seconds between polls. Defaults to waiting
+			on the cancellation, simulations pass their own.
+	"""
+
+	def __init__(self, printer, read_temperatures, logger, poll_interval=POLL_INTERVAL, clock=monotonic, sleep=None):
+		self._printer = printer
+		self._read_temperatures = read_temperatures
+		self._logger = logger
+		self._poll_interval = poll_interval
+		self._clock = clock
+		self._cancelled = threading.Event()
+		self._sleep = sleep if sleep is not None else self._cancelled.wait
+		self._start_lock = threading.Lock()
+		self._thread = None
+		self._on_progress = None
+		self.progress = None
+
+	def is_running(self):
+		"""Check if a restore is being run on the background thread."""
+		return self._thread is not None and self._thread.is_alive()
+
+	def start(self, plan, file_name=None, on_done=None, on_error=None, on_progress=None):
+		"""Start a restore job on a background thread.
+
+		Args:
+			plan (callable): Called on the background thread, returns the :class:`Step` list. Slow preparation
+				such as reconstructing the printer state from the G-code file belongs here.
+			file_name (str, optional): Job file to restore, reported in the progress.
+			on_done (callable, optional): Called without arguments when all steps were run.
+			on_error (callable, optional): Called with the exception when planning or a step failed.
+			on_progress (callable, optional): Called with the :class:`RestoreProgress` whenever the job
+				moves to another step or finishes.
+
+		Returns:
+			str: Job id.
+
+		Raises:
+			RestoreError: If a restore is already running.
+		"""
+		with self._start_lock:
+			if self.is_running():
+				raise RestoreError("A restore is already running")
+			self._cancelled.clear()
+			self._on_progress = on_progress
+			job_id = uuid.uuid4().hex
+			self._update(RestoreProgress(job_id, PREPARING, "prepare restore", 0, 0, file_name, None, time.time(), None))
+			self._thread = threading.Thread(target=self._run, args=(plan, on_done, on_error), name="PrintRestoreRunner")
+			self._thread.daemon = True
+			self._thread.start()
+		return job_id
+
+	def cancel(self, timeout=None):
+		"""Stop the running restore after the current step or poll.
+
+		Args:
+			timeout (float, optional): Seconds to wait for the thread to finish.
+		"""
+		self._cancelled.set()
+		if self._thread is not None and self._thread is not threading.current_thread():
+			self._thread.join(timeout)
+
+	def execute(self, steps):
+		"""Run the steps on the calling thread.
+
+		Raises:
+			RestoreError: If a wait timed out or the restore was cancelled.
+		"""
+		for done, step in enumerate(steps):
+			if self._cancelled.is_set():
+				raise RestoreError("Restore cancelled")
+			self._logger.info("Restore step: " + step.description)
+			if self.progress is not None:
+				self._update(self.progress._replace(state=step.state, step=step.description, steps_done=done))
+			if step.kind == COMMANDS:
+				self._printer.commands(step.value)
+			elif step.kind == HOME:
+				self._printer.home(step.value)
+			elif step.kind == WAIT:
+				self.wait(step.value)
+			elif step.kind == CALL:
+				step.value()
+			else:
+				raise RestoreError("Unknown restore step: {}".format(step.kind))
+
+	def wait(self, wait):
+		"""Poll the temperatures until the heaters settled in their windows.
+
+		Args:
+			wait (HeaterWait): Heater windows.
+
+		Raises:
+			RestoreError: If the heaters did not settle in time or the restore was cancelled.
+		"""
+		start = self._clock()
+		settled_since = None
+		while True:
+			now = self._clock()
+			if in_windows(self._read_temperatures(), wait.windows):
+				if settled_since is None:
+					settled_since = now
+				if now - settled_since >= wait.settle:
+					return
+			else:
+				settled_since = None
+			if now - start > wait.timeout:
+				raise RestoreError("Heaters did not reach {} within {:.0f}s".format(
+					", ".join("{} {:.1f}".format(heater, low) for heater, (low, _) in sorted(wait.windows.items())),
+					wait.timeout))
+			self._sleep(self._poll_interval)
+			if self._cancelled.is_set():
+				raise RestoreError("Restore cancelled")
+
+	def _update(self, progress):
+		self.progress = progress
+		if self._on_progress is not None:
+			try:
+				self._on_progress(progress)
+			except Exception as e:
+				self._logger.error("Could not report restore progress\n" + str(e))
+
+	def _run(self, plan, on_done, on_error):
+		try:
+			steps = plan()
+			# reported with the first step
+			self.progress = self.progress._replace(steps_total=len(steps))
+			self.execute(steps)
+		except Exception as e:
+			self._logger.error("Restore failed\n" + str(e))
+			try:
+				if on_error is not None:
+					on_error(e)
+			finally:
+				self._update(self.progress._replace(state=FAILED, error=str(e), finished=time.time()))
+			return
+		try:
+			if on_done is not None:
+				on_done()
+		finally:
+			self._update(self.progress._replace(state=DONE, step=None, steps_done=len(steps), finished=time.time()))
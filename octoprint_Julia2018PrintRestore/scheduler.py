@@ -0,0 +1,172 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import threading
+
+from .util import monotonic
+
+
+class PeriodicJob(object):
+	"""A function called every ``interval`` seconds by a :class:`Scheduler`.
+
+	Deadlines advance by exactly one interval from the previous deadline, so the time the function takes
+	does not make the schedule drift. If the function overran past the next deadline, the missed runs are
+	skipped and counted instead of being run back to back.
+
+	Args:
+		scheduler (Scheduler): Scheduler running the job.
+		interval (float): Delay interval in seconds.
+		function (object): The "function" to repeat
+		*args: Variable arguments for the "function"
+		**kwargs: Keyword arguments for the "function"
+	"""
+
+	repeat = True
+
+	def __init__(self, scheduler, interval, function, *args, **kwargs):
+		self._scheduler = scheduler
+		self.interval = interval
+		self.function = function
+		self.args = args
+		self.kwargs = kwargs
+		self.is_running = False
+		self.skipped = 0
+		# incremented on every start/stop, heap entries of an older generation are ignored
+		self._generation = 0
+
+	def start(self):
+		"""Schedule the first run one interval from now."""
+		self._scheduler._start_job(self)
+
+	def stop(self):
+		"""Stop running the job."""
+		self._scheduler._stop_job(self)
+
+
+class OneShotJob(PeriodicJob):
+	"""A function called once, ``interval`` seconds after the job was started.
+
+	Stopping the job before it ran cancels it, starting it again reschedules it from now.
+	"""
+
+	repeat = False
+
+
+class Scheduler(object):
+	"""Runs periodic jobs on a single thread using monotonic deadlines.
+
+	Args:
+		logger (logging.Logger): Logger for errors raised by jobs.
+	"""
+
+	def __init__(self, logger):
+		self._logger = logger
+		self._cond = threading.Condition()
+		self._queue = []
+		self._counter = itertools.count()
+		self._running = False
+		self._thread = None
+
+	def add_job(self, interval, function, *args, **kwargs):
+		"""Create a periodic job. It does not run until it is started.
+
+		Args:
+			interval (float): Delay interval in seconds.
+			function (object): The "function" to repeat
+
+		Returns:
+			PeriodicJob: The job.
+		"""
+		return PeriodicJob(self, interval, function, *args, **kwargs)
+
+	def add_one_shot_job(self, delay, function, *args, **kwargs):
+		"""Create a job running a function once. It does not run until it is started.
+
+		Args:
+			delay (float): Delay in seconds from the start of the job.
+			function (object): The "function" to run
+
+		Returns:
+			OneShotJob: The job.
+		"""
+		return OneShotJob(self, delay, function, *args, **kwargs)
+
+	def start(self):
+		"""Start the scheduler thread."""
+		with self._cond:
+			if self._running:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._run, name="PrintRestoreScheduler")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, timeout=None):
+		"""Stop the scheduler thread. Jobs are not run anymore, a job currently running is allowed to finish.
+
+		Args:
+			timeout (float, optional): Seconds to wait for the thread to finish.
+		"""
+		with self._cond:
+			self._running = False
+			self._cond.notify_all()
+		if self._thread is not None and self._thread is not threading.current_thread():
+			self._thread.join(timeout)
+
+	def _start_job(self, job):
+		if job.interval <= 0:
+			raise ValueError("Job interval must be positive: {}".format(job.interval))
+		with self._cond:
+			if job.is_running:
+				return
+			job.is_running = True
+			job._generation += 1
+			self._push(monotonic() + job.interval, job)
+
+	def _stop_job(self, job):
+		with self._cond:
+			if job.is_running:
+				job.is_running = False
+				job._generation += 1
+
+	def _push(self, deadline, job):
+		heapq.heappush(self._queue, (deadline, next(self._counter), job._generation, job))
+		self._cond.notify_all()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while True:
+					if not self._running:
+						return
+					# drop entries of stopped or restarted jobs
+					while self._queue and self._queue[0][2] != self._queue[0][3]._generation:
+						heapq.heappop(self._queue)
+					if not self._queue:
+						self._cond.wait()
+						continue
+					deadline = self._queue[0][0]
+					delay = deadline - monotonic()
+					if delay <= 0:
+						break
+					self._cond.wait(delay)
+				deadline, _, generation, job = heapq.heappop(self._queue)
+				if not job.repeat:
+					job.is_running = False
+
+			try:
+				job.function(*job.args, **job.kwargs)
+			except Exception:
+				self._logger.exception("Error in scheduled job {}".format(job.function))
+
+			with self._cond:
+				if job.is_running and job._generation == generation:
+					next_deadline = deadline + job.interval
+					now = monotonic()
+					if next_deadline <= now:
+						missed = int((now - deadline) // job.interval)
+						job.skipped += missed
+						next_deadline = deadline + (missed + 1) * job.interval
+					self._push(next_deadline, job)
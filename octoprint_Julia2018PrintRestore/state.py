@@ -0,0 +1,456 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import math
+import time
+
+from .gcode_parser import parse_move, parse_words
+
+# Order of the fields in a PrinterState snapshot tuple.
+FIELDS = ("x", "y", "z", "e", "f", "fan", "tool", "babystep", "feed_multiplier", "flow_multiplier",
+		  "offset_x", "offset_y", "offset_z", "relative", "relative_e", "units",
+		  "tool0_target", "tool1_target", "bed_target")
+(X, Y, Z, E, F, FAN, TOOL, BABYSTEP, FEED_MULTIPLIER, FLOW_MULTIPLIER,
+ OFFSET_X, OFFSET_Y, OFFSET_Z, RELATIVE, RELATIVE_E, UNITS,
+ TOOL0_TARGET, TOOL1_TARGET, BED_TARGET) = range(len(FIELDS))
+
+# Fields a restore checkpoint saves, the leading fields of a snapshot. Heater targets come from OctoPrint.
+CHECKPOINT_FIELDS = FIELDS[:TOOL0_TARGET]
+
+# Restore file "position" keys for the snapshot fields that are saved inside the position.
+_POSITION_KEYS = ((X, "X"), (Y, "Y"), (Z, "Z"), (E, "E"), (F, "F"), (FAN, "FAN"), (TOOL, "T"),
+				  (FEED_MULTIPLIER, "FEED"), (FLOW_MULTIPLIER, "FLOW"),
+				  (OFFSET_X, "OFFSET_X"), (OFFSET_Y, "OFFSET_Y"), (OFFSET_Z, "OFFSET_Z"),
+				  (RELATIVE, "RELATIVE"), (RELATIVE_E, "RELATIVE_E"), (UNITS, "UNITS"))
+
+MM_PER_INCH = 25.4
+
+# Move commands, G00/G01 being the zero padded forms some slicers emit
+_MOVE_COMMANDS = frozenset(("G0", "G1", "G00", "G01"))
+
+
+def _finite(value, name):
+	"""Convert a value to float and reject NaN/infinity.
+
+	Raises:
+		ValueError: If the value is not a finite number.
+	"""
+	value = float(value)
+	if math.isnan(value) or math.isinf(value):
+		raise ValueError("Invalid {} value: {}".format(name, value))
+	return value
+
+
+class PrinterState(object):
+	"""Last known state of the printer, kept as validated floats.
+
+	Updated in place by the G-code sent hook. Values are checked when they arrive so that corrupt data
+	is rejected at print time rather than discovered when restoring. A field is None until it was first seen.
+
+	:meth:`apply` is the single writer and never waits: it makes ``sequence`` odd while it updates the fields
+	and even again when done. Other threads read with :meth:`read_snapshot`, which retries a copy that
+	overlapped an update instead of locking (seqlock).
+
+	Works as a motion state machine following G90/G91, M82/M83, G92, G28 and G20/G21:
+	X/Y/Z are absolute machine coordinates in mm, offset_* is the G92 shift (machine minus logical),
+	E is the logical extruder position in mm and F is in mm/min.
+	"""
+
+	__slots__ = FIELDS + ("sequence",)
+
+	def __init__(self):
+		self.sequence = 0
+		self.babystep = 0.0
+		self.reset()
+
+	def reset(self):
+		"""Forget the tracked position, fan, tool and multipliers. Babystep is kept as it persists across prints."""
+		self.x = None
+		self.y = None
+		self.z = None
+		self.e = None
+		self.f = None
+		self.fan = None
+		self.tool = None
+		self.feed_multiplier = 100.0
+		self.flow_multiplier = 100.0
+		self.offset_x = 0.0
+		self.offset_y = 0.0
+		self.offset_z = 0.0
+		self.relative = False
+		self.relative_e = False
+		self.units = 1.0
+		self.tool0_target = None
+		self.tool1_target = None
+		self.bed_target = None
+
+	def apply(self, gcode, cmd):
+		"""Update the state from a command sent to the printer or read from a G-code file.
+
+		Commands that do not change the tracked state return right away, without parsing the command.
+		G0/G1 moves, nearly every line of a print, skip the handler lookup.
+
+		Args:
+			gcode (str): Parsed GCODE command, e.g. "G1" or "T". None if no known command could be parsed.
+			cmd (str): The full command.
+
+		Raises:
+			ValueError: If the command carries an invalid value.
+		"""
+		if gcode in _MOVE_COMMANDS:
+			x, y, z, e, f = parse_move(cmd)  # values are finite
+			if f is not None and f <= 0:
+				raise ValueError("Invalid feedrate: {}".format(f))
+			self.sequence += 1
+			self._move(x, y, z, e, f)
+			self.sequence += 1
+			return
+		handler = _HANDLERS.get(gcode)
+		if handler is None:
+			return
+		self.sequence += 1
+		try:
+			handler(self, cmd)
+		finally:
+			self.sequence += 1
+
+	def _apply_set_position(self, cmd):
+		self.set_position(parse_words(cmd))
+
+	def _apply_home(self, cmd):
+		self.home(parse_words(cmd))
+
+	def _apply_absolute(self, cmd):
+		self.set_relative(False)
+
+	def _apply_relative(self, cmd):
+		self.set_relative(True)
+
+	def _apply_absolute_e(self, cmd):
+		self.set_relative_e(False)
+
+	def _apply_relative_e(self, cmd):
+		self.set_relative_e(True)
+
+	def _apply_inches(self, cmd):
+		self.set_inches(True)
+
+	def _apply_millimeters(self, cmd):
+		self.set_inches(False)
+
+	def _apply_fan(self, cmd):
+		words = parse_words(cmd)
+		if "S" in words:
+			self.set_fan(words["S"])
+
+	def _apply_fan_off(self, cmd):
+		self.set_fan(0)
+
+	def _apply_babystep(self, cmd):
+		words = parse_words(cmd)
+		if "Z" in words:
+			self.add_babystep(words["Z"])
+
+	def _apply_feed_multiplier(self, cmd):
+		words = parse_words(cmd)
+		if "S" in words:
+			self.set_feed_multiplier(words["S"])
+
+	def _apply_flow_multiplier(self, cmd):
+		words = parse_words(cmd)
+		if "S" in words:
+			self.set_flow_multiplier(words["S"])
+
+	def _apply_tool_target(self, cmd):
+		words = parse_words(cmd)
+		target = words.get("S", words.get("R"))
+		if target is not None:
+			self.set_tool_target(words.get("T", self.tool or 0), target)
+
+	def _apply_bed_target(self, cmd):
+		words = parse_words(cmd)
+		target = words.get("S", words.get("R"))
+		if target is not None:
+			self.set_bed_target(target)
+
+	def _apply_tool(self, cmd):
+		words = parse_words(cmd)
+		if "T" in words:
+			self.set_tool(words["T"])
+
+	def move(self, words):
+		"""Apply a G0/G1 move.
+
+		Args:
+			words (dict): Parsed float words, see :func:`gcode_parser.parse_words`.
+
+		Raises:
+			ValueError: If any of the values is not finite or the feedrate is not positive.
+		"""
+		self.move_to(words.get("X"), words.get("Y"), words.get("Z"), words.get("E"), words.get("F"))
+
+	def move_to(self, x, y, z, e, f):
+		"""Apply a G0/G1 move given its axis values, None for an axis the move does not carry.
+
+		Raises:
+			ValueError: If any of the values is not finite or the feedrate is not positive.
+		"""
+		# validate everything first so a bad move never leaves a half updated position
+		if (x is not None and x - x) or (y is not None and y - y) or (z is not None and z - z) \
+				or (e is not None and e - e) or (f is not None and f - f):  # NaN or infinity
+			raise ValueError("Invalid move: X={} Y={} Z={} E={} F={}".format(x, y, z, e, f))
+		if f is not None and f <= 0:
+			raise ValueError("Invalid feedrate: {}".format(f))
+		self._move(x, y, z, e, f)
+
+	def _move(self, x, y, z, e, f):
+		"""Apply a move whose values were already validated."""
+		units = self.units
+		if f is not None:
+			self.f = f * units
+		if self.relative:
+			if x is not None and self.x is not None:
+				self.x += x * units
+			if y is not None and self.y is not None:
+				self.y += y * units
+			if z is not None and self.z is not None:
+				self.z += z * units
+		else:
+			if x is not None:
+				self.x = x * units + self.offset_x
+			if y is not None:
+				self.y = y * units + self.offset_y
+			if z is not None:
+				self.z = z * units + self.offset_z
+		if e is not None:
+			if self.relative_e:
+				self.e = (self.e or 0.0) + e * units
+			else:
+				self.e = e * units
+
+	def set_position(self, words):
+		"""Apply G92: redefine the logical position without moving. No words resets all axes to zero.
+
+		Raises:
+			ValueError: If any of the values is not finite.
+		"""
+		if not any(axis in words for axis in "XYZE"):
+			words = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+		units = self.units
+		x = _finite(words["X"], "X") * units if "X" in words else None
+		y = _finite(words["Y"], "Y") * units if "Y" in words else None
+		z = _finite(words["Z"], "Z") * units if "Z" in words else None
+		if "E" in words:
+			self.e = _finite(words["E"], "E") * units
+		# an unknown machine position is assumed to be unshifted
+		if x is not None:
+			if self.x is None:
+				self.x = x + self.offset_x
+			self.offset_x = self.x - x
+		if y is not None:
+			if self.y is None:
+				self.y = y + self.offset_y
+			self.offset_y = self.y - y
+		if z is not None:
+			if self.z is None:
+				self.z = z + self.offset_z
+			self.offset_z = self.z - z
+
+	def home(self, words):
+		"""Apply G28: homed axes are at machine zero and lose their G92 offset. No axis words homes all axes."""
+		home_all = not ("X" in words or "Y" in words or "Z" in words)
+		if home_all or "X" in words:
+			self.x = 0.0
+			self.offset_x = 0.0
+		if home_all or "Y" in words:
+			self.y = 0.0
+			self.offset_y = 0.0
+		if home_all or "Z" in words:
+			self.z = 0.0
+			self.offset_z = 0.0
+
+	def set_relative(self, relative):
+		"""Apply G90 (False) or G91 (True). Also switches the extruder mode, like Marlin does."""
+		self.relative = relative
+		self.relative_e = relative
+
+	def set_relative_e(self, relative):
+		"""Apply M82 (False) or M83 (True)."""
+		self.relative_e = relative
+
+	def set_inches(self, inches):
+		"""Apply G20 (True) or G21 (False)."""
+		self.units = MM_PER_INCH if inches else 1.0
+
+	def set_fan(self, value):
+		"""Set part cooling fan speed (0-255)."""
+		value = _finite(value, "fan")
+		if not 0 <= value <= 255:
+			raise ValueError("Invalid fan speed: {}".format(value))
+		self.fan = value
+
+	def set_tool(self, value):
+		"""Set active tool index."""
+		value = _finite(value, "tool")
+		if value < 0 or value != int(value):
+			raise ValueError("Invalid tool: {}".format(value))
+		self.tool = int(value)
+
+	def set_tool_target(self, tool, value):
+		"""Set a hotend target temperature (M104/M109)."""
+		value = _finite(value, "temperature")
+		if value < 0:
+			raise ValueError("Invalid temperature: {}".format(value))
+		if tool == 0:
+			self.tool0_target = value
+		elif tool == 1:
+			self.tool1_target = value
+
+	def set_bed_target(self, value):
+		"""Set the bed target temperature (M140/M190)."""
+		value = _finite(value, "temperature")
+		if value < 0:
+			raise ValueError("Invalid temperature: {}".format(value))
+		self.bed_target = value
+
+	def add_babystep(self, value):
+		"""Accumulate a babystep Z offset (M290)."""
+		self.babystep = self.babystep + _finite(value, "babystep")
+
+	def set_feed_multiplier(self, value):
+		"""Set feedrate multiplier in percent (M220)."""
+		value = _finite(value, "feed multiplier")
+		if value <= 0:
+			raise ValueError("Invalid feed multiplier: {}".format(value))
+		self.feed_multiplier = value
+
+	def set_flow_multiplier(self, value):
+		"""Set flow multiplier in percent (M221)."""
+		value = _finite(value, "flow multiplier")
+		if value <= 0:
+			raise ValueError("Invalid flow multiplier: {}".format(value))
+		self.flow_multiplier = value
+
+	def snapshot(self):
+		"""Take an immutable copy of the state.
+
+		Returns:
+			tuple: Field values in the order of :data:`FIELDS`.
+		"""
+		return (self.x, self.y, self.z, self.e, self.f, self.fan, self.tool,
+				self.babystep, self.feed_multiplier, self.flow_multiplier,
+				self.offset_x, self.offset_y, self.offset_z, self.relative, self.relative_e, self.units,
+				self.tool0_target, self.tool1_target, self.bed_target)
+
+	def read_snapshot(self):
+		"""Take a consistent snapshot while another thread may be calling :meth:`apply`.
+
+		Never blocks the writer. A copy taken while an update was in progress is discarded and taken again
+		after yielding to the writer.
+
+		Returns:
+			tuple: Field values in the order of :data:`FIELDS`.
+		"""
+		while True:
+			sequence = self.sequence
+			if not sequence & 1:
+				snapshot = self.snapshot()
+				if self.sequence == sequence:
+					return snapshot
+			time.sleep(0)
+
+	def checkpoint_into(self, target):
+		"""Copy the :data:`CHECKPOINT_FIELDS` into a preallocated list, like :meth:`snapshot` but without allocating.
+
+		Args:
+			target (list): List of ``len(CHECKPOINT_FIELDS)`` items, overwritten in place.
+		"""
+		target[X] = self.x
+		target[Y] = self.y
+		target[Z] = self.z
+		target[E] = self.e
+		target[F] = self.f
+		target[FAN] = self.fan
+		target[TOOL] = self.tool
+		target[BABYSTEP] = self.babystep
+		target[FEED_MULTIPLIER] = self.feed_multiplier
+		target[FLOW_MULTIPLIER] = self.flow_multiplier
+		target[OFFSET_X] = self.offset_x
+		target[OFFSET_Y] = self.offset_y
+		target[OFFSET_Z] = self.offset_z
+		target[RELATIVE] = self.relative
+		target[RELATIVE_E] = self.relative_e
+		target[UNITS] = self.units
+
+	def restore(self, snapshot):
+		"""Set all fields from a snapshot.
+
+		Args:
+			snapshot (tuple or list): As returned by :meth:`snapshot`.
+		"""
+		for name, value in zip(FIELDS, snapshot):
+			setattr(self, name, value)
+
+
+# Handler of each command that changes the tracked state, besides the moves handled by PrinterState.apply itself
+_HANDLERS = {"G92": PrinterState._apply_set_position, "G28": PrinterState._apply_home,
+			 "G90": PrinterState._apply_absolute, "G91": PrinterState._apply_relative,
+			 "M82": PrinterState._apply_absolute_e, "M83": PrinterState._apply_relative_e,
+			 "G20": PrinterState._apply_inches, "G21": PrinterState._apply_millimeters,
+			 "M106": PrinterState._apply_fan, "M107": PrinterState._apply_fan_off,
+			 "M290": PrinterState._apply_babystep,
+			 "M220": PrinterState._apply_feed_multiplier, "M221": PrinterState._apply_flow_multiplier,
+			 "M104": PrinterState._apply_tool_target, "M109": PrinterState._apply_tool_target,
+			 "M140": PrinterState._apply_bed_target, "M190": PrinterState._apply_bed_target,
+			 "T": PrinterState._apply_tool}
+
+# Commands PrinterState.apply does not ignore
+TRACKED_COMMANDS = _MOVE_COMMANDS.union(_HANDLERS)
+
+
+def position_from_snapshot(snapshot):
+	"""Convert a snapshot to the restore file "position" dict. Fields that were never seen are left out.
+
+	Args:
+		snapshot (tuple): As returned by :meth:`PrinterState.snapshot`, or its :data:`CHECKPOINT_FIELDS` only.
+
+	Returns:
+		dict: e.g. {"X": 10.0, "Y": 20.0, "Z": 0.2, "E": 3.1, "F": 1800.0, "T": 0}
+	"""
+	position = {}
+	for index, key in _POSITION_KEYS:
+		value = snapshot[index]
+		if value is not None:
+			position[key] = value
+	return position
+
+
+def snapshot_from_position(position, babystep=0.0):
+	"""Convert a restore file "position" dict back to a snapshot, the inverse of :func:`position_from_snapshot`.
+
+	Fields left out of the position get the values of a fresh :class:`PrinterState`.
+
+	Args:
+		position (dict): Restore file "position", values may be strings in files of older versions.
+		babystep (float, optional): Babystep Z offset.
+
+	Returns:
+		tuple: Field values in the order of :data:`FIELDS`.
+
+	Raises:
+		ValueError: If a value is not a finite number.
+	"""
+	state = PrinterState()
+	state.babystep = _finite(babystep, "babystep")
+	values = list(state.snapshot())
+	for index, key in _POSITION_KEYS:
+		value = position.get(key)
+		if value is None:
+			continue
+		if index == RELATIVE or index == RELATIVE_E:
+			values[index] = bool(value)
+		elif index == TOOL:
+			values[index] = int(_finite(value, key))
+		else:
+			values[index] = _finite(value, key)
+	return tuple(values)
@@ -0,0 +1,457 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _encode(data):
+	# \u escapes keep the payload ASCII, Python 2 byte-str file names would fail to decode otherwise
+	return json.dumps(data, separators=(",", ":"), ensure_ascii=True).encode("ascii")
+
+
+def _decode(payload):
+	return json.loads(payload.decode("utf-8"))
+
+
+# Binary record header: magic, sequence number, payload length, crc32 of (sequence number, payload length, payload)
+_HEADER = struct.Struct("<4sQII")
+
+
+def _pack_record(magic, seq, payload):
+	crc = zlib.crc32(struct.pack("<QI", seq, len(payload)) + payload) & 0xffffffff
+	return _HEADER.pack(magic, seq, len(payload), crc) + payload
+
+
+def _unpack_record(magic, buf, offset, size):
+	"""Parse the record stored at ``buf[offset:offset + size]``.
+
+	Returns:
+		tuple: (seq, payload) of a valid record, None for an empty or torn one.
+	"""
+	record_magic, seq, length, crc = _HEADER.unpack_from(buf, offset)
+	if record_magic != magic or length > size - _HEADER.size:
+		return None
+	start = offset + _HEADER.size
+	payload = bytes(buf[start:start + length])
+	if zlib.crc32(struct.pack("<QI", seq, length) + payload) & 0xffffffff != crc:
+		return None
+	return seq, payload
+
+
+class JsonRestoreStorage(object):
+	"""Restore file stored as a JSON document, replaced atomically on every write.
+
+	Args:
+		path (str): Path of the restore file.
+	"""
+
+	name = "json"
+
+	def __init__(self, path):
+		self.path = path
+		self.temp_path = path + ".tmp"
+
+	def exists(self):
+		"""Check if the restore file exists."""
+		return os.path.isfile(self.path)
+
+	def write(self, data):
+		"""Write and commit restore data to disk.
+
+		Args:
+			data (dict): Restore data.
+		"""
+		with open(self.temp_path, 'w') as restoreFile:
+			json.dump(data, restoreFile)
+			restoreFile.flush()
+			os.fsync(restoreFile.fileno())
+		os.rename(self.temp_path, self.path)
+		# the rename itself is only durable once the directory is committed
+		fsync_directory(self.path)
+
+	def read(self):
+		"""Read restore data.
+
+		Returns:
+			dict: Restore data.
+
+		Raises:
+			IOError: If the file cannot be read.
+			ValueError: If the file does not contain valid JSON.
+		"""
+		with open(self.path) as f:
+			txt = f.read()
+		txt = txt.encode('ascii', 'ignore')
+		txt = txt.decode()
+		try:
+			return json.loads(txt)
+		except ValueError as e:
+			raise ValueError("Invalid JSON data in restore file: {}\n{}".format(txt, str(e)))
+
+	def delete(self):
+		"""Delete the restore file."""
+		os.remove(self.path)
+
+
+class JournalRestoreStorage(object):
+	"""Restore data kept in a preallocated, append-only binary journal.
+
+	The journal holds ``capacity`` fixed-size records. Each record carries a sequence number and a CRC32
+	of its content, so a record torn by a power cut is detected and recovery falls back to the previous one.
+	A checkpoint is one small write at the next record offset plus ``fdatasync``; no file is created or
+	renamed. When the journal is full, writing continues from the first record, which bounds the file size.
+
+	Restore data too large for a record, e.g. with a long non-ASCII file name, grows the journal: it is
+	rewritten with records of twice the size, up to :attr:`MAX_RECORD_SIZE`. The record size is taken from
+	the file size when a journal is opened, so a grown journal keeps its records. A journal of another
+	layout is compacted to its latest record on open. Both replace the file atomically.
+
+	Args:
+		path (str): Path of the journal file.
+		record_size (int): Smallest size of one record in bytes, including the header.
+		capacity (int): Number of records in the journal.
+	"""
+
+	name = "journal"
+
+	MAGIC = b"JPRJ"
+	MAX_RECORD_SIZE = 64 * 1024
+
+	def __init__(self, path, record_size=1024, capacity=64):
+		self.path = path
+		self.record_size = record_size
+		self.capacity = capacity
+		self._lock = threading.Lock()
+		self._file = None
+		self._seq = 0
+		self._slot = 0
+
+	def exists(self):
+		"""Check if the journal file exists."""
+		return os.path.isfile(self.path)
+
+	def write(self, data):
+		"""Append restore data to the journal and commit it to disk.
+
+		Args:
+			data (dict): Restore data.
+
+		Raises:
+			ValueError: If the data does not fit in a record of :attr:`MAX_RECORD_SIZE` bytes.
+		"""
+		payload = _encode(data)
+		with self._lock:
+			self._open()
+			if len(payload) > self.record_size - _HEADER.size:
+				self._grow(len(payload) + _HEADER.size)
+			seq = self._seq + 1
+			record = self._pack(seq, payload)
+			self._file.seek(self._slot * self.record_size)
+			self._file.write(record)
+			self._file.flush()
+			_fdatasync(self._file.fileno())
+			self._seq = seq
+			self._slot = (self._slot + 1) % self.capacity
+
+	def read(self):
+		"""Read the latest valid record.
+
+		Returns:
+			dict: Restore data, or None if the journal holds no valid record.
+		"""
+		with self._lock:
+			with open(self.path, "rb") as f:
+				latest = self._scan(f.read())[0]
+		return _decode(latest[1]) if latest is not None else None
+
+	def delete(self):
+		"""Delete the journal file."""
+		with self._lock:
+			self._close()
+			os.remove(self.path)
+
+	def close(self):
+		"""Close the journal file handle."""
+		with self._lock:
+			self._close()
+
+	def _pack(self, seq, payload):
+		record = _pack_record(self.MAGIC, seq, payload)
+		return record + b"\0" * (self.record_size - len(record))
+
+	def _record_size_of(self, length):
+		"""Record size of a journal file of ``length`` bytes, which may have been grown."""
+		if length and length % self.capacity == 0:
+			return max(self.record_size, length // self.capacity)
+		return self.record_size
+
+	def _scan(self, content):
+		"""Find the valid record with the highest sequence number.
+
+		Returns:
+			tuple: ((seq, payload) or None, slot index of that record or -1)
+		"""
+		latest = None
+		latest_slot = -1
+		record_size = self._record_size_of(len(content))
+		for slot in range(len(content) // record_size):
+			record = _unpack_record(self.MAGIC, content, slot * record_size, record_size)
+			if record is not None and (latest is None or record[0] > latest[0]):
+				latest = record
+				latest_slot = slot
+		return latest, latest_slot
+
+	def _open(self):
+		if self._file is not None:
+			return
+		latest = None
+		if os.path.isfile(self.path):
+			with open(self.path, "rb") as f:
+				content = f.read()
+			latest, slot = self._scan(content)
+			self.record_size = self._record_size_of(len(content))
+			if len(content) == self.record_size * self.capacity:
+				self._file = open(self.path, "r+b")
+				self._seq = latest[0] if latest is not None else 0
+				self._slot = (slot + 1) % self.capacity
+				return
+		self._create(latest)
+
+	def _create(self, latest):
+		"""Replace the journal with an empty one of the current layout, holding only the ``latest`` record.
+
+		Written next to the journal and renamed over it, a power cut leaves either the old or the new journal.
+		"""
+		temp_path = self.path + ".tmp"
+		with open(temp_path, "wb") as f:
+			f.write(b"\0" * (self.record_size * self.capacity))
+			if latest is not None:
+				f.seek(0)
+				f.write(self._pack(latest[0], latest[1]))
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(temp_path, self.path)
+		fsync_directory(self.path)
+		self._file = open(self.path, "r+b")
+		self._seq = latest[0] if latest is not None else 0
+		self._slot = 1 if latest is not None else 0
+
+	def _grow(self, size):
+		"""Rewrite the open journal with records of at least ``size`` bytes, keeping its latest record.
+
+		Raises:
+			ValueError: If the records would be larger than :attr:`MAX_RECORD_SIZE`.
+		"""
+		record_size = self.record_size
+		while record_size < size:
+			record_size *= 2
+		if record_size > self.MAX_RECORD_SIZE:
+			raise ValueError("Restore data of {} bytes does not fit a {} byte journal record".format(
+				size - _HEADER.size, self.MAX_RECORD_SIZE))
+		self._file.seek(0)
+		latest = self._scan(self._file.read())[0]
+		self._close()
+		self.record_size = record_size
+		self._create(latest)
+
+	def _close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+class MmapSlotRestoreStorage(object):
+	"""Restore data kept in two fixed-size slots of a memory mapped file.
+
+	Each write copies the record into the slot not holding the current checkpoint and flushes only that
+	slot with ``msync``. The record's generation number is written along with it, so the checkpoint
+	flips to the new slot once the flush completes. Reading takes the valid slot with the higher generation;
+	a slot torn by a power cut fails its CRC32 check and the other slot is used.
+
+	Args:
+		path (str): Path of the slot file.
+	"""
+
+	name = "mmap"
+
+	MAGIC = b"JPRM"
+	# one slot per page, flush offsets must be aligned to it
+	SLOT_SIZE = max(mmap.ALLOCATIONGRANULARITY, 4096)
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = None
+		self._map = None
+		self._generation = 0
+
+	def exists(self):
+		"""Check if the slot file exists."""
+		return os.path.isfile(self.path)
+
+	def write(self, data):
+		"""Write restore data to the inactive slot and flush it.
+
+		Args:
+			data (dict): Restore data.
+
+		Raises:
+			ValueError: If the data does not fit in one slot.
+		"""
+		payload = _encode(data)
+		if len(payload) > self.SLOT_SIZE - _HEADER.size:
+			raise ValueError("Restore data of {} bytes does not fit a {} byte slot".format(len(payload), self.SLOT_SIZE))
+		with self._lock:
+			self._open()
+			generation = self._generation + 1
+			offset = (generation % 2) * self.SLOT_SIZE
+			record = _pack_record(self.MAGIC, generation, payload)
+			self._map[offset:offset + len(record)] = record
+			self._map.flush(offset, self.SLOT_SIZE)
+			self._generation = generation
+
+	def read(self):
+		"""Read the slot with the higher valid generation.
+
+		Returns:
+			dict: Restore data, or None if no slot is valid.
+		"""
+		with self._lock:
+			with open(self.path, "rb") as f:
+				latest = self._latest(f.read())
+		return _decode(latest[1]) if latest is not None else None
+
+	def delete(self):
+		"""Delete the slot file."""
+		with self._lock:
+			self._close()
+			os.remove(self.path)
+
+	def close(self):
+		"""Unmap and close the slot file."""
+		with self._lock:
+			self._close()
+
+	def _latest(self, content):
+		latest = None
+		for offset in (0, self.SLOT_SIZE):
+			if len(content) < offset + self.SLOT_SIZE:
+				break
+			record = _unpack_record(self.MAGIC, content, offset, self.SLOT_SIZE)
+			if record is not None and (latest is None or record[0] > latest[0]):
+				latest = record
+		return latest
+
+	def _open(self):
+		if self._map is not None:
+			return
+		size = 2 * self.SLOT_SIZE
+		if not os.path.isfile(self.path) or os.path.getsize(self.path) != size:
+			latest = None
+			if os.path.isfile(self.path):
+				with open(self.path, "rb") as f:
+					latest = self._latest(f.read())
+			# built next to the slot file and renamed over it, a power cut leaves either the old or the new file
+			temp_path = self.path + ".tmp"
+			with open(temp_path, "wb") as f:
+				f.write(b"\0" * size)
+				if latest is not None:
+					f.seek((latest[0] % 2) * self.SLOT_SIZE)
+					f.write(_pack_record(self.MAGIC, latest[0], latest[1]))
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(temp_path, self.path)
+			fsync_directory(self.path)
+		self._file = open(self.path, "r+b")
+		self._map = mmap.mmap(self._file.fileno(), size)
+		latest = self._latest(self._map)
+		self._generation = latest[0] if latest is not None else 0
+
+	def _close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+def fsync_directory(path):
+	"""Commit the directory entry of a file to disk. Does nothing where directories cannot be opened (Windows)."""
+	try:
+		fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+
+def create_restore_storage(kind, path):
+	"""Create the restore data storage backend for a plugin setting value.
+
+	Args:
+		kind (str): "json", "journal" or "mmap".
+		path (str): Path of the JSON restore file. Other backends store their file next to it.
+
+	Returns:
+		object: Storage backend with exists/write/read/delete methods.
+	"""
+	base = os.path.splitext(path)[0]
+	if kind == JournalRestoreStorage.name:
+		return JournalRestoreStorage(base + ".journal")
+	if kind == MmapSlotRestoreStorage.name:
+		return MmapSlotRestoreStorage(base + ".slots")
+	return JsonRestoreStorage(path)
+
+
+def open_restore_storage(kind, path):
+	"""Create the restore data storage backend and take over a checkpoint another backend left behind.
+
+	Every backend keeps its own file, so after the storage setting changed a pending checkpoint of the previous
+	backend would be invisible, and become restorable again once the setting is switched back. The newest
+	checkpoint on disk is migrated into the returned backend and the files of all other backends are deleted.
+
+	Args:
+		kind (str): "json", "journal" or "mmap".
+		path (str): Path of the JSON restore file.
+
+	Returns:
+		tuple: (storage backend, path of the file a checkpoint was migrated from or None)
+	"""
+	storage = create_restore_storage(kind, path)
+	others = [create_restore_storage(other, path) for other in ("json", "journal", "mmap") if other != storage.name]
+	others = [other for other in others if other.exists()]
+	candidates = others + [storage] if storage.exists() else others
+	migrated = None
+	for candidate in sorted(candidates, key=lambda s: os.path.getmtime(s.path), reverse=True):
+		if candidate is storage:
+			break
+		try:
+			data = candidate.read()
+		except (IOError, OSError, ValueError):
+			continue
+		if data is not None:
+			try:
+				storage.write(data)
+			except (IOError, OSError, ValueError):
+				# keep the files, the checkpoint is lost otherwise
+				return storage, None
+			migrated = candidate.path
+			break
+	for other in others:
+		try:
+			other.delete()
+		except OSError:
+			pass
+	return storage, migrated
@@ -0,0 +1,186 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import math
+import os
+
+from octoprint.printer import PrinterCallback
+
+from .util import monotonic
+
+MODEL_VERSION = 1
+# Samples are only taken this far below the target, closer to it the firmware throttles the heater
+FULL_POWER_MARGIN = 10.0
+# Reports further apart than this are not used as a heating rate sample
+MAX_SAMPLE_GAP = 30.0
+# Weight kept by the older samples on every new one
+DECAY = 0.995
+# Samples and temperature spread needed before the fitted model is used
+MIN_SAMPLES = 10
+MIN_SPREAD = 10.0
+# Heating rates in degC/s used until enough samples were seen
+DEFAULT_RATES = {"tool": 2.0, "bed": 0.2}
+
+
+class HeaterModel(object):
+	"""Heating behaviour of one heater on full power, learned online from temperature reports.
+
+	On full power a heater follows dT/dt = k (T_max - T), the heating rate falls linearly with the temperature.
+	The model fits rate = a + b * T by least squares. Only decayed running sums are kept, so an update is O(1)
+	and older samples fade out as the printer changes. The sums are replaced as one tuple, readers on other
+	threads always see a consistent set.
+
+	Args:
+		default_rate (float): Heating rate in degC/s assumed until enough samples were seen.
+	"""
+
+	def __init__(self, default_rate):
+		self.default_rate = default_rate
+		# weight, sum T, sum rate, sum T^2, sum T * rate
+		self.sums = (0.0, 0.0, 0.0, 0.0, 0.0)
+
+	def add(self, temperature, rate):
+		"""Add a heating rate sample.
+
+		Args:
+			temperature (float): Mean temperature over the sample in degC.
+			rate (float): Temperature increase in degC/s.
+		"""
+		n, sx, sy, sxx, sxy = self.sums
+		self.sums = (n * DECAY + 1.0, sx * DECAY + temperature, sy * DECAY + rate,
+					 sxx * DECAY + temperature * temperature, sxy * DECAY + temperature * rate)
+
+	def fit(self):
+		"""Get the fitted full power model.
+
+		Returns:
+			tuple: (k in 1/s, T_max in degC), None if the samples do not determine it.
+		"""
+		n, sx, sy, sxx, sxy = self.sums
+		if n < MIN_SAMPLES:
+			return None
+		variance = sxx / n - (sx / n) ** 2
+		if variance < MIN_SPREAD * MIN_SPREAD:
+			return None
+		b = (sxy / n - sx * sy / (n * n)) / variance
+		if b >= 0:
+			return None
+		a = sy / n - b * sx / n
+		return -b, a / -b
+
+	def time_to(self, start, target):
+		"""Estimate the seconds to heat from one temperature to another on full power.
+
+		Uses the fitted model when it can reach the target, otherwise the mean or default heating rate.
+		"""
+		if target <= start:
+			return 0.0
+		fit = self.fit()
+		if fit is not None:
+			k, t_max = fit
+			if t_max > target:
+				return math.log((t_max - start) / (t_max - target)) / k
+		n, _, sy, _, _ = self.sums
+		rate = sy / n if n >= MIN_SAMPLES and sy > 0 else self.default_rate
+		return (target - start) / rate
+
+
+class ThermalModel(PrinterCallback):
+	"""Heater models learned from the temperatures OctoPrint reports, see :class:`HeaterModel`.
+
+	Registered as a printer callback. Two consecutive reports of a heater with the same target, both at least
+	:data:`FULL_POWER_MARGIN` below it, give one heating rate sample.
+
+	Attributes:
+		dirty (bool): Samples were added since the model was last saved.
+	"""
+
+	def __init__(self):
+		self.heaters = {}
+		self.dirty = False
+		self._last = {}
+
+	def heater(self, name):
+		"""Get the model of a heater, created on first use."""
+		model = self.heaters.get(name)
+		if model is None:
+			model = self.heaters[name] = HeaterModel(DEFAULT_RATES["bed" if name == "bed" else "tool"])
+		return model
+
+	def time_to(self, heater, start, target):
+		"""Estimate the seconds to heat a heater from one temperature to another, see :meth:`HeaterModel.time_to`."""
+		return self.heater(heater).time_to(start, target)
+
+	def update(self, temperatures, now):
+		"""Add the samples of a temperature report.
+
+		Args:
+			temperatures (dict): {heater: (actual, target)}.
+			now (float): Monotonic time of the report in seconds.
+		"""
+		for name, (actual, target) in temperatures.items():
+			if actual is None or not target:
+				self._last.pop(name, None)
+				continue
+			last = self._last.get(name)
+			self._last[name] = (now, actual, target)
+			if last is None:
+				continue
+			last_time, last_actual, last_target = last
+			elapsed = now - last_time
+			if (last_target == target and 0 < elapsed <= MAX_SAMPLE_GAP and
+					last_actual < target - FULL_POWER_MARGIN and actual < target - FULL_POWER_MARGIN):
+				self.heater(name).add((actual + last_actual) / 2.0, (actual - last_actual) / elapsed)
+				self.dirty = True
+
+	def on_printer_add_temperature(self, data):
+		self.update(dict((heater, (values.get("actual"), values.get("target")))
+						 for heater, values in data.items() if isinstance(values, dict)), monotonic())
+
+	def to_dict(self):
+		return {"version": MODEL_VERSION,
+				"heaters": dict((name, list(model.sums)) for name, model in self.heaters.items())}
+
+	def restore(self, data):
+		"""Load the heater models saved by :meth:`to_dict`.
+
+		Raises:
+			ValueError: If the data is not a saved model.
+		"""
+		if not isinstance(data, dict) or data.get("version") != MODEL_VERSION:
+			raise ValueError("Unsupported thermal model data")
+		for name, sums in data["heaters"].items():
+			if len(sums) != 5:
+				raise ValueError("Invalid thermal model of {}".format(name))
+			self.heater(name).sums = tuple(float(value) for value in sums)
+
+	def load(self, path):
+		"""Load the model from a file. A missing or invalid file leaves the model untrained.
+
+		Returns:
+			bool: True if the model was loaded.
+		"""
+		try:
+			with open(path) as f:
+				self.restore(json.load(f))
+		except (IOError, OSError, ValueError, KeyError, TypeError):
+			return False
+		return True
+
+	def save(self, path):
+		"""Store the model, replacing the file atomically."""
+		folder = os.path.dirname(path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+		# cleared before the model is serialized, so samples added during the write mark it dirty again
+		self.dirty = False
+		try:
+			temp = path + ".tmp"
+			with open(temp, "w") as f:
+				json.dump(self.to_dict(), f, separators=(",", ":"))
+			os.rename(temp, path)
+		except Exception:
+			# saved again on the next attempt
+			self.dirty = True
+			raise
@@ -0,0 +1,9 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+try:
+	from time import monotonic
+except ImportError:  # Python 2
+	from time import time as monotonic
+
+__all__ = ["monotonic"]
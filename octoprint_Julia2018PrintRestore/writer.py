@@ -0,0 +1,154 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+from .util import monotonic
+
+
+class CheckpointWriter(object):
+	"""Long-lived thread writing restore checkpoints to storage.
+
+	Checkpoints are handed over through a single-slot mailbox holding only the latest one.
+	A checkpoint submitted while the previous is still waiting replaces it (coalesced), so a slow disk
+	never builds up a backlog and the newest state is always the one written next.
+
+	Args:
+		storage (object): Restore storage backend, see :mod:`storage`.
+		logger (logging.Logger): Logger for write errors.
+		on_failure (callable, optional): Called with the checkpoint data when a write failed.
+	"""
+
+	def __init__(self, storage, logger, on_failure=None):
+		self.storage = storage
+		self._logger = logger
+		self._on_failure = on_failure
+		self._cond = threading.Condition()
+		self._pending = None
+		self._writing = False
+		self._running = False
+		self._thread = None
+
+		self._queued = 0
+		self._coalesced = 0
+		self._written = 0
+		self._failed = 0
+		self._latency_last = 0.0
+		self._latency_max = 0.0
+		self._latency_total = 0.0
+
+	def start(self):
+		"""Start the writer thread."""
+		with self._cond:
+			if self._running:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._run, name="PrintRestoreCheckpointWriter")
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self, timeout=None):
+		"""Stop the writer thread after the pending checkpoint was written.
+
+		Args:
+			timeout (float, optional): Seconds to wait for the thread to finish.
+		"""
+		with self._cond:
+			self._running = False
+			self._cond.notify_all()
+		if self._thread is not None:
+			self._thread.join(timeout)
+
+	def submit(self, data):
+		"""Queue a checkpoint, replacing the one still waiting to be written.
+
+		Args:
+			data (dict): Restore data.
+		"""
+		with self._cond:
+			if self._pending is not None:
+				self._coalesced += 1
+			self._pending = data
+			self._queued += 1
+			self._cond.notify_all()
+
+	def flush(self, timeout=None):
+		"""Wait until the waiting checkpoint and a write in progress are on disk.
+
+		Args:
+			timeout (float, optional): Seconds to wait at most.
+
+		Returns:
+			bool: True if everything submitted so far was written, False on timeout, on a failed write or if the
+				writer thread is not running.
+		"""
+		deadline = None if timeout is None else monotonic() + timeout
+		with self._cond:
+			failed = self._failed
+			while self._pending is not None or self._writing:
+				if self._thread is None or not self._thread.is_alive():
+					return False
+				if deadline is None:
+					self._cond.wait()
+				else:
+					remaining = deadline - monotonic()
+					if remaining <= 0:
+						return False
+					self._cond.wait(remaining)
+			return self._failed == failed
+
+	def discard(self):
+		"""Drop the waiting checkpoint and wait for a write in progress to finish."""
+		with self._cond:
+			self._pending = None
+			while self._writing:
+				self._cond.wait()
+
+	def stats(self):
+		"""Writer counters.
+
+		Returns:
+			dict: Checkpoint counts and write + fsync latency in seconds.
+		"""
+		with self._cond:
+			return dict(queued=self._queued,
+						coalesced=self._coalesced,
+						written=self._written,
+						failed=self._failed,
+						fsyncLatencyLast=self._latency_last,
+						fsyncLatencyMax=self._latency_max,
+						fsyncLatencyAvg=self._latency_total / self._written if self._written else 0.0)
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._pending is None and self._running:
+					self._cond.wait()
+				if self._pending is None:
+					return
+				data = self._pending
+				self._pending = None
+				self._writing = True
+
+			start = monotonic()
+			try:
+				self.storage.write(data)
+				ok = True
+			except Exception as e:
+				ok = False
+				self._logger.error("Could not write to restore file\n" + str(e))
+			latency = monotonic() - start
+
+			with self._cond:
+				self._writing = False
+				if ok:
+					self._written += 1
+					self._latency_last = latency
+					self._latency_max = max(self._latency_max, latency)
+					self._latency_total += latency
+				else:
+					self._failed += 1
+				self._cond.notify_all()
+
+			if not ok and self._on_failure is not None:
+				self._on_failure(data)